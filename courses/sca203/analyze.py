@@ -1 +1,252 @@
-import cwtvla
\ No newline at end of file
+"""Fixed vs random t-tests computed while capturing, up to third order.
+
+cwtvla.analysis.t_test(group1, group2) needs every trace of both groups in
+memory. Here each trace updates running central sums per sample point
+instead, so memory is O(samples) whatever the number of traces, and
+t_test() gives the same t_val for check_t_test()::
+
+    acc = TTestAccumulator(scope.adc.samples, N, max_order=3)
+    for i in trange(N):
+        ...
+        acc.add(0, trace.wave)    # group A (fixed)
+        ...
+        acc.add(1, trace.wave)    # group B (random)
+    t_val = acc.t_test()          # first order
+    fp = check_t_test(t_val)
+    t_val3 = acc.t_test(order=3)  # e.g. for a masked implementation
+
+Traces already in a zarr store go through zarr_t_test(), a chunk at a
+time. Accumulators from separate runs or processes combine exactly with
+merge(), and can be kept between runs with save()/load().
+
+The higher order tests follow Schneider & Moradi, "Leakage Assessment
+Methodology" (CHES 2015): the order d test compares the means of the
+centered (d = 2) or standardized (d = 3) traces raised to the power d,
+which needs the central moments up to 2d.
+"""
+from math import comb
+
+import numpy as np
+
+
+class Moments:
+    """Running count, mean and central sums sum((x - mean)**p) for p up to
+    max_power, per sample point.
+
+    Traces are added one at a time or a chunk at a time; both, and merge(),
+    use the pairwise update of Pebay, "Formulas for Robust, One-Pass
+    Parallel Computation of Covariances and Arbitrary-Order Statistical
+    Moments" (2008), so the result doesn't depend on how the traces were
+    split up.
+    """
+
+    def __init__(self, samples, max_power=2):
+        self.n = 0
+        self.max_power = max_power
+        self.mean = np.zeros(samples, dtype='float64')
+        # sums[p] is the central sum of power p, sums[0] and sums[1] are unused
+        self.sums = np.zeros((max_power + 1, samples), dtype='float64')
+
+    @property
+    def m2(self):
+        return self.sums[2]
+
+    def add(self, wave):
+        wave = np.asarray(wave, dtype='float64')
+        if self.max_power == 2:
+            # Welford's update, the common first order case
+            self.n += 1
+            delta = wave - self.mean
+            self.mean += delta / self.n
+            self.sums[2] += delta * (wave - self.mean)
+            return
+        if not self.n:
+            self.n, self.mean = 1, wave.copy()
+            return
+        # merge() with a single trace: its central sums are all zero, which
+        # leaves the terms in powers of delta. Higher powers first, so each
+        # uses the lower sums from before this trace.
+        na = self.n
+        self.n += 1
+        delta = wave - self.mean
+        # powers[k] = (-delta / n)**k
+        powers = [None, delta * (-1 / self.n)]
+        for k in range(2, self.max_power + 1):
+            powers.append(powers[-1] * powers[1])
+        for p in range(self.max_power, 2, -1):
+            for k in range(1, p - 1):
+                self.sums[p] += comb(p, k) * powers[k] * self.sums[p - k]
+            # (na / n * delta)**p * (1 - (-1 / na)**(p - 1))
+            self.sums[p] += (-na) ** p * (1 - (-1 / na) ** (p - 1)) * powers[p]
+        self.sums[2] += delta ** 2 * (na / self.n)
+        self.mean += delta / self.n
+
+    def add_many(self, waves):
+        """Add a 2D array of traces at once, e.g. a chunk read from zarr."""
+        waves = np.asarray(waves, dtype='float64')
+        if not waves.shape[0]:
+            return
+        other = Moments(waves.shape[1], self.max_power)
+        other.n = waves.shape[0]
+        other.mean = waves.mean(axis=0)
+        centered = waves - other.mean
+        power = centered * centered
+        for p in range(2, self.max_power + 1):
+            other.sums[p] = power.sum(axis=0)
+            if p < self.max_power:
+                power *= centered
+        self.merge(other)
+
+    def merge(self, other):
+        """Combine with the moments of other traces."""
+        if not other.n:
+            return self
+        if not self.n:
+            self.n, self.mean, self.sums = other.n, other.mean.copy(), other.sums.copy()
+            return self
+        na, nb = self.n, other.n
+        n = na + nb
+        delta = other.mean - self.mean
+        sums = self.sums + other.sums
+        for p in range(3, self.max_power + 1):
+            for k in range(1, p - 1):
+                sums[p] += comb(p, k) * delta ** k * ((-nb / n) ** k * self.sums[p - k] + (na / n) ** k * other.sums[p - k])
+            sums[p] += (na * nb / n * delta) ** p * (1 / nb ** (p - 1) - (-1 / na) ** (p - 1))
+        sums[2] += delta ** 2 * (na * nb / n)
+        self.mean = self.mean + delta * (nb / n)
+        self.sums = sums
+        self.n = n
+        return self
+
+    def central(self, p):
+        """The p-th central moment, sum((x - mean)**p) / n."""
+        return self.sums[p] / self.n
+
+    def variance(self):
+        """Sample variance (n - 1 degrees of freedom), like scipy's ttest_ind."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sums[2] / (self.n - 1)
+
+    def order_stats(self, order):
+        """Mean and variance of the traces preprocessed for an order 1, 2 or 3 test."""
+        if order == 1:
+            return self.mean, self.variance()
+        cm2 = self.central(2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if order == 2:
+                return cm2, self.central(4) - cm2 ** 2
+            if order == 3:
+                cm3 = self.central(3)
+                return cm3 / cm2 ** 1.5, (self.central(6) - cm3 ** 2) / cm2 ** 3
+        raise ValueError("order must be 1, 2 or 3, not {}".format(order))
+
+
+def welch_t(a, b, order=1):
+    """Welch's t-statistic per sample point between two Moments."""
+    mean_a, var_a = a.order_stats(order)
+    mean_b, var_b = b.order_stats(order)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (mean_a - mean_b) / np.sqrt(var_a / a.n + var_b / b.n)
+
+
+class TTestAccumulator:
+    """Fixed vs random Welch t-tests, one trace or chunk at a time.
+
+    Like cwtvla.analysis.t_test(), each group is split in two halves and
+    t_test() gives one t-statistic per half, so check_t_test() can require a
+    leak in both. With num_traces (the traces per group), the first half of
+    each group's traces go in the first half as t_test() would split them;
+    without it traces alternate between the halves.
+
+    Args:
+        samples (int): Samples per trace.
+        num_traces (int): Traces that will be added to each group.
+        max_order (int): Highest order of test wanted, up to 3. Each order
+            needs twice as many central sums per sample point.
+    """
+
+    def __init__(self, samples, num_traces=None, max_order=1):
+        if max_order not in (1, 2, 3):
+            raise ValueError("max_order must be 1, 2 or 3, not {}".format(max_order))
+        self.samples = samples
+        self.num_traces = num_traces
+        self.max_order = max_order
+        # [half][group]
+        self.moments = [[Moments(samples, 2 * max_order), Moments(samples, 2 * max_order)] for _ in range(2)]
+        self.added = [0, 0]
+
+    def _half(self, group):
+        i = self.added[group]
+        if self.num_traces:
+            return 0 if i < self.num_traces // 2 else 1
+        return i % 2
+
+    def add(self, group, wave):
+        """Add a trace to group 0 (fixed) or 1 (random)."""
+        self.moments[self._half(group)][group].add(wave)
+        self.added[group] += 1
+
+    def add_many(self, group, waves):
+        """Add the next traces of a group at once, as a 2D array."""
+        waves = np.asarray(waves)
+        if self.num_traces:
+            split = min(max(self.num_traces // 2 - self.added[group], 0), len(waves))
+            self.moments[0][group].add_many(waves[:split])
+            self.moments[1][group].add_many(waves[split:])
+        else:
+            first = self.added[group] % 2
+            self.moments[0][group].add_many(waves[first::2])
+            self.moments[1][group].add_many(waves[1 - first::2])
+        self.added[group] += len(waves)
+
+    def merge(self, other):
+        """Add the traces of another accumulator, e.g. from another run or process."""
+        for half in range(2):
+            for group in range(2):
+                self.moments[half][group].merge(other.moments[half][group])
+        self.added = [a + b for a, b in zip(self.added, other.added)]
+        return self
+
+    def t_test(self, order=1):
+        """t-statistics of an order up to max_order, shape (2, samples), one row per half."""
+        if not 1 <= order <= self.max_order:
+            raise ValueError("order must be from 1 to {}, not {}".format(self.max_order, order))
+        return np.array([welch_t(fixed, random, order) for fixed, random in self.moments])
+
+    def save(self, path):
+        arrays = {}
+        for half in range(2):
+            for group in range(2):
+                m = self.moments[half][group]
+                prefix = 'h{}g{}_'.format(half, group)
+                arrays.update({prefix + 'n': m.n, prefix + 'mean': m.mean, prefix + 'sums': m.sums})
+        np.savez(path, added=self.added, num_traces=self.num_traces or 0, max_order=self.max_order, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            acc = cls(data['h0g0_mean'].shape[0], int(data['num_traces']) or None, int(data['max_order']))
+            acc.added = [int(a) for a in data['added']]
+            for half in range(2):
+                for group in range(2):
+                    m = acc.moments[half][group]
+                    prefix = 'h{}g{}_'.format(half, group)
+                    m.n, m.mean, m.sums = int(data[prefix + 'n']), data[prefix + 'mean'], data[prefix + 'sums']
+        return acc
+
+
+def zarr_t_test(group1, group2, max_order=3, rows=None):
+    """Accumulate fixed vs random traces stored in zarr (or any 2D array) a
+    chunk at a time, e.g. zarr_t_test(z.traces.group1, z.traces.group2).
+
+    Only one chunk of rows is read at once (rows, default the zarr chunk
+    size). Returns the TTestAccumulator, so the t-tests of every order come
+    from one pass over the data.
+    """
+    acc = TTestAccumulator(group1.shape[1], group1.shape[0], max_order)
+    if rows is None:
+        rows = getattr(group1, 'chunks', (2500,))[0]
+    for group, waves in enumerate((group1, group2)):
+        for start in range(0, waves.shape[0], rows):
+            acc.add_many(group, waves[start:start + rows])
+    return acc
@@ -0,0 +1,209 @@
+"""Key/text generation and AES checking off the capture loop's critical path.
+
+Calling ktp.next_group_A()/next_group_B() and verify_AES() for every trace
+puts Python AES work between captures. Here a background thread takes
+the key/text pairs from the ktp a block at a time and encrypts each block
+with a vectorized (numpy) AES, and the returned textouts are compared with
+those expectations in batches::
+
+    inputs = KeyTextQueue(ktp, groups='AB')
+    verifier = BatchVerifier()
+    for i in trange(N):
+        key, text, expected = inputs.next()    # group A
+        trace = cw.capture_trace(scope, target, text, key)
+        verifier.add(expected, trace.textout)
+        key, text, expected = inputs.next()    # group B
+        ...
+    verifier.close()
+    inputs.close()
+
+A wrong encryption raises ValueError("Encryption failed") from add() or
+close(), up to a batch of traces after it happened.
+"""
+import queue
+import threading
+
+import numpy as np
+
+SBOX = np.array([
+    0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67, 0x2b, 0xfe, 0xd7, 0xab, 0x76,
+    0xca, 0x82, 0xc9, 0x7d, 0xfa, 0x59, 0x47, 0xf0, 0xad, 0xd4, 0xa2, 0xaf, 0x9c, 0xa4, 0x72, 0xc0,
+    0xb7, 0xfd, 0x93, 0x26, 0x36, 0x3f, 0xf7, 0xcc, 0x34, 0xa5, 0xe5, 0xf1, 0x71, 0xd8, 0x31, 0x15,
+    0x04, 0xc7, 0x23, 0xc3, 0x18, 0x96, 0x05, 0x9a, 0x07, 0x12, 0x80, 0xe2, 0xeb, 0x27, 0xb2, 0x75,
+    0x09, 0x83, 0x2c, 0x1a, 0x1b, 0x6e, 0x5a, 0xa0, 0x52, 0x3b, 0xd6, 0xb3, 0x29, 0xe3, 0x2f, 0x84,
+    0x53, 0xd1, 0x00, 0xed, 0x20, 0xfc, 0xb1, 0x5b, 0x6a, 0xcb, 0xbe, 0x39, 0x4a, 0x4c, 0x58, 0xcf,
+    0xd0, 0xef, 0xaa, 0xfb, 0x43, 0x4d, 0x33, 0x85, 0x45, 0xf9, 0x02, 0x7f, 0x50, 0x3c, 0x9f, 0xa8,
+    0x51, 0xa3, 0x40, 0x8f, 0x92, 0x9d, 0x38, 0xf5, 0xbc, 0xb6, 0xda, 0x21, 0x10, 0xff, 0xf3, 0xd2,
+    0xcd, 0x0c, 0x13, 0xec, 0x5f, 0x97, 0x44, 0x17, 0xc4, 0xa7, 0x7e, 0x3d, 0x64, 0x5d, 0x19, 0x73,
+    0x60, 0x81, 0x4f, 0xdc, 0x22, 0x2a, 0x90, 0x88, 0x46, 0xee, 0xb8, 0x14, 0xde, 0x5e, 0x0b, 0xdb,
+    0xe0, 0x32, 0x3a, 0x0a, 0x49, 0x06, 0x24, 0x5c, 0xc2, 0xd3, 0xac, 0x62, 0x91, 0x95, 0xe4, 0x79,
+    0xe7, 0xc8, 0x37, 0x6d, 0x8d, 0xd5, 0x4e, 0xa9, 0x6c, 0x56, 0xf4, 0xea, 0x65, 0x7a, 0xae, 0x08,
+    0xba, 0x78, 0x25, 0x2e, 0x1c, 0xa6, 0xb4, 0xc6, 0xe8, 0xdd, 0x74, 0x1f, 0x4b, 0xbd, 0x8b, 0x8a,
+    0x70, 0x3e, 0xb5, 0x66, 0x48, 0x03, 0xf6, 0x0e, 0x61, 0x35, 0x57, 0xb9, 0x86, 0xc1, 0x1d, 0x9e,
+    0xe1, 0xf8, 0x98, 0x11, 0x69, 0xd9, 0x8e, 0x94, 0x9b, 0x1e, 0x87, 0xe9, 0xce, 0x55, 0x28, 0xdf,
+    0x8c, 0xa1, 0x89, 0x0d, 0xbf, 0xe6, 0x42, 0x68, 0x41, 0x99, 0x2d, 0x0f, 0xb0, 0x54, 0xbb, 0x16,
+], dtype='uint8')
+
+# multiplication by 2 in GF(2^8)
+XTIME = np.array([((b << 1) ^ (0x1b if b & 0x80 else 0)) & 0xff for b in range(256)], dtype='uint8')
+
+RCON = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36]
+
+# state byte r + 4c comes from byte r + 4((c + r) % 4)
+SHIFT_ROWS = np.array([(i % 4) + 4 * ((i // 4 + i % 4) % 4) for i in range(16)])
+
+
+def expand_keys(keys):
+    """Round keys for a (n, 16, 24 or 32) array of AES keys, shape (n, rounds + 1, 16)."""
+    keys = np.asarray(keys, dtype='uint8')
+    nk = keys.shape[1] // 4
+    rounds = nk + 6
+    words = [keys[:, 4 * i:4 * i + 4] for i in range(nk)]
+    for i in range(nk, 4 * (rounds + 1)):
+        word = words[i - 1]
+        if i % nk == 0:
+            word = SBOX[np.roll(word, -1, axis=1)]
+            word[:, 0] ^= RCON[i // nk - 1]
+        elif nk > 6 and i % nk == 4:
+            word = SBOX[word]
+        words.append(words[i - nk] ^ word)
+    return np.concatenate(words, axis=1).reshape(keys.shape[0], rounds + 1, 16)
+
+
+def aes_encrypt(keys, texts):
+    """AES encrypt each row of texts ((n, 16) bytes) with the key in the same
+    row of keys, returning the (n, 16) ciphertexts."""
+    round_keys = expand_keys(keys)
+    state = np.asarray(texts, dtype='uint8') ^ round_keys[:, 0]
+    rounds = round_keys.shape[1] - 1
+    for r in range(1, rounds + 1):
+        state = SBOX[state][:, SHIFT_ROWS]
+        if r != rounds:
+            columns = state.reshape(-1, 4, 4)
+            total = np.bitwise_xor.reduce(columns, axis=2)[:, :, None]
+            columns = columns ^ total ^ XTIME[columns ^ np.roll(columns, -1, axis=2)]
+            state = columns.reshape(-1, 16)
+        state = state ^ round_keys[:, r]
+    return state
+
+
+class KeyTextQueue:
+    """Key/text pairs from a ktp with their expected ciphertexts, made ahead
+    of time by a background thread.
+
+    Pairs come from the ktp's next_group_A()/next_group_B() in the order
+    given by groups, repeated: 'AB' alternates like the fixed vs random
+    loops, 'B' is for random vs random. Keys and texts are what the ktp
+    returned.
+
+    Args:
+        ktp: A cwtvla ktp, e.g. FixedVRandomText(16).
+        groups (str): Order of the groups, e.g. 'AB'.
+        block_size (int): Pairs generated and encrypted at once.
+        blocks_ahead (int): Blocks kept ready.
+    """
+
+    def __init__(self, ktp, groups='AB', block_size=1000, blocks_ahead=2):
+        self.ktp = ktp
+        self.groups = groups
+        self.block_size = block_size
+        self._blocks = queue.Queue(maxsize=blocks_ahead)
+        self._block = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _make_block(self):
+        pairs = []
+        while len(pairs) < self.block_size:
+            for group in self.groups:
+                pairs.append(getattr(self.ktp, 'next_group_' + group)())
+        expected = aes_encrypt([list(key) for key, text in pairs], [list(text) for key, text in pairs])
+        return [(key, text, expected[i]) for i, (key, text) in enumerate(pairs)]
+
+    def _fill(self):
+        while not self._stop.is_set():
+            try:
+                block = self._make_block()
+            except Exception as e:
+                block = e
+            while not self._stop.is_set():
+                try:
+                    self._blocks.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(block, Exception):
+                return
+
+    def next(self):
+        """The next (key, text, expected ciphertext)."""
+        if not self._block:
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            # popping from the end is cheap
+            self._block = block[::-1]
+        return self._block.pop()
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchVerifier:
+    """Checks the targets' textouts against expected ciphertexts a batch at a time.
+
+    Args:
+        batch_size (int): Traces between checks.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.expected = np.zeros((batch_size, 16), dtype='uint8')
+        self.textouts = np.zeros((batch_size, 16), dtype='uint8')
+        self.valid = np.zeros(batch_size, dtype=bool)
+        self.num_buffered = 0
+        self.num_checked = 0
+
+    def add(self, expected, textout):
+        """Add a trace's expected ciphertext and its textout."""
+        i = self.num_buffered
+        self.expected[i] = expected
+        self.valid[i] = textout is not None and len(textout) == 16
+        if self.valid[i]:
+            self.textouts[i] = np.frombuffer(bytes(textout), dtype='uint8')
+        self.num_buffered += 1
+        if self.num_buffered == self.batch_size:
+            self.check()
+
+    def check(self):
+        """Compare everything added so far, raising ValueError on a wrong encryption."""
+        n = self.num_buffered
+        wrong = ~self.valid[:n] | (self.expected[:n] != self.textouts[:n]).any(axis=1)
+        self.num_buffered = 0
+        self.num_checked += n
+        if wrong.any():
+            raise ValueError("Encryption failed for trace {}".format(self.num_checked - n + int(np.argmax(wrong))))
+
+    def close(self):
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # don't hide the error that stopped the capture
+        if exc_type is None:
+            self.close()
@@ -10,36 +10,43 @@ scope.default_setup()
 # capture traces...
 N = 50000 #total traces = 2*n
 
-from cwtvla.ktp import FixedVRandomText, verify_AES
+from cwtvla.ktp import FixedVRandomText
+from batch_aes import KeyTextQueue, BatchVerifier
 import numpy as np
 key_len = 16
 ktp = FixedVRandomText(key_len)
-
-group1 = np.zeros((N, scope.adc.samples), dtype='float64')
-group2 = np.zeros((N, scope.adc.samples), dtype='float64')
+# keys, texts and expected ciphertexts are made ahead and textouts checked in
+# batches, so the loop only captures
+inputs = KeyTextQueue(ktp, 'AB')
+verifier = BatchVerifier()
+
+# running moments per sample point instead of keeping every trace,
+# up to the ones needed for a third order test
+from analyze import TTestAccumulator
+acc = TTestAccumulator(scope.adc.samples, N, max_order=3)
 for i in trange(N):
-    key, text = ktp.next_group_A()
+    key, text, expected = inputs.next()
 
     trace = cw.capture_trace(scope, target, text, key)
     while trace is None:
         trace = cw.capture_trace(scope, target, text, key)
 
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
-    group1[i,:] = trace.wave[:]
+    verifier.add(expected, trace.textout)
+    acc.add(0, trace.wave)
 
-    key, text = ktp.next_group_B() 
+    key, text, expected = inputs.next()
     trace = cw.capture_trace(scope, target, text, key)
     while trace is None:
         trace = cw.capture_trace(scope, target, text, key)
 
-    group2[i,:] = trace.wave[:]
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
+    acc.add(1, trace.wave)
+    verifier.add(expected, trace.textout)
+verifier.close()
+inputs.close()
 
 # do analysis
-from cwtvla.analysis import t_test, check_t_test
-t_val = t_test(group1, group2)
+from cwtvla.analysis import check_t_test
+t_val = acc.t_test()
 fp = check_t_test(t_val)
 
 if len(fp) > 0:
@@ -47,6 +54,14 @@ if len(fp) > 0:
 else:
     print("Passed T Test")
 
+# higher order tests, for masked implementations
+for order in (2, 3):
+    fp = check_t_test(acc.t_test(order))
+    if len(fp) > 0:
+        print("Failed order {} T Test @ {}".format(order, fp))
+    else:
+        print("Passed order {} T Test".format(order))
+
 import matplotlib.pyplot as plt 
 plt.figure()
 plt.plot(t_val[0])
@@ -59,20 +74,23 @@ N = 100000
 
 import numpy as np
 ktp = FixedVRandomText(key_len)
+inputs = KeyTextQueue(ktp, 'B')
+verifier = BatchVerifier()
 waves = np.zeros((N, scope.adc.samples), dtype='float64')
 textins = np.zeros((N, 16), dtype='uint8')
 
 for i in trange(N):
-    key, text = ktp.next_group_B()
+    key, text, expected = inputs.next()
     trace = cw.capture_trace(scope, target, text, key)
     while trace is None:
         trace = cw.capture_trace(scope, target, text, key)
 
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
+    verifier.add(expected, trace.textout)
     #project.traces.append(trace)
     waves[i, :] = trace.wave
     textins[i, :] = np.array(text)
+verifier.close()
+inputs.close()
 
 ## test rand_v_rand
 from cwtvla.analysis import eval_rand_v_rand, roundinout_hd
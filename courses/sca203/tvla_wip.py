@@ -1,12 +1,141 @@
 import chipwhisperer as cw
 import time
+import queue
+import threading
 import zarr
+import numcodecs
 import numpy as np
-from cwtvla.ktp import FixedVRandomText, FixedVRandomKey, SemiFixedVRandomText, verify_AES
+from cwtvla.ktp import FixedVRandomText, FixedVRandomKey, SemiFixedVRandomText
+from batch_aes import KeyTextQueue, BatchVerifier
 import cwtvla.analysis as analysis
 import matplotlib.pyplot as plt
 from tqdm import trange
 
+class TraceSink:
+    """Writes traces to a zarr group as they're captured, a chunk at a time.
+
+    Each append() copies one row of every array into an in memory chunk.
+    When a chunk is full, a background thread appends it to the arrays
+    (compressed), and then records how many rows are committed in the
+    group's attributes. A crash loses at most the chunks not written yet, and
+    memory holds a few chunks instead of the whole capture.
+
+    Opening a group that already has committed rows resumes after them (see
+    rows); rows written past the last commit are dropped.
+
+    before_flush is called before a chunk goes to the writer, e.g. a
+    BatchVerifier's check(), so a chunk is only committed once every row in
+    it passed. If it raises, or the with block exits with an error, the
+    rows not handed to the writer yet are dropped.
+
+    Args:
+        group (zarr.Group): Group the arrays are in.
+        chunk_rows (int): Rows per chunk, and per write.
+        compressor: numcodecs compressor for new arrays.
+        before_flush: Called with no arguments before each chunk is written.
+        **columns: name=(row length, dtype) for each array, e.g.
+            waves=(scope.adc.samples, 'float64'), textins=(16, 'uint8').
+    """
+
+    def __init__(self, group, chunk_rows=2500, compressor=None, before_flush=None, **columns):
+        if compressor is None:
+            compressor = numcodecs.Blosc(cname='zstd', clevel=3, shuffle=numcodecs.Blosc.BITSHUFFLE)
+        self.group = group
+        self.chunk_rows = chunk_rows
+        self.before_flush = before_flush
+        self.rows = group.attrs.get('committed rows', 0)
+        self.arrays = {}
+        for name, (length, dtype) in columns.items():
+            if name in group:
+                array = group[name]
+                array.resize(self.rows, length)
+            else:
+                array = group.create_dataset(name, shape=(0, length), chunks=(chunk_rows, None), dtype=dtype,
+                                             compressor=compressor)
+            self.arrays[name] = array
+        self._buffers = None
+        self._buffered = 0
+        self._error = None
+        # a couple of chunks waiting at most, so a slow disk holds up the capture instead of filling memory
+        self._queue = queue.Queue(maxsize=2)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def _new_buffers(self):
+        return {name: np.empty((self.chunk_rows, array.shape[1]), dtype=array.dtype) for name, array in self.arrays.items()}
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            buffers, num_rows = item
+            try:
+                if self._error is None:
+                    for name, array in self.arrays.items():
+                        array.append(buffers[name][:num_rows])
+                    self.group.attrs['committed rows'] = self.arrays[next(iter(self.arrays))].shape[0]
+            except Exception as e:
+                self._error = e
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def append(self, **row):
+        """Add one row, a value for every array."""
+        self._check()
+        if self._buffers is None:
+            self._buffers = self._new_buffers()
+        for name, buffer in self._buffers.items():
+            buffer[self._buffered] = row[name]
+        self._buffered += 1
+        self.rows += 1
+        if self._buffered == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Hand the rows buffered so far to the writer."""
+        if self._buffered:
+            if self.before_flush is not None:
+                self.before_flush()
+            self._queue.put((self._buffers, self._buffered))
+            self._buffers = None
+            self._buffered = 0
+
+    def close(self):
+        """Write everything appended and wait for it to be committed."""
+        try:
+            self.flush()
+        except Exception:
+            self.discard()
+            raise
+        self._stop_writer()
+        self._check()
+
+    def discard(self):
+        """Drop the rows not handed to the writer yet and stop it; chunks
+        already handed over are still committed."""
+        self.rows -= self._buffered
+        self._buffers = None
+        self._buffered = 0
+        self._stop_writer()
+
+    def _stop_writer(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # don't commit rows captured before the error, they may be bad
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
 def setup_device(name):
     scope = cw.scope()
     if name == "CW305":
@@ -52,68 +181,63 @@ def setup_device(name):
 
     return scope,target
 
-def random_v_random_capture(platform, key_len=16, N=10000):
+def random_v_random_capture(platform, key_len=16, N=10000, resume=True):
     #may not be working
     scope,target = setup_device(platform)
     ktp = FixedVRandomText(key_len)
     store = zarr.DirectoryStore('data/{}-{}-{}.zarr'.format(platform,N,key_len))
-    root = zarr.group(store=store, overwrite=True)
-
-    zwaves = root.zeros('traces/waves', shape=(2*N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-    ztextins = root.zeros('traces/textins', shape=(2*N, 16), chunks=(2500, None), dtype='uint8')
+    root = zarr.group(store=store, overwrite=not resume)
 
-    waves = zwaves[:,:]
-    textins = ztextins[:,:]
-    
-    for i in trange(2*N):
-        key, text = ktp.next_group_B()
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
+    # traces go to the store a chunk at a time as they're captured,
+    # inputs are made ahead and encryptions checked in batches, every chunk
+    # checked before it's written
+    with BatchVerifier() as verifier, KeyTextQueue(ktp, 'B') as inputs, \
+            TraceSink(root.require_group('traces'), before_flush=verifier.check,
+                      waves=(scope.adc.samples, 'float64'), textins=(16, 'uint8')) as sink:
+        for i in trange(sink.rows, 2*N):
+            key, text, expected = inputs.next()
             trace = cw.capture_trace(scope, target, text, key)
+            while trace is None:
+                trace = cw.capture_trace(scope, target, text, key)
 
-        if not verify_AES(text, key, trace.textout):
-            raise ValueError("Encryption failed")
-        #project.traces.append(trace)
-        waves[i, :] = trace.wave
-        textins[i, :] = np.array(text)
-    zwaves[:,:] = waves[:,:]
-    ztextins[:,:] = textins[:,:]
+            verifier.add(expected, trace.textout)
+            #project.traces.append(trace)
+            sink.append(waves=trace.wave, textins=np.array(text))
     print("Last encryption took {} samples".format(scope.adc.trig_count))
 
 
 
-def do_invariant_test(ktp_class, platform, N=10000, key_len=16):
+def do_invariant_test(ktp_class, platform, N=10000, key_len=16, resume=True):
     # may not be working
     scope, target = setup_device(platform)
     #scope.adc.offset = 20000
     ktp = ktp_class(key_len)
     #ktp = FixedVRandomKey(key_len)
-    #store = zarr.DirectoryStore('SFvR/{}-{}-{}-{}.zarr'.format(platform, ktp._name, N, key_len))
-    #root = zarr.group(store=store, overwrite=True)
-    root = zarr.group("")
-    zgroup1 = root.zeros('traces/group1', shape=(N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-    zgroup2 = root.zeros('traces/group2', shape=(N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-
-    group1 = zgroup1[:,:]
-    group2 = zgroup2[:,:]
-    for i in trange(N):
-        key, text = ktp.next_group_A()
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
+    store = zarr.DirectoryStore('SFvR/{}-{}-{}-{}.zarr'.format(platform, ktp._name, N, key_len))
+    root = zarr.group(store=store, overwrite=not resume)
+
+    # a row holds one trace of each group, written a chunk at a time as they're captured,
+    # inputs are made ahead and encryptions checked in batches, every chunk
+    # checked before it's written
+    with BatchVerifier() as verifier, KeyTextQueue(ktp, 'AB') as inputs, \
+            TraceSink(root.require_group('traces'), before_flush=verifier.check,
+                      group1=(scope.adc.samples, 'float64'), group2=(scope.adc.samples, 'float64')) as sink:
+        for i in trange(sink.rows, N):
+            key, text, expected = inputs.next()
             trace = cw.capture_trace(scope, target, text, key)
+            while trace is None:
+                trace = cw.capture_trace(scope, target, text, key)
 
-        if not verify_AES(text, key, trace.textout):
-            raise ValueError("Encryption failed")
-        group1[i,:] = trace.wave[:]
+            verifier.add(expected, trace.textout)
+            wave1 = trace.wave
 
-        key, text = ktp.next_group_B() 
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
+            key, text, expected = inputs.next()
             trace = cw.capture_trace(scope, target, text, key)
+            while trace is None:
+                trace = cw.capture_trace(scope, target, text, key)
 
-        group2[i,:] = trace.wave[:]
-        if not verify_AES(text, key, trace.textout):
-            raise ValueError("Encryption failed")
+            verifier.add(expected, trace.textout)
+            sink.append(group1=wave1, group2=trace.wave)
 
     
 if __name__ == "__main__":
@@ -122,14 +246,17 @@ if __name__ == "__main__":
     hp.setrelheap()
     z = zarr.open("SFvR/STM32F4-SemiFixedVRandomText-5000-16.zarr")
     print(z.tree())
-    group1 = z.traces.group1[:,:]
-    group2 = z.traces.group2[:,:]
+    # one pass over the store, a chunk at a time, for every order
+    from analyze import zarr_t_test
+    acc = zarr_t_test(z.traces.group1, z.traces.group2, max_order=3)
     print(hp.heap())
-    t = analysis.t_test(group1, group2)
     import matplotlib.pyplot as plt
-    plt.figure()
-    plt.plot(t[0])
-    plt.plot(t[1])
+    for order in (1, 2, 3):
+        t = acc.t_test(order)
+        plt.figure()
+        plt.title("Order {}".format(order))
+        plt.plot(t[0])
+        plt.plot(t[1])
     plt.show()
     #func = analysis.roundinout_hd
     #analysis.eval_rand_v_rand(waves, textins, func, round_range=range(2,3), plot=True)
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Time the harness's stages for some notebooks, without any hardware.
+
+Each notebook is run repeat times against a cw_replay directory (recorded
+with tutorials.py --record, or empty for made up traces), timing:
+
+    kernel start
+        Starting a python3 kernel and waiting until it answers.
+    preprocess
+        Loading, inlining and substituting the notebook (NotebookTemplate),
+        without its cache.
+    execution
+        Running the cells in the started kernel.
+    export
+        Writing the executed notebook as .ipynb to the output directory
+        (export_notebook, which no longer writes HTML or ReST).
+
+For example::
+
+    python benchmark.py --replay replays --repeat 3 --json before.json \\
+        "../courses/sca101/SOLN_Lab 2_1B - Power Analysis for Password Bypass.ipynb"
+    # change the harness
+    python benchmark.py --replay replays --repeat 3 --compare before.json ...
+
+Prints the median and fastest of each stage per notebook; --json saves
+every time and --compare prints the change from a saved run.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tutorials  # noqa: E402
+
+STAGES = ('kernel start', 'preprocess', 'execution', 'export')
+
+
+def start_kernel(cwd):
+    km = tutorials.KernelManager(kernel_name='python3')
+    km.start_kernel(cwd=cwd)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=60)
+    finally:
+        kc.stop_channels()
+    return km
+
+
+def time_notebook(nb_path, replay_dir, output_dir, logger, **kwargs):
+    """One run of nb_path, returning ({stage: seconds}, passed)."""
+    times = {}
+    nb_path = os.path.abspath(nb_path)
+    lab_name, _ = os.path.splitext(os.path.basename(nb_path))
+    replay = os.path.join(os.path.abspath(replay_dir), kwargs.get('SNAME', 'CWLITEARM'), lab_name)
+
+    t = time.time()
+    km = start_kernel(os.path.dirname(nb_path))
+    times['kernel start'] = time.time() - t
+    try:
+        t = time.time()
+        tutorials.NotebookTemplate._templates.clear()
+        template = tutorials.NotebookTemplate.load(nb_path, inline=True)
+        params = template.parameter_values(logger=logger, **kwargs)
+        template.render(params, replay=replay)
+        times['preprocess'] = time.time() - t
+
+        # the template is cached now, so this is almost all execution
+        t = time.time()
+        nb, errors, export_kwargs = tutorials.execute_notebook(nb_path, logger=logger, km=km, replay=replay, **kwargs)
+        times['execution'] = time.time() - t
+    finally:
+        km.shutdown_kernel(now=True)
+
+    os.makedirs(os.path.join(output_dir, export_kwargs['PLATFORM']), exist_ok=True)
+    t = time.time()
+    tutorials.export_notebook(nb, nb_path, output_dir, **export_kwargs, logger=logger)
+    times['export'] = time.time() - t
+    return times, not errors
+
+
+def summarize(results, previous=None):
+    for nb_path, runs in results.items():
+        print(os.path.basename(nb_path))
+        failed = sum(not run['passed'] for run in runs)
+        if failed:
+            print("  {} of {} runs failed".format(failed, len(runs)))
+        for stage in STAGES:
+            seconds = [run['seconds'][stage] for run in runs]
+            line = "  {:<13} median {:7.2f}s  fastest {:7.2f}s".format(stage, statistics.median(seconds), min(seconds))
+            before = (previous or {}).get(nb_path)
+            if before:
+                old = statistics.median(run['seconds'][stage] for run in before)
+                if old:
+                    line += "  ({:+.0%})".format(statistics.median(seconds) / old - 1)
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the tutorial harness's stages for notebooks, replaying recorded devices")
+    parser.add_argument('notebooks', nargs='+')
+    parser.add_argument('--replay', default=tempfile.gettempdir(), metavar='DIR',
+                        help="cw_replay recordings, <DIR>/<SNAME>/<lab name> (made up traces where there's none)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="notebook parameter, e.g. PLATFORM=CWLITEARM (can be repeated)")
+    parser.add_argument('--output-dir', help="where notebooks are exported (a temporary directory by default)")
+    parser.add_argument('--json', help="save every time to this file")
+    parser.add_argument('--compare', help="print the change from a file saved with --json")
+    args = parser.parse_args()
+
+    kwargs = {'SCOPETYPE': 'OPENADC', 'PLATFORM': 'CWLITEARM', 'SNAME': 'CWLITEARM'}
+    for param in args.param:
+        name, value = param.split('=', 1)
+        kwargs[name] = yaml.safe_load(value)
+
+    logger = tutorials.test_logger
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='benchmark')
+    results = {}
+    for nb_path in args.notebooks:
+        for _ in range(args.repeat):
+            seconds, passed = time_notebook(nb_path, args.replay, output_dir, logger, **kwargs)
+            results.setdefault(os.path.abspath(nb_path), []).append({'seconds': seconds, 'passed': passed})
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    summarize(results, previous)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+"""Stand-ins for a ChipWhisperer scope and target that replay a recording.
+
+Lets the tutorials run, and the harness be profiled, on a machine without
+any hardware attached. The harness installs it in the notebook kernel (see
+tutorials.replay_setup_code()) and points every cw.scope()/cw.target() call
+at a replay directory, the same way it fills in sn=/hw_location= for a real
+device::
+
+    scope = cw.scope(replay='replays/CWLITEARM')
+    target = cw.target(scope, cw.targets.SimpleSerial, replay='replays/CWLITEARM')
+    cw.program_target(scope, prog, fw_path)      # waits as long as programming took
+    trace = cw.capture_trace(scope, target, text, key)
+
+A replay directory holds what a Recorder saved while the notebook ran on
+real hardware:
+
+    traces.npz
+        waves, textin, textout, key and seconds (the capture time) of every
+        capture_trace(), served again in order and cycled. textin, textout
+        and key are padded to their longest value, with the real lengths in
+        textin_len, textout_len and key_len (-1 for None).
+    session.json
+        The serial exchanges ([command, data hex, response hex, seconds]),
+        the time cw.scope()/cw.target() and program_target took, and the
+        number of samples.
+
+Anything missing is made up: noise traces of the recorded (or default)
+length, random responses of the requested length and the default
+latencies below, so an empty directory works too. Settings the notebooks
+change (scope.gain.db = 25, scope.adc.samples = 5000, ...) are kept and
+read back, anything never set reads as a settings object.
+
+Only needs numpy, which chipwhisperer depends on.
+"""
+import json
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+
+import numpy as np
+
+Trace = namedtuple('Trace', ['wave', 'textin', 'textout', 'key'])
+
+# roughly what a CW-Lite takes, used when the recording doesn't say
+DEFAULT_LATENCIES = {
+    'connect': 1.0,
+    'program': 3.0,
+    'capture': 0.02,
+    'serial': 0.005,
+}
+DEFAULT_SAMPLES = 5000
+
+
+class Settings:
+    """Accepts any setting, reads back the ones that were set."""
+
+    def __init__(self, name, values=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_values', dict(values or {}))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        values = object.__getattribute__(self, '_values')
+        if name not in values:
+            values[name] = Settings('{}.{}'.format(self._name, name))
+        return values[name]
+
+    def __setattr__(self, name, value):
+        self._values[name] = value
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+    def __repr__(self):
+        return '<replayed {}>'.format(self._name)
+
+
+class Replay:
+    """A loaded replay directory, shared by the scope and target using it."""
+
+    _loaded = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.rng = np.random.default_rng(0)
+        self.session = {}
+        session_path = os.path.join(path, 'session.json')
+        if os.path.isfile(session_path):
+            with open(session_path, encoding='utf-8') as f:
+                self.session = json.load(f)
+        self.latencies = dict(DEFAULT_LATENCIES, **self.session.get('latencies', {}))
+
+        self.traces = None
+        traces_path = os.path.join(path, 'traces.npz')
+        if os.path.isfile(traces_path):
+            with np.load(traces_path) as data:
+                self.traces = {name: data[name] for name in data.files}
+        self.num_captures = 0
+
+        self.responses = {}
+        for command, data, response, seconds in self.session.get('serial', []):
+            self.responses.setdefault((command, data), []).append((bytes.fromhex(response), seconds))
+        self._last_write = None
+
+    @classmethod
+    def load(cls, path):
+        path = os.path.abspath(path)
+        if path not in cls._loaded:
+            cls._loaded[path] = cls(path)
+        return cls._loaded[path]
+
+    @property
+    def samples(self):
+        if self.traces is not None:
+            return self.traces['waves'].shape[1]
+        return self.session.get('samples', DEFAULT_SAMPLES)
+
+    def wait(self, what, seconds=None):
+        time.sleep(self.latencies[what] if seconds is None else seconds)
+
+    def next_trace(self, textin, key, samples):
+        """The next recorded capture, or noise if there isn't a recording."""
+        if self.traces is None or not len(self.traces['waves']):
+            self.wait('capture')
+            return Trace(self.rng.normal(0, 0.05, samples), textin, bytearray(self.rng.bytes(16)), key)
+        i = self.num_captures % len(self.traces['waves'])
+        self.num_captures += 1
+        self.wait('capture', float(self.traces['seconds'][i]) if 'seconds' in self.traces else None)
+        wave = self.traces['waves'][i][:samples]
+        return Trace(wave, *(self._recorded_bytes(name, i) for name in ('textin', 'textout', 'key')))
+
+    def _recorded_bytes(self, name, i):
+        value = self.traces[name][i]
+        if name + '_len' in self.traces:
+            length = int(self.traces[name + '_len'][i])
+            if length < 0:
+                return None
+            value = value[:length]
+        return bytearray(value)
+
+    def write(self, command, data):
+        self._last_write = (command, bytes(data or b'').hex())
+        self.wait('serial')
+
+    def read(self, num_bytes):
+        recorded = self.responses.get(self._last_write)
+        if recorded:
+            response, seconds = recorded[0]
+            # cycle through the responses seen for this write
+            recorded.append(recorded.pop(0))
+            self.wait('serial', seconds)
+            return bytearray(response)
+        self.wait('serial')
+        return bytearray(self.rng.bytes(num_bytes))
+
+
+class ReplayScope(Settings):
+    """Stands in for the scope returned by cw.scope()."""
+
+    def __init__(self, replay):
+        super().__init__('scope')
+        self._values.update(replay=replay, fw_version_str='replay', latest_fw_str='replay',
+                            adc=Settings('scope.adc', {'samples': replay.samples, 'trig_count': replay.samples}))
+        self._last_trace = None
+        replay.wait('connect', replay.session.get('connect seconds'))
+
+    def default_setup(self, *args, **kwargs):
+        pass
+
+    def arm(self):
+        pass
+
+    def capture(self, *args, **kwargs):
+        # False means it didn't time out
+        return False
+
+    def get_last_trace(self, as_int=False):
+        if self._last_trace is None:
+            self._last_trace = self.replay.next_trace(None, None, self.adc.samples)
+        return self._last_trace.wave
+
+    def dis(self):
+        pass
+
+    def _getNAEUSB(self):
+        return Settings('naeusb', {'hw_location': lambda: None, 'is_MPSSE_enabled': lambda: False})
+
+
+class ReplayTarget(Settings):
+    """Stands in for the target returned by cw.target()."""
+
+    def __init__(self, replay, scope=None):
+        super().__init__('target')
+        self._values.update(replay=replay, scope=scope, output_len=16, baud=38400)
+
+    def simpleserial_write(self, command, data, end='\n'):
+        self.replay.write(command, data)
+
+    def simpleserial_read(self, command, num_bytes, end='\n', timeout=250, ack=True):
+        return self.replay.read(num_bytes)
+
+    def simpleserial_wait_ack(self, timeout=500):
+        return bytearray([0])
+
+    def set_key(self, key, ack=True, timeout=250, always_send=False):
+        self.simpleserial_write('k', key)
+
+    def write(self, data):
+        self.replay.write('raw', data.encode() if isinstance(data, str) else data)
+
+    def read(self, num_char=0, timeout=250):
+        return self.replay.read(num_char or 1).hex()
+
+    def in_waiting(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def dis(self):
+        pass
+
+
+def install(cw):
+    """Make cw.scope(replay=...) and cw.target(..., replay=...) return replayed
+    devices, and cw.program_target()/cw.capture_trace() handle them. Calls
+    without replay= go to chipwhisperer as before."""
+    original = {name: getattr(getattr(cw, name), 'original', getattr(cw, name))
+                for name in ('scope', 'target', 'program_target', 'capture_trace')}
+
+    def scope(*args, replay=None, **kwargs):
+        if replay is None:
+            return original['scope'](*args, **kwargs)
+        return ReplayScope(Replay.load(replay))
+
+    def target(scope=None, *args, replay=None, **kwargs):
+        if replay is None:
+            return original['target'](scope, *args, **kwargs)
+        return ReplayTarget(Replay.load(replay), scope)
+
+    def program_target(scope, *args, **kwargs):
+        if not isinstance(scope, ReplayScope):
+            return original['program_target'](scope, *args, **kwargs)
+        scope.replay.wait('program', scope.replay.session.get('program seconds'))
+
+    def capture_trace(scope, target, plaintext, key=None, *args, **kwargs):
+        if not isinstance(scope, ReplayScope):
+            return original['capture_trace'](scope, target, plaintext, key, *args, **kwargs)
+        scope._last_trace = scope.replay.next_trace(plaintext, key, scope.adc.samples)
+        return scope._last_trace
+
+    for name, replacement in (('scope', scope), ('target', target), ('program_target', program_target),
+                              ('capture_trace', capture_trace)):
+        replacement.original = original[name]
+        setattr(cw, name, replacement)
+
+
+class Recorder:
+    """Records what a notebook does with real hardware into a replay directory.
+
+    Wraps cw.scope(), cw.target(), cw.program_target() and cw.capture_trace()
+    to time them and keep every trace and serial exchange; save() writes
+    them out. Install with record(cw, path) in the kernel before the
+    notebook runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.session = {'serial': []}
+        self.captures = {'waves': [], 'textin': [], 'textout': [], 'key': [], 'seconds': []}
+
+    def timed(self, name, fn):
+        def wrapper(*args, **kwargs):
+            t = time.time()
+            result = fn(*args, **kwargs)
+            self.session['{} seconds'.format(name)] = time.time() - t
+            return result
+        return wrapper
+
+    def wrap_target(self, target):
+        write, read = target.simpleserial_write, target.simpleserial_read
+        last = {}
+
+        def simpleserial_write(command, data, *args, **kwargs):
+            last['write'] = (command, bytes(data or b'').hex(), time.time())
+            return write(command, data, *args, **kwargs)
+
+        def simpleserial_read(*args, **kwargs):
+            response = read(*args, **kwargs)
+            if 'write' in last and response is not None:
+                command, data, t = last['write']
+                self.session['serial'].append([command, data, bytes(response).hex(), time.time() - t])
+            return response
+
+        target.simpleserial_write, target.simpleserial_read = simpleserial_write, simpleserial_read
+        return target
+
+    def wrap_capture(self, capture_trace):
+        def wrapper(scope, target, plaintext, key=None, *args, **kwargs):
+            t = time.time()
+            trace = capture_trace(scope, target, plaintext, key, *args, **kwargs)
+            if trace is not None:
+                self.captures['waves'].append(np.asarray(trace.wave, dtype='float32'))
+                for name in ('textin', 'textout', 'key'):
+                    value = getattr(trace, name)
+                    self.captures[name].append(None if value is None else bytes(value))
+                self.captures['seconds'].append(time.time() - t)
+            return trace
+        return wrapper
+
+    @staticmethod
+    def _pad(values):
+        """Byte strings of any length (or None) as a padded (n, longest) uint8
+        array and their lengths, -1 for None."""
+        lengths = np.array([-1 if value is None else len(value) for value in values], dtype='int32')
+        padded = np.zeros((len(values), max(lengths.max(initial=0), 0)), dtype='uint8')
+        for row, value in zip(padded, values):
+            if value:
+                row[:len(value)] = np.frombuffer(value, dtype='uint8')
+        return padded, lengths
+
+    def save(self):
+        """Write the recording. Runs at kernel exit, so errors are printed
+        rather than raised, and the session is written even if the traces
+        can't be."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            if self.captures['waves']:
+                samples = min(len(wave) for wave in self.captures['waves'])
+                self.session['samples'] = samples
+                arrays = {}
+                for name in ('textin', 'textout', 'key'):
+                    arrays[name], arrays[name + '_len'] = self._pad(self.captures[name])
+                np.savez_compressed(os.path.join(self.path, 'traces.npz'),
+                                    waves=np.stack([wave[:samples] for wave in self.captures['waves']]),
+                                    seconds=np.array(self.captures['seconds']), **arrays)
+        except Exception:
+            print("cw_replay: couldn't save the traces to {}:".format(self.path), file=sys.stderr)
+            traceback.print_exc()
+        try:
+            with open(os.path.join(self.path, 'session.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.session, f, indent=1)
+        except Exception:
+            print("cw_replay: couldn't save the session to {}:".format(self.path), file=sys.stderr)
+            traceback.print_exc()
+
+
+def record(cw, path):
+    """Start recording into path, saved when the kernel exits."""
+    import atexit
+    recorder = Recorder(path)
+    scope, target = cw.scope, cw.target
+    cw.scope = recorder.timed('connect', scope)
+    cw.target = lambda *args, **kwargs: recorder.wrap_target(target(*args, **kwargs))
+    cw.program_target = recorder.timed('program', cw.program_target)
+    cw.capture_trace = recorder.wrap_capture(cw.capture_trace)
+    atexit.register(recorder.save)
+    return recorder
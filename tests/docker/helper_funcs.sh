@@ -15,7 +15,10 @@ run_test () {
 	local FROM_EMAIL
 	local TO_EMAILS
 	local CLEAR_RESULTS
-	local USAGE="Usage: run_test [-h|--help] [-H|--hours hours] [--emails sendgrid_api_key from_email to_emails] [--no-check-git] [--no-clear]"
+	local FULL_RUN_HOURS
+	local POLL_MIN_SECONDS
+	local POLL_MAX_SECONDS
+	local USAGE="Usage: run_test [-h|--help] [-H|--hours hours] [--emails sendgrid_api_key from_email to_emails] [--no-check-git] [--no-clear] [--full-run-hours hours] [--poll-seconds min max]"
 
 	while [[ $# -gt 0 ]]; do
 		case $1 in
@@ -57,6 +60,18 @@ run_test () {
 				CLEAR_RESULTS="YES"
 				shift
 				;;
+			--full-run-hours)
+				FULL_RUN_HOURS="$2"
+				shift
+				shift
+				;;
+			--poll-seconds)
+				POLL_MIN_SECONDS="$2"
+				POLL_MAX_SECONDS="$3"
+				shift
+				shift
+				shift
+				;;
 			-*|--*)
 				echo "Unknown option $1"
 				return 1
@@ -82,6 +97,15 @@ run_test () {
 		CHECK_GIT="YES"
 	fi
 
+	if [ -z $FULL_RUN_HOURS ]; then
+		FULL_RUN_HOURS="24"
+	fi
+
+	if [ -z $POLL_MIN_SECONDS ]; then
+		POLL_MIN_SECONDS="60"
+		POLL_MAX_SECONDS="900"
+	fi
+
 	#echo "RUN_HOURS=$RUN_HOURS"
 	#echo "CHECK_GIT=$CHECK_GIT"
 
@@ -99,6 +123,9 @@ run_test () {
 	    -e SENDGRID_API_KEY="$SENDGRID_KEY" \
 	    -e HOURS="$RUN_HOURS" \
 	    -e CHECK_GIT="$CHECK_GIT" \
+	    -e FULL_RUN_HOURS="$FULL_RUN_HOURS" \
+	    -e POLL_MIN_SECONDS="$POLL_MIN_SECONDS" \
+	    -e POLL_MAX_SECONDS="$POLL_MAX_SECONDS" \
 	    cw-testing-server)
 	export CURRENT_TEST_ID
 	echo $CURRENT_TEST_ID
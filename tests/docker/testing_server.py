@@ -1,13 +1,20 @@
 from datetime import datetime
+import asyncio
 import subprocess
-from subprocess import PIPE
+from subprocess import PIPE, DEVNULL
+from collections import deque
+import json
 import shlex
 import sys
 import os
+import signal
 import logging
-from datetime import datetime
-from time import sleep
+from datetime import datetime, timedelta
+from time import sleep, time
+import threading
 from importlib import util
+import shutil
+import yaml
 import usb1
 from pathlib import Path
 
@@ -56,37 +63,93 @@ ACTIVATE_VENV = '. /home/cwtests/.virtualenvs/tests/bin/activate'
 ACTIVATE_VENV_PYTHON = '/home/cwtests/.virtualenvs/tests/bin/activate_this.py'
 
 
-def execute_command(command, directory, shell=False):
+async def run_command(command, directory, shell=False, timeout=None, max_output=1024*1024):
+    """Run a command, logging its output line by line as it arrives.
+
+    Only the last max_output bytes of stdout and of stderr are kept for the
+    return value, so long pip installs and builds don't pile up in memory.
+    A command still running after timeout seconds is killed, along with
+    anything it started, and the output it had written so far is returned
+    with a note on stderr.
+
+    Returns:
+        tuple: (stdout, stderr) as stripped strings.
+    """
     cmd_logger.debug('executing "{}" in "{}" with shell={}'.format(command, directory, shell))
     if shell:
-        process = subprocess.Popen(command,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
-            cwd=directory,
-            shell=True)
+        process = await asyncio.create_subprocess_shell(command, stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                                                        cwd=directory, start_new_session=True)
     else:
-        commands = shlex.split(command)
-        process = subprocess.Popen(commands,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
-            cwd=directory)
-
-    stdout, stderr = process.communicate()
-    stdout, stderr = stdout.decode('utf-8').strip(), stderr.decode('utf-8').strip()
-
-    if stdout:
-        cmd_logger.debug('stdout: \n"{}"\n'.format(stdout))
-    if stderr:
-        cmd_logger.error('stderr: \n"{}"\n'.format(stderr))
-
-    return stdout, stderr
+        process = await asyncio.create_subprocess_exec(*shlex.split(command), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                                                       cwd=directory, start_new_session=True)
+
+    # kept outside stream() so a timeout still has the output so far
+    output = {'stdout': deque(), 'stderr': deque()}
+
+    async def stream(reader, log, name):
+        lines, size = output[name], 0
+        partial, dropping = b'', False
+
+        def add(line):
+            nonlocal size
+            line = line.decode('utf-8', errors='replace').rstrip()
+            log('{}: {}'.format(name, line))
+            lines.append(line)
+            size += len(line) + 1
+            while size > max_output and len(lines) > 1:
+                size -= len(lines.popleft()) + 1
+
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            *complete, partial = (partial + chunk).split(b'\n')
+            for line in complete:
+                if dropping:
+                    # the end of a line that was too long
+                    dropping = False
+                else:
+                    add(line)
+            if len(partial) > max_output:
+                add(partial[:max_output] + b' [rest of line dropped]')
+                partial, dropping = b'', True
+        if partial and not dropping:
+            add(partial)
+
+    streams = asyncio.gather(stream(process.stdout, cmd_logger.debug, 'stdout'),
+                             stream(process.stderr, cmd_logger.error, 'stderr'))
+    try:
+        # wait_for() cancels the streams when it times out
+        await asyncio.wait_for(streams, timeout)
+        await process.wait()
+    except asyncio.TimeoutError:
+        os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+        cmd_logger.error('"{}" timed out after {}s'.format(command, timeout))
+        output['stderr'].append('[timed out after {}s]'.format(timeout))
+
+    return '\n'.join(output['stdout']).strip(), '\n'.join(output['stderr']).strip()
+
+
+def execute_command(command, directory, shell=False, timeout=None):
+    """Run a command and wait for it, see run_command()."""
+    return asyncio.run(run_command(command, directory, shell, timeout))
+
+
+def execute_commands(commands, shell=False, timeout=None):
+    """Run independent (command, directory) pairs at the same time.
+
+    Returns:
+        list: (stdout, stderr) for each command, in order.
+    """
+    async def run_all():
+        return await asyncio.gather(*(run_command(command, directory, shell, timeout) for command, directory in commands))
+    return asyncio.run(run_all())
 
 
 def update_from_remote(directory):
     updated = False
-    out, err = execute_command('git pull --rebase', directory)
+    out, err = execute_command('git pull --rebase', directory, timeout=600)
 
     # check if there was any updates to remote repository
     if os.environ.get('CHECK_GIT') == "NO":
@@ -114,30 +177,59 @@ def checked_out_commit(directory):
     return checked_out_hash
 
 
-def run_tests(cw_dir, config_file):
+def head_commit(directory):
+    commit, err = execute_command('git rev-parse HEAD', directory)
+    return commit
+
+
+def changed_files(directory, since):
+    """Absolute paths of the files changed in the repository at directory
+    between commit since and HEAD, or None if git can't diff them (e.g. since
+    no longer exists after a force push)."""
+    out, err = execute_command('git diff --name-only {} HEAD'.format(since), directory)
+    if err:
+        return None
+    return [os.path.join(directory, line) for line in out.splitlines() if line.strip()]
+
+
+def load_tutorials(cw_dir):
+    jupyter_test_dir = os.path.join(cw_dir, 'jupyter', 'tests')
+    path = os.path.join(jupyter_test_dir, 'tutorials.py')
+    spec = util.spec_from_file_location("tutorials", path)
+    tutorials = util.module_from_spec(spec)
+    spec.loader.exec_module(tutorials)
+    return tutorials
+
+
+def get_config_path(cw_dir, config_file):
+    if not config_file:
+        return os.path.abspath(os.path.join(cw_dir, '..', 'tests.yaml'))
+    return config_file
+
+
+def run_tests(cw_dir, config_file, shard=None):
+    """Run the tutorials, or only the jobs in shard (see tutorials.affected_jobs())."""
     jupyter_dir = os.path.join(cw_dir, 'jupyter')
     jupyter_test_dir = os.path.join(jupyter_dir, 'tests')
     test_script = os.path.join(jupyter_test_dir, 'tutorials.py')
 
     # # wipe virtual environment
+    # the installs go into the same virtualenv, so they can't run at the same time as each other or the wipe
     cmd = '{} && pip freeze | xargs pip uninstall -y'.format(ACTIVATE_VENV)
-    # out1, err1 = execute_command(cmd, cw_dir, shell=True)
+    # out1, err1 = execute_command(cmd, cw_dir, shell=True, timeout=600)
 
     install_cw = '{} && python -m pip install .'.format(ACTIVATE_VENV)
-    # out2, err2 = execute_command(install_cw, cw_dir, shell=True)
+    # out2, err2 = execute_command(install_cw, cw_dir, shell=True, timeout=1800)
 
     install_jupyter = '{} && python -m pip install -r requirements.txt'.format(ACTIVATE_VENV)
-    # out3, err3 = execute_command(install_jupyter, jupyter_dir, shell=True)
+    # out3, err3 = execute_command(install_jupyter, jupyter_dir, shell=True, timeout=1800)
 
     # # activate virtualenvironment
     # with open(ACTIVATE_VENV_PYTHON, 'r') as f:
     #     exec(f.read(), dict(__file__=ACTIVATE_VENV_PYTHON))
 
     # make sure the tutorials.run_tests function is available
-    path = os.path.join(jupyter_test_dir, 'tutorials.py')
-    spec = util.spec_from_file_location("tutorials", os.path.join(jupyter_test_dir, path))
-    tutorials = util.module_from_spec(spec)
-    spec.loader.exec_module(tutorials)
+    tutorials = load_tutorials(cw_dir)
 
     cur_date = local_time()
     cur_date_formatted = '{}-{}-{}:{}'.format(cur_date.year, 
@@ -148,17 +240,25 @@ def run_tests(cw_dir, config_file):
     os.chmod(str(result_path), 0o777) ## need to do this for some reason to get correct permissions
     #result_path = Path(os.getcwd(), "results")
 
-    if not config_file:
-        config_path = os.path.abspath(os.path.join(cw_dir, '..', 'tests.yaml'))
-    else:
-        config_path = config_file
+    config_path = get_config_path(cw_dir, config_file)
+
+    # a partial run only has results for the affected notebooks, so keep the others from last time
+    output_results = os.path.join(cw_dir, 'tutorials', 'results.yaml')
+    previous_results = None
+    if shard is not None and os.path.isfile(output_results):
+        previous_results = os.path.join(str(result_path), 'previous_results.yaml')
+        shutil.copyfile(output_results, previous_results)
 
     cwd = os.getcwd()
     os.chdir(jupyter_test_dir)
     sys.modules['tutorials'] = tutorials
-    summary, tests = eval('tutorials.run_tests("{}", "{}", "{}")'.format(cw_dir, config_path, result_path), {'tutorials': tutorials, '__name__': '__main__'})
+    summary, tests = eval('tutorials.run_tests("{}", "{}", "{}", shard=shard)'.format(cw_dir, config_path, result_path),
+                          {'tutorials': tutorials, 'shard': shard, '__name__': '__main__'})
     os.chdir(cwd)
 
+    if previous_results:
+        tutorials.merge_results([previous_results, output_results], [output_results, os.path.join(str(result_path), 'results.yaml')])
+
     #tests[cmd] = 'Stdout:\n{}\nStderr:{}\n'.format(out1, err1)
     #tests[install_cw] = 'Stdout:\n{}\nStderr:{}\n'.format(out2, err2)
     #tests[install_jupyter] = 'Stdout:\n{}\nStderr:{}\n'.format(out3, err3)
@@ -175,14 +275,167 @@ def local_time():
     return datetime.now()
 
 
+class CommitWatcher:
+    """Watches the remote for new commits in a background thread.
+
+    Polls the upstream branch with git ls-remote, which only asks the remote
+    for its refs, every min_interval seconds while commits are coming in,
+    backing off to max_interval while nothing changes or the remote can't
+    be reached. Touching trigger_file (e.g. from a push webhook) makes it
+    check straight away.
+
+    New commits are queued in pending. next_commit() takes the newest one and
+    drops the ones before it, so pushes that arrive while tests run, or in
+    quick succession, are tested together in a single run of the newest
+    commit.
+    """
+
+    def __init__(self, directory, trigger_file="results/trigger", min_interval=60, max_interval=900):
+        self.directory = directory
+        self.trigger_file = trigger_file
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.pending = []
+        self.last_seen = head_commit(directory)
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def remote_ref(self):
+        """(remote, ref) of the branch the checkout tracks, e.g. ('origin', 'refs/heads/develop')."""
+        upstream, err = execute_command('git rev-parse --abbrev-ref --symbolic-full-name @{u}', self.directory)
+        if err or '/' not in upstream:
+            return 'origin', 'HEAD'
+        remote, branch = upstream.split('/', 1)
+        return remote, 'refs/heads/' + branch
+
+    def remote_commit(self):
+        remote, ref = self.remote_ref()
+        out, err = execute_command('git ls-remote {} {}'.format(remote, ref), self.directory, timeout=60)
+        return out.split()[0] if out else None
+
+    def check(self):
+        """Queue the remote's commit if it's new. Returns True if it was."""
+        commit = self.remote_commit()
+        if not commit:
+            run_logger.warning('could not read the remote commit, next check in {}s'.format(self.interval))
+            return False
+        if commit == self.last_seen:
+            return False
+        run_logger.info('new commit {} on remote'.format(commit))
+        with self._changed:
+            self.last_seen = commit
+            self.pending.append((commit, local_time()))
+            self._changed.notify_all()
+        return True
+
+    def _triggered(self):
+        if self.trigger_file and os.path.exists(self.trigger_file):
+            try:
+                os.remove(self.trigger_file)
+            except OSError:
+                pass
+            run_logger.info('check triggered by {}'.format(self.trigger_file))
+            return True
+        return False
+
+    def _watch(self):
+        next_check = 0
+        while not self._stop.is_set():
+            if self._triggered() or time() >= next_check:
+                if self.check():
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+                next_check = time() + self.interval
+            self._stop.wait(5)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name='commit watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def next_commit(self, timeout=None):
+        """Wait up to timeout seconds for a new commit.
+
+        Returns:
+            str: The newest pending commit, with any older ones dropped, or
+                None if none arrived in time.
+        """
+        with self._changed:
+            if not self.pending:
+                self._changed.wait(timeout)
+            if not self.pending:
+                return None
+            commit, seen = self.pending[-1]
+            if len(self.pending) > 1:
+                run_logger.info('merging {} pushes into one run of {}'.format(len(self.pending), commit))
+            self.pending = []
+        run_logger.info('testing {}, pushed {} ago'.format(commit, local_time() - seen))
+        return commit
+
+
 class Tester:
+    """Runs the tests when the repository changes.
 
-    def __init__(self, chipwhisperer_dir, config_file, testing_hours=(6, 10, 14, 18)):
+    Only the notebooks affected by the changes since the last tested commits
+    are run, with a full run at least every full_run_hours as a safety net.
+    The tested commits are kept in state_file so they survive restarts.
+    """
+
+    def __init__(self, chipwhisperer_dir, config_file, testing_hours=(6, 10, 14, 18), full_run_hours=24,
+                 state_file="results/tested_commits.yaml"):
         self.hours_tested_today = list()
         self.testing_hours = testing_hours
         self.last_test_start_time = None
         self.cw_dir = chipwhisperer_dir
         self.config_file = config_file
+        self.full_run_hours = full_run_hours
+        self.state_file = state_file
+        self.tested = {}
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                self.tested = yaml.safe_load(f) or {}
+
+    def repositories(self):
+        return (('chipwhisperer', self.cw_dir), ('jupyter', os.path.join(self.cw_dir, 'jupyter')))
+
+    def select_tests(self):
+        """Pick the jobs affected by the changes since the last tested commits.
+
+        Returns:
+            dict: A shard for tutorials.run_tests(), or None for a full run.
+        """
+        last_full_run = self.tested.get('last full run')
+        if not last_full_run or local_time() - last_full_run > timedelta(hours=self.full_run_hours):
+            run_logger.info('full run due, last one at {}'.format(last_full_run))
+            return None
+
+        changed = []
+        for name, directory in self.repositories():
+            files = changed_files(directory, self.tested[name]) if self.tested.get(name) else None
+            if files is None:
+                run_logger.info('no tested {} commit to compare with, running everything'.format(name))
+                return None
+            changed += files
+        run_logger.info('changed files: {}'.format(changed))
+
+        tutorials = load_tutorials(self.cw_dir)
+        return tutorials.affected_jobs(self.cw_dir, get_config_path(self.cw_dir, self.config_file), changed)
+
+    def record_tested(self, full_run):
+        heads = execute_commands([('git rev-parse HEAD', directory) for name, directory in self.repositories()])
+        for (name, directory), (commit, err) in zip(self.repositories(), heads):
+            self.tested[name] = commit
+        if full_run:
+            self.tested['last full run'] = self.last_test_start_time
+        with open(self.state_file, 'w') as f:
+            yaml.dump(self.tested, f, default_flow_style=False)
 
     def should_check_repo(self):
         #return True
@@ -196,20 +449,31 @@ class Tester:
         else:
             return False
 
-    def run(self):
+    def run(self, new_commit=False):
+        """Pull and test the changes, if there's a new commit or it's a testing hour."""
         summary = None
         tests = None
-        if self.should_check_repo():
+        if new_commit or self.should_check_repo():
             # check for update from remote
             changes_pulled = update_from_remote(self.cw_dir)
             commit = checked_out_commit(self.cw_dir)
             if changes_pulled:
+                shard = self.select_tests()
+                if shard is not None and not shard['jobs']:
+                    run_logger.info('changes don\'t affect any tutorials, not running tests')
+                    self.record_tested(full_run=False)
+                    return None
+
                 # run the tests on newest changes
-                run_logger.info('running tests at {}'.format(local_time()))
+                if shard is None:
+                    run_logger.info('running all tests at {}'.format(local_time()))
+                else:
+                    run_logger.info('running {} affected tests at {}'.format(len(shard['jobs']), local_time()))
                 #reset_usb()
                 self.last_test_start_time = local_time()
                 self.last_test_time_pretty = server_time()
-                summary, tests = run_tests(cw_dir, self.config_file)
+                summary, tests = run_tests(self.cw_dir, self.config_file, shard)
+                self.record_tested(full_run=shard is None)
                 if self.testing_hours == "once":
                     sys.exit()
                 self.hours_tested_today.append(self.last_test_start_time.day)
@@ -222,17 +486,28 @@ class Tester:
             if day_finished > day_started:
                 self.hours_tested_today = list()
 
-        if summary and tests:
+        if summary:
             return self.last_test_time_pretty, commit, summary, tests
         else:
             return None
 
 
-def create_summaries(summary, tests):
+def create_summaries(summary, tests, history=None):
+    """Title, per hardware lines and tests for the results email.
+
+    With a tutorials.TestHistory and the run's 'run id' in summary, everything
+    comes from the history: the counts, a 'PASSED/FAILED hardware notebook'
+    entry per result, the flaky notebooks and each device's slowest ones.
+    """
+    if history is not None and 'run id' in summary:
+        return history_summaries(history, summary['run id'])
+
     summaries = []
     title = ''
 
     for key, value in summary.items():
+        if not isinstance(value, dict):
+            continue
         failed = value['failed']
         run = value['run']
         passed = run - failed
@@ -245,6 +520,48 @@ def create_summaries(summary, tests):
     return title, summaries, tests
 
 
+def error_lines(errors):
+    # tracebacks are stored as nested lists of lines
+    if isinstance(errors, str):
+        return [errors]
+    return [line for error in errors for line in error_lines(error)]
+
+
+def history_summaries(history, run_id):
+    results = history.run_results(run_id)
+    counts = {}
+    tests = {}
+    for result in results:
+        run, failed = counts.get(result['hardware'], (0, 0))
+        counts[result['hardware']] = (run + 1, failed + (not result['passed']))
+        status = 'PASSED' if result['passed'] else 'FAILED'
+        name = os.path.splitext(os.path.basename(result['notebook']))[0]
+        key = '{} {} {}'.format(status, result['hardware'], name)
+        if result['configuration']:
+            key += ' ({})'.format(result['configuration'])
+        if result['cached']:
+            tests[key] = 'cached'
+        elif result['errors']:
+            tests[key] = '\n'.join(error_lines(json.loads(result['errors'])))
+        else:
+            tests[key] = '{:.0f} s'.format(result['seconds'] or 0)
+
+    run = len(results)
+    failed = sum(not result['passed'] for result in results)
+    title = '{} Failed, {} Passed, {} Run'.format(failed, run - failed, run)
+    summaries = ['{}: {} Failed, {} Passed, {} Run'.format(hardware, failed, run - failed, run)
+                 for hardware, (run, failed) in sorted(counts.items())]
+    for flaky in history.flaky():
+        summaries.append('Flaky: {} on {} ({} of {} runs passed)'.format(flaky['notebook'], flaky['hardware'],
+                                                                        flaky['passes'], flaky['runs']))
+    for hardware in sorted(counts):
+        slowest = history.slowest(hardware, num=3)
+        if slowest:
+            summaries.append('Slowest on {}: {}'.format(hardware, ', '.join(
+                '{} ({:.0f} s)'.format(os.path.splitext(os.path.basename(row['notebook']))[0], row['seconds']) for row in slowest)))
+    return title, summaries, tests
+
+
 def sort_by_failed(tests):
     failed = {}
     passed = {}
@@ -290,15 +607,29 @@ def main(chipwhisperer_dir, config_file):
     else:
         hours = [int(h.strip()) for h in hours_env.strip().split(',') if h.strip()]
 
-    run_logger.info("Running test server with Hours = {}".format(hours))
+    full_run_hours = float(os.environ.get('FULL_RUN_HOURS', 24))
+
+    run_logger.info("Running test server with Hours = {}, full run every {} hours".format(hours, full_run_hours))
+
+    tester = Tester(chipwhisperer_dir, config_file, hours, full_run_hours)
 
-    tester = Tester(chipwhisperer_dir, config_file, hours)
+    # new commits are tested as soon as they're seen, the testing hours still apply too
+    watcher = CommitWatcher(chipwhisperer_dir, trigger_file=os.environ.get('TRIGGER_FILE', 'results/trigger'),
+                            min_interval=float(os.environ.get('POLL_MIN_SECONDS', 60)),
+                            max_interval=float(os.environ.get('POLL_MAX_SECONDS', 900)))
+    watcher.start()
 
     while True:
-        test_results = tester.run()
+        new_commit = watcher.next_commit(timeout=100)
+        test_results = tester.run(new_commit=new_commit is not None)
         if test_results:
             time, commit, summary, tests = test_results
-            title, summaries, tests = create_summaries(summary, tests)
+            history = None
+            if summary.get('history'):
+                history = load_tutorials(chipwhisperer_dir).TestHistory(summary['history'])
+            title, summaries, tests = create_summaries(summary, tests or {}, history)
+            if history:
+                history.close()
 
             tests = sort_by_failed(tests)
 
@@ -322,7 +653,6 @@ def main(chipwhisperer_dir, config_file):
             #email_contents = create_email_contents(jinja_context)
             subject = 'ChipWhisperer Test Results {}'.format(time)
             #send_mail(from_email, to_emails, subject, email_contents)
-        sleep(100)
 
 
 def reset_usb():
@@ -0,0 +1,186 @@
+"""Content addressed cache for the firmware the tutorials build.
+
+The notebooks build firmware in %%bash cells with make, and many of them
+build the same firmware for the same platform. The test harness points make
+in those cells at this script (see tutorials.firmware_cache_env()) and uses
+it to build everything once before the notebooks run (see
+tutorials.prebuild_firmware())::
+
+    cd firmware/mcu/simpleserial-aes
+    python firmware_cache.py CACHE_DIR make PLATFORM=CWLITEARM CRYPTO_TARGET=TINYAES128C
+
+Builds are keyed on the make arguments, the firmware directory's sources,
+the sources shared by all firmware (hal, crypto, simpleserial and the
+makefiles next to them, like Makefile.inc) and the version of every
+compiler the firmware builds with that's on the PATH. On a hit the
+stored build outputs are copied into the firmware directory instead of
+running make. On a miss make runs and the outputs it wrote are stored.
+Hardware workers and notebooks can build the same firmware directory at
+once with other arguments, and the outputs have the same names whatever
+CRYPTO_TARGET or SS_VER are, so each firmware directory is locked (see
+fw_dir_lock()) from the cache lookup until the outputs are stored.
+
+Only uses the standard library, since it runs from the notebook kernels'
+%%bash cells.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no locking on Windows, where the tests don't run in parallel
+    fcntl = None
+
+SOURCE_EXTS = ('.c', '.h', '.s', '.S', '.mk', '.ld', '.inc')
+ARTIFACT_EXTS = ('.hex', '.elf', '.bin', '.map', '.lss', '.sym', '.eep')
+
+# directories next to the firmware directory that every project builds in
+SHARED_DIRS = ('hal', 'crypto', 'simpleserial')
+
+# compilers used by the HALs, a toolchain upgrade changes the build
+COMPILERS = ('arm-none-eabi-gcc', 'avr-gcc', 'riscv64-unknown-elf-gcc')
+
+_compiler_versions = None
+
+
+def _hash_tree(h, path):
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not (d.startswith('objdir') or d.startswith('.')))
+        for name in sorted(files):
+            if name.endswith(SOURCE_EXTS) or name.lower() == 'makefile':
+                file_path = os.path.join(root, name)
+                _hash_file(h, file_path, os.path.relpath(file_path, path))
+
+
+def _hash_file(h, path, name):
+    h.update(name.encode())
+    with open(path, 'rb') as f:
+        h.update(hashlib.sha256(f.read()).digest())
+
+
+def compiler_versions():
+    """--version output of each of COMPILERS found on the PATH."""
+    global _compiler_versions
+    if _compiler_versions is None:
+        _compiler_versions = {}
+        for compiler in COMPILERS:
+            path = shutil.which(compiler)
+            if path is None:
+                continue
+            try:
+                output = subprocess.run([path, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        timeout=30).stdout
+            except (OSError, subprocess.SubprocessError):
+                continue
+            _compiler_versions[compiler] = output.decode(errors='replace')
+    return _compiler_versions
+
+
+def shared_sources(fw_dir):
+    """The SHARED_DIRS next to fw_dir and the makefiles beside them (Makefile.inc
+    and friends, included by every firmware's makefile), which a build in
+    fw_dir also depends on."""
+    parent = os.path.dirname(os.path.abspath(fw_dir))
+    paths = []
+    for name in sorted(os.listdir(parent)):
+        path = os.path.join(parent, name)
+        if name in SHARED_DIRS and os.path.isdir(path):
+            paths.append(path)
+        elif (name.lower().startswith('makefile') or name.endswith(('.inc', '.mk'))) and os.path.isfile(path):
+            paths.append(path)
+    return paths
+
+
+def build_key(fw_dir, args):
+    """Key for running make with args in fw_dir."""
+    fw_dir = os.path.abspath(fw_dir)
+    h = hashlib.sha256()
+    h.update(repr(list(args)).encode())
+    _hash_tree(h, fw_dir)
+    for path in shared_sources(fw_dir):
+        name = os.path.basename(path)
+        if os.path.isdir(path):
+            h.update(name.encode())
+            _hash_tree(h, path)
+        else:
+            _hash_file(h, path, name)
+    for compiler, version in sorted(compiler_versions().items()):
+        h.update(compiler.encode())
+        h.update(version.encode())
+    return h.hexdigest()
+
+
+@contextmanager
+def fw_dir_lock(cache_dir, fw_dir):
+    """Hold an exclusive lock on fw_dir between processes, a file in cache_dir."""
+    if fcntl is None:
+        yield
+        return
+    name = 'lock-' + hashlib.sha256(os.path.abspath(fw_dir).encode()).hexdigest()[:16]
+    with open(os.path.join(cache_dir, name), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cached_make(cache_dir, args, fw_dir=None):
+    """Run args (a make command) in fw_dir, or restore its outputs from cache_dir.
+
+    Returns:
+        int: The make return code, 0 for a cache hit.
+    """
+    if fw_dir is None:
+        fw_dir = os.getcwd()
+    with fw_dir_lock(cache_dir, fw_dir):
+        return _cached_make(cache_dir, args, fw_dir)
+
+
+def _cached_make(cache_dir, args, fw_dir):
+    key = build_key(fw_dir, args)
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.isdir(entry):
+        artifacts = sorted(os.listdir(entry))
+        for name in artifacts:
+            # several notebooks can restore the same build at once
+            tmp_path = os.path.join(fw_dir, '{}.tmp{}'.format(name, os.getpid()))
+            shutil.copy2(os.path.join(entry, name), tmp_path)
+            os.replace(tmp_path, os.path.join(fw_dir, name))
+        print("Using cached firmware build {}: {}".format(key[:12], ", ".join(artifacts)))
+        return 0
+
+    t_start = time.time()
+    returncode = subprocess.call(list(args), cwd=fw_dir)
+    if returncode != 0:
+        return returncode
+
+    # outputs written by this build, allowing for coarse file system timestamps
+    artifacts = [name for name in os.listdir(fw_dir) if name.endswith(ARTIFACT_EXTS) and
+                 os.path.getmtime(os.path.join(fw_dir, name)) >= t_start - 2]
+    if artifacts:
+        tmp_entry = '{}.tmp{}'.format(entry, os.getpid())
+        os.makedirs(tmp_entry)
+        for name in artifacts:
+            shutil.copy2(os.path.join(fw_dir, name), os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another build stored the same key first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    return returncode
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python firmware_cache.py CACHE_DIR make [ARGS...]", file=sys.stderr)
+        sys.exit(2)
+    os.makedirs(sys.argv[1], exist_ok=True)
+    sys.exit(cached_make(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,120 @@
+"""Runs notebook cells once and forks kernels that start from their state.
+
+Started by tutorials.KernelCheckpoint in the notebook's directory. It reads
+one JSON request per line on stdin and answers each with one JSON line on
+stdout:
+
+    {"cells": [source, ...]}
+        Run the cells in order. Answers {"status": "ok" or "error",
+        "outputs": [[output, ...] per cell], "execution counts": [...]},
+        stopping at the first cell that raises.
+    {"fork": connection file}
+        Fork. The child starts a kernel listening on the connection file
+        with the namespace the cells left; the answer is {"pid": pid}.
+    {"exit": true} (or end of input)
+        Exit. Forked kernels keep running until they are shut down.
+
+The cells run in a plain IPython shell, before any kernel sockets or
+threads exist, so the process can be forked safely afterwards.
+"""
+import base64
+import json
+import os
+import signal
+import sys
+
+from IPython.core.displayhook import DisplayHook
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.utils.capture import capture_output
+
+
+class ResultHook(DisplayHook):
+    """Keeps a cell's result as an execute_result output instead of printing it."""
+
+    result = None
+
+    def start_displayhook(self):
+        pass
+
+    def write_output_prompt(self):
+        pass
+
+    def write_format_data(self, format_dict, md_dict=None):
+        self.result = {'output_type': 'execute_result', 'data': json_data(format_dict), 'metadata': md_dict or {}}
+
+    def finish_displayhook(self):
+        pass
+
+
+def json_data(data):
+    return {mime: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value for mime, value in data.items()}
+
+
+def run_cells(shell, sources):
+    outputs, counts = [], []
+    for source in sources:
+        shell.displayhook.result = None
+        with capture_output() as captured:
+            result = shell.run_cell(source, store_history=True)
+        cell_outputs = []
+        for name, text in (('stdout', captured.stdout), ('stderr', captured.stderr)):
+            if text:
+                cell_outputs.append({'output_type': 'stream', 'name': name, 'text': text})
+        for out in captured.outputs:
+            cell_outputs.append({'output_type': 'display_data', 'data': json_data(out.data), 'metadata': out.metadata or {}})
+        counts.append(shell.execution_count - 1)
+        if shell.displayhook.result:
+            cell_outputs.append(dict(shell.displayhook.result, execution_count=counts[-1]))
+        outputs.append(cell_outputs)
+        if not result.success:
+            error = result.error_in_exec or result.error_before_exec
+            return {'status': 'error', 'outputs': outputs, 'execution counts': counts,
+                    'error': "{}: {}".format(type(error).__name__, error)}
+    return {'status': 'ok', 'outputs': outputs, 'execution counts': counts}
+
+
+def fork_kernel(shell, connection_file):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # a kernel of our own, with its own process group so the harness can kill it
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    try:
+        from ipykernel.kernelapp import IPKernelApp
+        user_ns = shell.user_ns
+        execution_count = shell.execution_count
+        InteractiveShell.clear_instance()
+        app = IPKernelApp.instance(connection_file=connection_file, user_ns=user_ns)
+        app.initialize([])
+        app.shell.execution_count = execution_count
+        app.start()
+    finally:
+        os._exit(0)
+
+
+def main():
+    # forked kernels are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    shell = InteractiveShell.instance(displayhook_class=ResultHook)
+    requests, replies = sys.stdin, sys.stdout
+    # anything the cells print outside capture_output mustn't break the replies
+    sys.stdout = sys.stderr
+    for line in requests:
+        request = json.loads(line)
+        if 'cells' in request:
+            reply = run_cells(shell, request['cells'])
+        elif 'fork' in request:
+            reply = {'pid': fork_kernel(shell, request['fork'])}
+        else:
+            break
+        replies.write(json.dumps(reply, default=str) + '\n')
+        replies.flush()
+
+
+if __name__ == '__main__':
+    main()
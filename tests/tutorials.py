@@ -1,6 +1,8 @@
 import shutil
 import os
-from glob import glob
+import copy
+import ast
+from glob import glob, escape as glob_escape
 from pathlib import Path
 from os import listdir
 from os.path import isfile
@@ -8,7 +10,21 @@ import yaml
 import re
 import sys
 import logging
+import logging.handlers
+import multiprocessing
 import time
+import hashlib
+import json
+import base64
+import mimetypes
+import argparse
+import shlex
+import signal
+import sqlite3
+import subprocess
+import threading
+import queue
+from contextlib import contextmanager
 import chipwhisperer as cw
 from datetime import datetime
 
@@ -20,11 +36,17 @@ from nbconvert.preprocessors import ExecutePreprocessor
 from nbconvert import RSTExporter, HTMLExporter
 from nbparameterise import extract_parameters, parameter_values, replace_definitions, Parameter
 from nbconvert.nbconvertapp import NbConvertBase
+from jupyter_client import KernelManager
+from IPython.core.inputtransformer2 import TransformerManager
 test_logger = logging.getLogger("ChipWhisperer Test")
 test_logger.setLevel(logging.DEBUG)
 
 script_path = os.path.abspath(__file__)
 tests_dir, _ = os.path.split(script_path)
+# the helper scripts next to this one, also when loaded from a file path (testing_server.py)
+if tests_dir not in sys.path:
+    sys.path.insert(0, tests_dir)
+from firmware_cache import shared_sources
 # set configuration options
 RSTExporter.template_paths = ['.', tests_dir]
 RSTExporter.extra_template_basedirs = [tests_dir, tests_dir+'/rst_extended']
@@ -42,39 +64,183 @@ def sname_to_log_name(hw_dict):
 output = []
 
 # helper functions for printing results/errors from notebook
-def _get_outputs(nb):
-    return [[i, cell] for i, cell in enumerate(nb.cells) if "outputs" in cell]
+def collect_outputs(nb, allowable_exceptions=()):
+    """Go through every cell's outputs once, collecting errors and streams.
+
+    Returns:
+        tuple: (errors, stdout, stderr), lists of [1 based cell index, output].
+            Errors named in allowable_exceptions are left out.
+    """
+    errors, stdout, stderr = [], [], []
+    for i, cell in enumerate(nb.cells):
+        for output in cell.get('outputs', []):
+            if output.output_type == 'error':
+                if output.ename not in allowable_exceptions:
+                    errors.append([i + 1, output])
+            elif output.output_type == 'stream':
+                (stderr if output.name == 'stderr' else stdout).append([i + 1, output])
+    return errors, stdout, stderr
 
 def _print_stderr(nb, logger=None):
-    outputs = _get_outputs(nb)
     if logger is None:
         logger = test_logger
-    printed_output = [[cell[0], output] for cell in outputs for output in cell[1]['outputs'] if
-                      ('name' in output and output['name'] == 'stderr')]
-    for out in printed_output:
+    for out in collect_outputs(nb)[2]:
         logger.warning("[{}]:\n{}".format(out[0], out[1]['text']))
 
 def _print_stdout(nb, logger=None):
     if logger is None:
         logger = test_logger
-    outputs = _get_outputs(nb)
-    printed_output = [[cell[0], output] for cell in outputs for output in cell[1]['outputs'] if
-                      ('name' in output and output['name'] == 'stdout')]
-    for out in printed_output:
+    for out in collect_outputs(nb)[1]:
         logger.info("[{}]:\n{}".format(out[0], out[1]['text']))
 
 def _print_tracebacks(errors, logger = None, config=None):
-    # to escape ANSI sequences use regex
+    # ANSI sequences are removed by whatever writes the log (see LogWriter), not in the worker
     if logger is None:
         logger = test_logger
-    ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
     if errors == []:
         logger.info("Passed all tests!")
     for error in errors:
-        logger.info("Test failed in cell {}: {}: {}".format(error[0], error[1]['ename'], error[1]['evalue']))
-        for lineno in range(len(error[1]['traceback'])):
-            error[1]['traceback'][lineno] = ansi_escape.sub('', error[1]['traceback'][lineno])
-            logger.log(60, error[1]['traceback'][lineno])
+        logger.info("Test failed in cell {}: {}: {}".format(error[0], error[1]['ename'], error[1]['evalue']),
+                    extra={'event': 'error', 'cell': error[0]})
+        logger.log(60, "\n".join(error[1]['traceback']), extra={'event': 'traceback', 'cell': error[0]})
+
+ANSI_ESCAPE = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
+
+def strip_ansi(value):
+    """value with ANSI escape sequences removed, going into lists and dicts."""
+    if isinstance(value, str):
+        return ANSI_ESCAPE.sub('', value)
+    if isinstance(value, (list, tuple)):
+        return [strip_ansi(v) for v in value]
+    if isinstance(value, dict):
+        return {k: strip_ansi(v) for k, v in value.items()}
+    return value
+
+class NotebookLogger(logging.LoggerAdapter):
+    """Adds fields like the notebook and configuration to every event logged
+    through it, on top of the ones passed with extra=."""
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        return msg, kwargs
+
+class LogWriter:
+    """Writes the logs of every test process from a single writer process.
+
+    The loggers in the main process and the hardware workers only have a
+    QueueHandler (see attach()), so logging never waits on a file or on
+    another process. The writer process routes each record by logger name to
+    the same files as before: testing.log for test_logger, test_<hw>.log
+    and sum_test_<hw>.log for each hardware's logger, and sum_test.log for
+    every summary (level 60) record. ANSI escapes are removed there too.
+
+    Every record is also written to events.jsonl as a structured event with
+    its time, logger, level, message and any of event_fields passed with
+    extra= (see read_events()).
+
+    Args:
+        results_path (str): Directory for the log files.
+        hw_names (list): Short names of the hardware, as from sname_to_log_name().
+    """
+
+    event_fields = ('event', 'hardware', 'notebook', 'configuration', 'cell', 'seconds', 'passed', 'cached')
+
+    def __init__(self, results_path, hw_names):
+        self.results_path = results_path
+        self.hw_names = list(hw_names)
+        self.queue = multiprocessing.Queue()
+        self._process = None
+
+    @staticmethod
+    def logger_names(hw_names):
+        return [test_logger.name] + ["{} Logger".format(name) for name in hw_names]
+
+    @staticmethod
+    def attach(log_queue, hw_names):
+        """Send the test loggers' records in this process to log_queue.
+
+        Used as the ProcessPoolExecutor initializer so workers log the same
+        way however they are started.
+        """
+        for name in LogWriter.logger_names(hw_names):
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.NOTSET)
+            if not any(isinstance(h, logging.handlers.QueueHandler) and h.queue is log_queue for h in logger.handlers):
+                logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    def detach(self):
+        for name in self.logger_names(self.hw_names):
+            logger = logging.getLogger(name)
+            for handler in [h for h in logger.handlers if isinstance(h, logging.handlers.QueueHandler) and h.queue is self.queue]:
+                logger.removeHandler(handler)
+
+    def start(self):
+        self._process = multiprocessing.Process(target=self._write, args=(self.queue, self.results_path, self.hw_names),
+                                                name="test log writer", daemon=True)
+        self._process.start()
+        self.attach(self.queue, self.hw_names)
+
+    def stop(self):
+        """Write everything still queued and stop the writer process."""
+        self.detach()
+        self.queue.put(None)
+        self._process.join()
+
+    @classmethod
+    def _write(cls, log_queue, results_path, hw_names):
+        global_sum = logging.FileHandler(os.path.join(results_path, "sum_test.log"))
+        global_sum.setFormatter(logging.Formatter("%(asctime)s||%(name)s||%(message)s", "%H:%M"))
+        global_sum.setLevel(60)
+        routes = {test_logger.name: [logging.FileHandler(os.path.join(results_path, "testing.log")), global_sum]}
+        for sname in hw_names:
+            full_handle = logging.FileHandler(os.path.join(results_path, "test_{}.log".format(sname)))
+            full_handle.setFormatter(logging.Formatter("%(asctime)s||%(levelname)s||%(lineno)d||%(message)s", "%y-%m-%d %H:%M:%S"))
+            sum_handle = logging.FileHandler(os.path.join(results_path, "sum_test_{}.log".format(sname)))
+            sum_handle.setFormatter(logging.Formatter("%(asctime)s||%(message)s", "%H:%M"))
+            sum_handle.setLevel(60)
+            routes["{} Logger".format(sname)] = [full_handle, sum_handle, global_sum]
+        hw_by_logger = {"{} Logger".format(sname): sname for sname in hw_names}
+
+        with open(os.path.join(results_path, "events.jsonl"), 'a', encoding='utf-8') as events:
+            while True:
+                record = log_queue.get()
+                if record is None:
+                    break
+                record.msg = strip_ansi(record.getMessage())
+                record.args = None
+                for handler in routes.get(record.name, routes[test_logger.name]):
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+                event = {'time': datetime.fromtimestamp(record.created).isoformat(), 'logger': record.name,
+                         'level': record.levelname, 'message': record.msg}
+                if record.name in hw_by_logger:
+                    event['hardware'] = hw_by_logger[record.name]
+                event.update((field, getattr(record, field)) for field in cls.event_fields if hasattr(record, field))
+                events.write(json.dumps(event, default=str) + '\n')
+                if log_queue.empty():
+                    events.flush()
+
+        for handlers in routes.values():
+            for handler in handlers:
+                handler.close()
+
+def read_events(path, **fields):
+    """Events from a run's events.jsonl (see LogWriter) with the given field
+    values, e.g. read_events(path, event='notebook finished', passed=False).
+
+    path can be the file or the results directory holding it.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "events.jsonl")
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if all(event.get(k) == v for k, v in fields.items()):
+                yield event
 
 
 # Context manager for changing current working directory.
@@ -110,8 +276,22 @@ def put_all_kwargs_in_notebook(params, logger=None, **kwargs):
 
 # do the execution of the notebook
 # also do any substiutions (scope hw location, PLATFORM, SS_VER, etc)
-def execute_notebook(nb_path, serial_number=None, baud=None, hw_location=None, target_hw_location=None, allow_errors=True, SCOPETYPE='OPENADC', PLATFORM='CWLITEARM', SNAME="CWLITEARM", logger=None, **kwargs):
+def execute_notebook(nb_path, serial_number=None, baud=None, hw_location=None, target_hw_location=None, allow_errors=True, SCOPETYPE='OPENADC', PLATFORM='CWLITEARM', SNAME="CWLITEARM", logger=None, km=None, profiler=None,
+                     fail_fast=None, cell_timeout=None, notebook_timeout=None, allowable_exceptions=None, setup_code=None, spill_dir=None,
+                     checkpoint=None, replay=None, **kwargs):
     """Execute a notebook via nbconvert and collect output.
+
+       If km is given (a leased KernelPool kernel), the notebook is run in
+       that kernel instead of starting a new one. If profiler is given (a
+       CellProfiler), it records the time and memory used by each cell.
+       fail_fast, cell_timeout, notebook_timeout, allowable_exceptions and
+       setup_code are passed to FailFastExecutePreprocessor. Errors whose name is in
+       allowable_exceptions aren't returned. Outputs too big to keep in the
+       notebook are saved in spill_dir, see BoundedOutputExecutePreprocessor.
+       If checkpoint (a KernelCheckpoint) has this config's first cells and
+       no km is given, the notebook continues from a kernel forked from it.
+       With replay (a cw_replay directory), the notebook's scope and target
+       replay the recording there instead of using a device.
        :returns (parsed nb object, execution errors)
     """
     notebook_dir, file_name = os.path.split(nb_path)
@@ -119,86 +299,856 @@ def execute_notebook(nb_path, serial_number=None, baud=None, hw_location=None, t
     if logger is None:
         logger=test_logger
 
-    with open(real_path, encoding='utf-8') as nbfile:
-        # replace variables in first block with passed in kwargs (from .yaml file)
-        nb = nbformat.read(nbfile, as_version=4)
+    # %run blocks can be run just fine through ExecutePreprocessor;
+    # however, things like cw.scope() that we need to modify (to insert hw_location mostly)
+    # are locked in another notebook, so they're inlined when there's a device to attach.
+    # Parsing, inlining and finding the substitutions is done once per notebook,
+    # each config only fills in its parameters and device slots
+    inline = bool(serial_number or baud or hw_location or replay)
+    template = NotebookTemplate.load(real_path, inline=inline)
+
+    # replace variables in first block with passed in kwargs (from .yaml file)
+    params = template.parameter_values(logger=logger, SCOPETYPE=SCOPETYPE, PLATFORM=PLATFORM, **kwargs)
+    nb = template.render(params, serial_number=serial_number, baud=baud, hw_location=hw_location,
+                         target_hw_location=target_hw_location, replay=replay)
+    if replay:
+        setup_code = replay_setup_code() + (setup_code or '')
+
+    # the cells every config shares already ran in the checkpoint
+    forked_km = None
+    if checkpoint is not None and km is None and checkpoint.applies_to(nb):
+        forked_km = km = checkpoint.fork()
+        if km is not None:
+            checkpoint.apply(nb)
+            logger.info("Continuing from checkpoint after cell {}".format(checkpoint.num_cells))
+
+    ep = BoundedOutputExecutePreprocessor(spill_dir=spill_dir, fail_fast=fail_fast, cell_timeout=cell_timeout, notebook_timeout=notebook_timeout,
+                                          allowable_exceptions=allowable_exceptions, setup_code=setup_code, kernel_name='python3',
+                                          allow_errors=allow_errors)
+    if profiler:
+        profiler.attach(ep)
+
+    # run in the notebook's directory. The path goes to the kernel instead
+    # of using cd() so several notebooks can run at once from threads
+    nb_cwd = os.path.abspath(notebook_dir) if notebook_dir else os.getcwd()
+    try:
+        nb, resources = ep.preprocess(nb, {'metadata': {'path': nb_cwd}}, km=km)
+    finally:
+        # a pooled kernel outlives this notebook, so only drop our client
+        if km is not None and ep.kc is not None:
+            ep.kc.stop_channels()
+        if forked_km is not None:
+            forked_km.shutdown_kernel()
+
+    errors, _, _ = collect_outputs(nb, ep.allowable_exceptions)
+
+    export_kwargs = {
+        'SCOPETYPE': SCOPETYPE,
+        'PLATFORM': SNAME
+    }
+
+    return nb, errors, export_kwargs
+
+class NotebookTemplate:
+    """A notebook parsed, inlined and prepared for substitution once.
 
-        orig_parameters = extract_parameters(nb)
-        params = parameter_values(orig_parameters, SCOPETYPE=SCOPETYPE, PLATFORM=PLATFORM, **kwargs)
-        kwargs['SCOPETYPE'] = SCOPETYPE
-        kwargs['PLATFORM'] = PLATFORM
+    Running a notebook for a config means setting its parameters, attaching
+    it to a device (cw.scope(sn=...)/cw.scope(hw_location=...), cw.target(...,
+    hw_location=...), or replay=... for a cw_replay recording) and setting
+    the program_target baud. Instead of reading,
+    inlining and regex replacing the whole notebook for every config, the
+    template does that once with a placeholder in each place a config can
+    change, and render() only rebuilds the parameter cell and fills in the
+    placeholders.
+
+    Templates are cached per notebook file contents, see load().
+
+    Args:
+        nb_path (str): Path to the notebook.
+        inline (bool): Whether to inline %run notebooks, needed when devices
+            are attached since cw.scope() is usually in Setup_Generic.ipynb.
+    """
+
+    # one placeholder per config dependent substitution. \x00 can't be in a notebook
+    slot_replacements = [
+        # cw.scope() -> cw.scope(sn='<SN>') or cw.scope(hw_location=<HW_LOCATION>)
+        (re.compile(r'(cw|chipwhisperer)\.scope\(\)'), '\\1.scope(\x00scope\x00)'),
+        # cw.program_target(...) -> cw.program_target(..., baud=<BAUD>)
+        (re.compile(r'(program_target\(.*)\)'), '\\g<1>\x00baud\x00)'),
+        # cw.target(...) -> cw.target(..., hw_location=<HW_LOCATION>)
+        (re.compile(r'(cw|chipwhisperer)(\.target\()(.*,)(.*)(\))'), '\\1\\2\\3\\4\x00target\x00\\5'),
+        # %matplotlib notebook won't show up in blank plots
+        # so replace with %matplotlib inline for now
+        (re.compile('%matplotlib notebook'), '%matplotlib inline'),
+    ]
+    slot_names = ('scope', 'baud', 'target')
+
+    _templates = {}
+
+    def __init__(self, nb_path, inline=False):
+        self.nb_path = str(nb_path)
+        self.notebook_dir = os.path.dirname(self.nb_path)
+        self.inline = inline
+        self._inliner = InLineCodePreprocessor(self.notebook_dir)
+        with open(self.nb_path, encoding='utf-8') as nbfile:
+            self.nb = nbformat.read(nbfile, as_version=4)
+        self.parameters = extract_parameters(self.nb)
+
+        code_cells = [i for i, cell in enumerate(self.nb.cells) if cell['cell_type'] == 'code']
+        self.param_index = code_cells[0] if code_cells else None
+
+        # every other cell is finished here, the parameter cell is done per render
+        self.sources = [self._prepare(cell['source']) if cell['cell_type'] == 'code' and i != self.param_index else None
+                        for i, cell in enumerate(self.nb.cells)]
+
+    @classmethod
+    def load(cls, nb_path, inline=False):
+        """Get the template for nb_path, compiling it if the file changed."""
+        nb_path = str(nb_path)
+        key = (nb_path, inline, hash_path(nb_path))
+        if key not in cls._templates:
+            cls._templates[key] = cls(nb_path, inline)
+        return cls._templates[key]
+
+    def _prepare(self, source):
+        if self.inline:
+            cell, _ = self._inliner.preprocess_cell({'cell_type': 'code', 'source': source}, {}, 0)
+            source = cell['source']
+        for p, repl in self.slot_replacements:
+            source = p.sub(repl, source)
+        return source
+
+    def parameter_values(self, logger=None, **kwargs):
+        """Parameters for the first cell, with any kwargs the notebook doesn't
+        define added as new parameters."""
+        params = parameter_values(self.parameters, **kwargs)
         put_all_kwargs_in_notebook(params, logger=logger, **kwargs)
+        return params
+
+    def render(self, params, serial_number=None, baud=None, hw_location=None, target_hw_location=None, replay=None):
+        """Build a fresh notebook for one config, ready for ExecutePreprocessor."""
+        slots = {'scope': '', 'baud': '', 'target': ''}
+        if serial_number:
+            slots['scope'] = "sn='{}'".format(serial_number)
+        if hw_location:
+            slots['scope'] = 'hw_location={}'.format(hw_location)
+        if baud:
+            slots['baud'] = ', baud={}'.format(baud)
+        if target_hw_location:
+            slots['target'] = ', hw_location={}'.format(target_hw_location)
+        if replay:
+            slots['scope'] = 'replay={!r}'.format(replay)
+            slots['target'] = ', replay={!r}'.format(replay)
+
+        nb = nbformat.NotebookNode(self.nb)
+        nb.metadata = copy.deepcopy(self.nb.metadata)
+        nb.cells = []
+        for i, cell in enumerate(self.nb.cells):
+            # shallow copy, but execution writes to metadata and outputs
+            cell = nbformat.NotebookNode(cell)
+            cell.metadata = copy.deepcopy(cell.metadata)
+            if cell['cell_type'] == 'code':
+                cell.outputs = []
+                if i == self.param_index:
+                    cell.source = self._prepare(self._parameter_source(params))
+                else:
+                    cell.source = self.sources[i]
+                if '\x00' in cell.source:
+                    for name in self.slot_names:
+                        cell.source = cell.source.replace('\x00{}\x00'.format(name), slots[name])
+            nb.cells.append(cell)
+        return nb
+
+    def _parameter_source(self, params):
+        # nbparameterise only rewrites the first cell, so give it just that one
+        param_cell = self.nb.cells[self.param_index]
+        param_nb = nbformat.v4.new_notebook(metadata=self.nb.metadata, cells=[param_cell])
         try:
-            nb = replace_definitions(nb, params, execute=False)
+            return replace_definitions(param_nb, params, execute=False).cells[0]['source']
         except:
+            return param_cell['source']
+
+def cell_names(source):
+    """Names a cell's code defines and names it might use.
+
+    Magics are translated to python first. Defined names come from the AST
+    (assignments, imports, defs, for/with targets, including ones local to
+    functions). Used names are every identifier in the source, which
+    over-approximates so dependent cells are never missed.
+
+    Returns:
+        tuple: (defined names, used names) as sets.
+    """
+    try:
+        source = TransformerManager().transform_cell(source)
+    except Exception:
+        pass
+    used = set(re.findall(r'[A-Za-z_]\w*', source))
+    defined = set()
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return defined, used
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            defined.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                defined.add((alias.asname or alias.name).split('.')[0])
+    return defined, used
+
+class FailFastExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor that stops spending time on a notebook once it's broken.
+
+    With allow_errors, a normal ExecutePreprocessor keeps running every cell
+    after a failed firmware build or program_target, and the capture cells
+    often hang on the dead target. Skipped cells get a note on stderr and
+    'skipped' in their metadata instead of being run.
+
+    Args:
+        fail_fast (str): None to run every cell, 'stop' to skip everything
+            after the first error, or 'dependents' to skip only cells using
+            names defined by a failed or skipped cell.
+        cell_timeout (float): Seconds a cell can run before the kernel is
+            interrupted. None for no limit.
+        notebook_timeout (float): Seconds the whole notebook can run. Cells
+            are interrupted when it runs out and the rest are skipped.
+        allowable_exceptions (list): Exception names (e.g. 'OSError') that
+            don't count as a failure.
+        setup_code (str): Code run silently in the kernel before the first
+            cell, e.g. ProgramCache.setup_code(). It isn't added to the notebook.
+    """
+
+    def __init__(self, fail_fast=None, cell_timeout=None, notebook_timeout=None, allowable_exceptions=None, setup_code=None, **kw):
+        if fail_fast not in (None, 'stop', 'dependents'):
+            raise ValueError("Invalid fail_fast mode {}".format(fail_fast))
+        super().__init__(timeout=cell_timeout, interrupt_on_timeout=True, **kw)
+        self.fail_fast = fail_fast
+        self.cell_timeout = cell_timeout
+        self.notebook_timeout = notebook_timeout
+        self.allowable_exceptions = list(allowable_exceptions or [])
+        self.setup_code = setup_code
+
+    def preprocess(self, nb, resources=None, km=None):
+        self._setup_done = False
+        self._t_start = time.time()
+        self.failed_cell = None
+        self.out_of_time = False
+        self.poisoned_names = set()
+        return super().preprocess(nb, resources, km=km)
+
+    def _skip_reason(self, cell):
+        if self.out_of_time:
+            return "notebook ran out of time"
+        if self.failed_cell is None:
+            return None
+        if self.fail_fast == 'stop':
+            return "cell {} failed".format(self.failed_cell)
+        if self.fail_fast == 'dependents':
+            defined, used = cell_names(cell['source'])
+            depends_on = sorted(used & self.poisoned_names)
+            if depends_on:
+                return "uses {} from failed cell(s)".format(", ".join(depends_on))
+        return None
+
+    def preprocess_cell(self, cell, resources, index):
+        if cell['cell_type'] != 'code':
+            return super().preprocess_cell(cell, resources, index)
+
+        # already run in a KernelCheckpoint, with its outputs filled in
+        if cell.metadata.get('checkpointed'):
+            return cell, resources
+
+        if self.setup_code and not self._setup_done:
+            self._setup_done = True
+            reply = self.wait_for_reply(self.kc.execute(self.setup_code, silent=True, store_history=False))
+            if reply and reply['content']['status'] != 'ok':
+                self.log.warning("Harness setup code failed: {}".format(reply['content'].get('evalue')))
+
+        reason = self._skip_reason(cell)
+        if reason:
+            cell.outputs = [nbformat.v4.new_output('stream', name='stderr', text="Skipped by test harness: {}\n".format(reason))]
+            cell.metadata['skipped'] = reason
+            self.poisoned_names |= cell_names(cell['source'])[0]
+            return cell, resources
+
+        if self.notebook_timeout:
+            remaining = self.notebook_timeout - (time.time() - self._t_start)
+            self.timeout = max(1, min(remaining, self.cell_timeout or remaining))
+
+        cell, resources = super().preprocess_cell(cell, resources, index)
+
+        failed = any(output.output_type == 'error' and output.ename not in self.allowable_exceptions for output in cell.outputs)
+        if failed and self.fail_fast:
+            if self.failed_cell is None:
+                self.failed_cell = index + 1
+            self.poisoned_names |= cell_names(cell['source'])[0]
+        if self.notebook_timeout and time.time() - self._t_start >= self.notebook_timeout:
+            self.out_of_time = True
+            if not failed:
+                cell.outputs.append(nbformat.v4.new_output('error', ename='TimeoutError', evalue="Notebook time budget of {}s exceeded".format(self.notebook_timeout),
+                                                           traceback=["TimeoutError: Notebook time budget of {}s exceeded".format(self.notebook_timeout)]))
+        return cell, resources
+
+class BoundedOutputExecutePreprocessor(FailFastExecutePreprocessor):
+    """Keeps the executed notebook's size bounded however much a cell outputs.
+
+    Outputs are handled as they arrive from the kernel. A rich output (plot,
+    html, image) bigger than max_output_bytes is written to spill_dir and
+    replaced in the notebook by a note saying where it went; bokeh plots of
+    full traces can be tens of MB each. Streams keep their first
+    max_stream_bytes per cell, then get a note that the rest was dropped.
+
+    Args:
+        spill_dir (str): Directory for spilled outputs. None to keep them.
+        max_output_bytes (int): Largest rich output kept in the notebook.
+        max_stream_bytes (int): stdout/stderr kept per cell and stream.
+    """
+
+    def __init__(self, spill_dir=None, max_output_bytes=4 * 1024 * 1024, max_stream_bytes=1024 * 1024, **kw):
+        super().__init__(**kw)
+        self.spill_dir = spill_dir
+        self.max_output_bytes = max_output_bytes
+        self.max_stream_bytes = max_stream_bytes
+
+    def preprocess(self, nb, resources=None, km=None):
+        self._stream_bytes = {}
+        self._num_spilled = 0
+        return super().preprocess(nb, resources, km=km)
+
+    def output(self, outs, msg, display_id, cell_index):
+        out = super().output(outs, msg, display_id, cell_index)
+        if out is None:
+            return out
+        if out.output_type == 'stream':
+            key = (cell_index, out.name)
+            kept = self._stream_bytes.get(key, 0)
+            self._stream_bytes[key] = kept + len(out.text)
+            if kept >= self.max_stream_bytes:
+                # just appended; remove() would match an earlier equal output
+                if outs and outs[-1] is out:
+                    del outs[-1]
+                return None
+            elif kept + len(out.text) > self.max_stream_bytes:
+                out.text = out.text[:self.max_stream_bytes - kept] + "\n[further {} dropped by test harness]\n".format(out.name)
+        elif 'data' in out and self.spill_dir:
+            self._spill(out, cell_index)
+        return out
+
+    def _spill(self, out, cell_index):
+        size = sum(len(value) if isinstance(value, str) else len(json.dumps(value)) for value in out.data.values())
+        if size <= self.max_output_bytes:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._num_spilled += 1
+        saved = []
+        for mime, value in out.data.items():
+            ext = mimetypes.guess_extension(mime) or ('.json' if 'json' in mime else '.txt')
+            path = os.path.join(self.spill_dir, 'cell{}_{}_{}{}'.format(cell_index + 1, self._num_spilled, len(saved), ext))
+            if mime.startswith('image/') and mime != 'image/svg+xml':
+                with open(path, 'wb') as f:
+                    f.write(base64.b64decode(value))
+            else:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(value if isinstance(value, str) else json.dumps(value))
+            saved.append(path)
+        out.data = nbformat.NotebookNode({'text/plain': "[{:.1f} MB output saved to {} by test harness]".format(
+            size / 1e6, ", ".join(os.path.basename(path) for path in saved))})
+        out.metadata = nbformat.NotebookNode({'spilled': saved})
+
+KERNEL_FORK_SCRIPT = os.path.join(tests_dir, 'kernel_fork.py')
+
+def replay_setup_code(record_dir=None):
+    """Kernel code installing cw_replay, so cw.scope(replay=...) and
+    cw.target(..., replay=...) use a replay directory instead of a device.
+    With record_dir, what the notebook does with the real devices is
+    recorded there instead, see cw_replay.Recorder."""
+    code = "import sys as _sys\nif {0!r} not in _sys.path:\n    _sys.path.insert(0, {0!r})\n" \
+           "import cw_replay as _cw_replay, chipwhisperer as _cw\n".format(tests_dir)
+    if record_dir:
+        code += "_cw_replay.record(_cw, {!r})\n".format(os.path.abspath(record_dir))
+    else:
+        code += "_cw_replay.install(_cw)\n"
+    return code + "del _sys, _cw_replay, _cw\n"
+
+class ForkedKernelManager(KernelManager):
+    """KernelManager for a kernel forked by a KernelCheckpoint.
+
+    The kernel is already running, so it's never started, and it's a child
+    of the checkpoint process, so it's checked, interrupted and killed by
+    pid.
+    """
+
+    def __init__(self, pid, connection_file, **kw):
+        super().__init__(**kw)
+        self.pid = pid
+        self.load_connection_file(connection_file)
+
+    @property
+    def has_kernel(self):
+        return True
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def interrupt_kernel(self):
+        os.kill(self.pid, signal.SIGINT)
+
+    def shutdown_kernel(self, now=False, restart=False):
+        if not now and self.is_alive():
+            kc = self.client()
+            kc.start_channels()
+            try:
+                kc.shutdown()
+                t_end = time.time() + 5
+                while self.is_alive() and time.time() < t_end:
+                    time.sleep(0.1)
+            finally:
+                kc.stop_channels()
+        if self.is_alive():
+            os.kill(self.pid, signal.SIGKILL)
+        try:
+            os.remove(self.connection_file)
+        except OSError:
             pass
 
-        ep = ExecutePreprocessor(timeout=None, kernel_name='python3', allow_errors=allow_errors)
+class KernelCheckpoint:
+    """Runs the first cells a notebook's configurations share once and forks
+    a kernel for each configuration from there.
 
-        # %run blocks can be run just fine through ExecutePreprocessor;
-        # however, things like cw.scope() that we need to modify (to insert hw_location mostly)
-        # are locked in another notebook
+    Sweeps of SIMULATED notebooks over SS_VER, CRYPTO_TARGET or VERSION
+    repeat the same imports and trace loading for every configuration. The
+    shared cells are the ones up to the first that differs between the
+    configurations, reads a parameter that has a different value in one of
+    them, uses magics or could touch a device or a plot. The parameter cell
+    itself is run again in every fork, so the forks have their own values.
 
-        # so we have to traverse the %run blocks and inline all the code
-        if serial_number or baud or hw_location:
-            ip = InLineCodePreprocessor(notebook_dir)
-            # inline all code before doing any replacements
-            nb, resources = ip.preprocess(nb, {})
+    The cells run in a kernel_fork.py process the first time fork() is
+    called. Each fork() then forks that process into a new kernel with the
+    cells' namespace, and apply() fills the shared cells' outputs into the
+    configuration's notebook. If the shared cells fail, fork() returns None
+    and the notebooks run from the start as usual.
 
-        replacements = {}
+    Args:
+        nbs (list): The notebook rendered for each configuration, see
+            NotebookTemplate.render().
+        param_index (int): Index of the parameter cell.
+        notebook_dir (str): Directory the cells run in.
+        timeout (float): Seconds the shared cells can take.
+    """
 
-        # do regex replacements for attaching specific devies
-        # cw.scope() -> cw.scope(sn='<SN>')
-        if serial_number:
-            replacements.update({
-                r'(cw|chipwhisperer)\.scope\(\)': r'\1.scope(sn=\'{}\')'.format(serial_number),
-            })
+    # things that need the kernel's display machinery or a device
+    unsafe_regex = re.compile(r'(cw|chipwhisperer)\.(scope|target|plot)|program_target|matplotlib|bokeh|holoviews|ipywidgets|tqdm')
 
-        # cw.program_target(...) -> cw.program_target(..., baud=<BAUD>)
-        if baud:
-            replacements.update({
-                r'(program_target\(.*)\)': r'\g<1>, baud={})'.format(baud)
-            })
+    def __init__(self, nbs, param_index, notebook_dir, timeout=600, logger=None):
+        if logger is None:
+            logger = test_logger
+        self.logger = logger
+        self.nb = nbs[0]
+        self.param_index = param_index
+        self.notebook_dir = notebook_dir
+        self.timeout = timeout
+        self.num_cells = self.shared_cells(nbs, param_index)
+        self.seconds = None
+        self._outputs = None
+        self._counts = None
+        self._failed = False
+        self._proc = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_configurations(cls, nb_path, configurations, logger=None):
+        """Checkpoint for running nb_path with each of configurations (kwargs
+        for execute_notebook()), or None if they share no cells."""
+        template = NotebookTemplate.load(os.path.abspath(nb_path))
+        if template.param_index is None:
+            return None
+        nbs = []
+        for kwargs in configurations:
+            kwargs = {k: v for k, v in kwargs.items() if k != 'SNAME'}
+            nbs.append(template.render(template.parameter_values(**kwargs)))
+        checkpoint = cls(nbs, template.param_index, template.notebook_dir, logger=logger)
+        if not checkpoint.num_cells:
+            return None
+        return checkpoint
+
+    @staticmethod
+    def _assignments(source):
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            return None
+        return {target.id: ast.dump(node.value) for node in tree.body if isinstance(node, ast.Assign)
+                for target in node.targets if isinstance(target, ast.Name)}
+
+    @classmethod
+    def shared_cells(cls, nbs, param_index):
+        """Number of leading cells of nbs that can run once for all of them,
+        0 if that's only the parameter cell."""
+        if param_index is None:
+            return 0
+        params = [cls._assignments(nb.cells[param_index]['source']) for nb in nbs]
+        if None in params:
+            return 0
+        varying = {name for p in params for name in p if any(q.get(name) != p[name] for q in params)}
+        count = 0
+        for i, cell in enumerate(nbs[0].cells):
+            if cell['cell_type'] != 'code' or i == param_index:
+                continue
+            if any(len(nb.cells) <= i or nb.cells[i]['source'] != cell['source'] for nb in nbs):
+                break
+            if cls.unsafe_regex.search(cell['source']) or 'get_ipython' in TransformerManager().transform_cell(cell['source']):
+                break
+            if cell_names(cell['source'])[1] & varying:
+                break
+            count = i + 1
+        return count
+
+    def applies_to(self, nb):
+        return self.num_cells > 0 and self.shared_cells([self.nb, nb], self.param_index) >= self.num_cells
+
+    def _request(self, request, timeout):
+        self._proc.stdin.write(json.dumps(request) + '\n')
+        self._proc.stdin.flush()
+        reply = queue.Queue()
+        reader = threading.Thread(target=lambda: reply.put(self._proc.stdout.readline()), daemon=True)
+        reader.start()
+        try:
+            line = reply.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No reply from checkpoint in {}s".format(timeout))
+        if not line:
+            raise RuntimeError("Checkpoint process exited")
+        return json.loads(line)
+
+    def _start(self):
+        code_cells = [i for i in range(self.num_cells) if self.nb.cells[i]['cell_type'] == 'code']
+        t_a = time.time()
+        self._proc = subprocess.Popen([sys.executable, KERNEL_FORK_SCRIPT], cwd=self.notebook_dir, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, universal_newlines=True)
+        reply = self._request({'cells': [self.nb.cells[i]['source'] for i in code_cells]}, self.timeout)
+        if reply['status'] != 'ok':
+            raise RuntimeError("Shared cells failed: {}".format(reply.get('error')))
+        self._outputs = dict(zip(code_cells, reply['outputs']))
+        self._counts = dict(zip(code_cells, reply['execution counts']))
+        self.seconds = time.time() - t_a
+        self.logger.info("Checkpointed {} cells in {:.1f}s".format(len(code_cells), self.seconds))
+
+    def fork(self):
+        """A ForkedKernelManager for a kernel continuing from the shared
+        cells, or None if they couldn't be run."""
+        from jupyter_client.connect import write_connection_file
+        with self._lock:
+            if self._failed:
+                return None
+            try:
+                if self._proc is None:
+                    self._start()
+                connection_file, _ = write_connection_file()
+                pid = self._request({'fork': connection_file}, 60)['pid']
+            except Exception as e:
+                self.logger.warning("Kernel checkpoint unusable, running notebooks from the start: {}".format(e))
+                self._failed = True
+                self.close()
+                return None
+        return ForkedKernelManager(pid, connection_file)
+
+    def apply(self, nb):
+        """Fill in the shared cells of nb, as if they ran in its kernel."""
+        for i in range(self.num_cells):
+            cell = nb.cells[i]
+            if cell['cell_type'] != 'code' or i == self.param_index:
+                continue
+            cell.outputs = [nbformat.from_dict(output) for output in self._outputs[i]]
+            cell.execution_count = self._counts[i]
+            cell.metadata['checkpointed'] = True
+
+    def close(self):
+        """Stop the checkpoint process. Kernels forked from it keep running."""
+        if self._proc is not None and self._proc.poll() is None:
+            try:
+                self._proc.stdin.write(json.dumps({'exit': True}) + '\n')
+                self._proc.stdin.close()
+                self._proc.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self._proc.kill()
+
+class ProgramCache:
+    """Skips cw.program_target when a device already has the firmware.
+
+    Notebooks that run one after another on a device usually flash the same
+    hex. The notebook's kernel gets a wrapper around cw.program_target (see
+    setup_code()) that keeps a record per device of the firmware hash,
+    programmer and arguments it last programmed successfully, and only resets
+    the target when they match.
+
+    The programmers have no read back without programming again, so the
+    record is trusted carefully instead: it's removed before programming (a
+    failed or interrupted program leaves no record), after any notebook that
+    fails, and after notebooks that may write flash some other way (e.g.
+    through a bootloader). Anything that doesn't match, a programmer without
+    an external reset (NEORV32) or a notebook without reset_target()
+    reprograms the target as usual.
 
-        # cw.scope() -> cw.scope(hw_location=<HW_LOCATION>)
-        if hw_location:
-            replacements.update({
-                r'(cw|chipwhisperer)\.scope\(\)': r'\1.scope(hw_location={})'.format(hw_location),
-            })
+    Args:
+        cache_dir (str): Directory for the records, one file per device so
+            processes for different hardware don't share a file.
+    """
 
-        # cw.target(...) -> cw.target(..., hw_location=<HW_LOCATION>)
-        if target_hw_location:
-            replacements.update({
-                r'(cw|chipwhisperer)(\.target\()(.*,)(.*)(\))': r"\1\2\3\4, hw_location={}\5".format(target_hw_location)
-            })
+    # notebooks that may change the flash without cw.program_target
+    flash_writer_regex = re.compile(r'bootloader', re.IGNORECASE)
+
+    _wrapper_code = (
+        "def _cw_harness_wrap(original, record_path):\n"
+        "    import functools\n"
+        "    @functools.wraps(original)\n"
+        "    def program_target(scope, prog_type, fw_path, **kwargs):\n"
+        "        import hashlib, json, os\n"
+        "        reset_target = get_ipython().user_ns.get('reset_target')\n"
+        "        name = getattr(prog_type, '__name__', str(prog_type))\n"
+        "        record, matches = None, False\n"
+        "        try:\n"
+        "            with open(fw_path, 'rb') as f:\n"
+        "                record = {'firmware': hashlib.sha256(f.read()).hexdigest(), 'programmer': name,\n"
+        "                          'kwargs': repr(sorted(kwargs.items()))}\n"
+        "            with open(record_path) as f:\n"
+        "                matches = json.load(f) == record\n"
+        "        except (OSError, ValueError):\n"
+        "            pass\n"
+        "        if matches and callable(reset_target) and name != 'NEORV32Programmer':\n"
+        "            print('Target already has {}, resetting instead of programming'.format(fw_path))\n"
+        "            reset_target(scope)\n"
+        "            return\n"
+        "        try:\n"
+        "            os.remove(record_path)\n"
+        "        except OSError:\n"
+        "            pass\n"
+        "        original(scope, prog_type, fw_path, **kwargs)\n"
+        "        if record and prog_type is not None:\n"
+        "            with open(record_path + '.tmp', 'w') as f:\n"
+        "                json.dump(record, f)\n"
+        "            os.replace(record_path + '.tmp', record_path)\n"
+        "    program_target.original = original\n"
+        "    return program_target\n"
+        "import chipwhisperer as _cw_harness\n"
+        "_cw_harness.program_target = _cw_harness_wrap(getattr(_cw_harness.program_target, 'original', _cw_harness.program_target),\n"
+        "                                              RECORD_PATH)\n"
+        "del _cw_harness, _cw_harness_wrap\n"
+    )
+
+    def __init__(self, cache_dir, logger=None):
+        if logger is None:
+            logger = test_logger
+        self.logger = logger
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def record_path(self, device):
+        name = hashlib.sha256(repr(device).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def setup_code(self, device):
+        """Kernel code that wraps cw.program_target for device (its serial
+        number or hw_location)."""
+        return self._wrapper_code.replace('RECORD_PATH', repr(self.record_path(device)))
+
+    def invalidate(self, device):
+        try:
+            os.remove(self.record_path(device))
+            self.logger.info("Forgot firmware programmed on {}".format(device))
+        except FileNotFoundError:
+            pass
 
-        # %matplotlib notebook won't show up in blank plots
-        # so replace with %matplotlib inline for now
-        replacements.update({'%matplotlib notebook' : '%matplotlib inline'})
+    def notebook_finished(self, device, nb, passed):
+        """Drop device's record if the notebook failed or may have written flash itself."""
+        if not passed or any(cell['cell_type'] == 'code' and self.flash_writer_regex.search(cell['source']) for cell in nb.cells):
+            self.invalidate(device)
 
-        # complete all regex subtitutions
-        if replacements:
-            rp = RegexReplacePreprocessor(replacements)
-            nb, resources = rp.preprocess(nb, {})
+    def clear(self):
+        """Forget every device, e.g. at the start of a run since anything
+        could have been programmed in between."""
+        for path in glob(os.path.join(self.cache_dir, '*.json')):
+            os.remove(path)
 
-        # grab notebook resources
-        if notebook_dir:
-            with cd(notebook_dir):
-                nb, resources = ep.preprocess(nb, {'metadata': {'path': './'}})
-        else:
-            nb, resources = ep.preprocess(nb, {'metadata': {'path': './'}})
+def enumerated_devices():
+    """{serial number: hw_location} of the ChipWhisperer devices on USB, from
+    enumeration alone (no device is connected to). None if listing fails."""
+    try:
+        return {str(dev['sn']): tuple(dev['hw_loc']) for dev in cw.list_devices() if dev.get('sn') and dev.get('hw_loc')}
+    except Exception as e:
+        test_logger.info("Listing USB devices failed: {}".format(e))
+        return None
+
+def wait_for_device(connect, sn, timeout=60, interval=0.25, logger=None):
+    """Poll until the device with serial number sn is back on USB and
+    connect() succeeds, e.g. after a firmware upgrade or MPSSE switch makes it
+    re-enumerate. Returns connect()'s result, raising its last error after
+    timeout seconds."""
+    if logger is None:
+        logger = test_logger
+    deadline = time.time() + timeout
+    while True:
+        devices = enumerated_devices()
+        if devices is None or str(sn) in devices:
+            try:
+                return connect()
+            except Exception as e:
+                if time.time() > deadline:
+                    raise
+                logger.debug("Device {} not ready yet: {}".format(sn, e))
+        elif time.time() > deadline:
+            raise OSError("Device {} didn't come back within {}s".format(sn, timeout))
+        time.sleep(interval)
+
+class DeviceCache:
+    """What setup found out about each device last time, by serial number.
+
+    Connecting to a device to read its hw_location and firmware version takes
+    a few seconds, and longer if it has to be upgraded or switched to MPSSE.
+    A device whose record matches is used without connecting: it must still
+    be enumerated at the same hw_location (so it hasn't been unplugged or
+    re-enumerated since), with the same chipwhisperer version (so the latest
+    firmware hasn't changed) and the same MPSSE setting.
+
+    Args:
+        path (str): JSON file holding the records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def lookup(self, sn, devices, MPSSE=False):
+        """The cached hw_location of sn if it can be used as is, else None.
+        devices is enumerated_devices()."""
+        record = self.records.get(str(sn))
+        if not record or not devices or str(sn) not in devices:
+            return None
+        if tuple(record['hw_location']) != devices[str(sn)] or record['cw version'] != str(cw.__version__) \
+                or record['MPSSE'] != bool(MPSSE):
+            return None
+        return devices[str(sn)]
+
+    def store(self, sn, hw_location, fw_version, MPSSE=False):
+        with self._lock:
+            self.records[str(sn)] = {'hw_location': list(hw_location), 'fw version': fw_version,
+                                     'cw version': str(cw.__version__), 'MPSSE': bool(MPSSE)}
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.records, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+class CellProfiler:
+    """Records wall time and peak kernel RSS for every executed cell.
+
+    Attached to an ExecutePreprocessor through its cell execution hooks. Peak
+    RSS is read from /proc/<kernel pid>/status (VmHWM), which is reset before
+    each cell, so it's only available on Linux and doesn't include processes
+    the cell starts (e.g. make in %%bash cells).
+
+    Attributes:
+        cells (list): One dict per executed cell with its 1 based 'cell'
+            index, 'seconds', 'peak rss MB' (None if unavailable) and the
+            first line of its 'source'.
+    """
+
+    def __init__(self):
+        self.cells = []
+        self.ep = None
+        self._t_start = None
 
-        errors = [[i + 1, output] for i, cell in enumerate(nb.cells) if "outputs" in cell
-                  for output in cell["outputs"] \
-                  if output.output_type == "error"]
+    def attach(self, ep):
+        self.ep = ep
+        ep.on_cell_execute = self._cell_started
+        ep.on_cell_executed = self._cell_finished
 
-        export_kwargs = {
-            'SCOPETYPE': SCOPETYPE,
-            'PLATFORM': SNAME
-        }
+    def _kernel_pid(self):
+        km = self.ep.km
+        provisioner = getattr(km, 'provisioner', None)
+        process = getattr(provisioner, 'process', None) or getattr(km, 'kernel', None)
+        # a ForkedKernelManager has neither, only the forked kernel's pid
+        return getattr(process, 'pid', None) or getattr(km, 'pid', None)
 
-        return nb, errors, export_kwargs
+    def _reset_peak_rss(self, pid):
+        try:
+            with open('/proc/{}/clear_refs'.format(pid), 'w') as f:
+                f.write('5')
+        except (OSError, TypeError):
+            pass
 
+    def _peak_rss(self, pid):
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except (OSError, TypeError):
+            pass
+        return None
+
+    def _cell_started(self, cell, cell_index, **kwargs):
+        self._reset_peak_rss(self._kernel_pid())
+        self._t_start = time.time()
+
+    def _cell_finished(self, cell, cell_index, **kwargs):
+        seconds = time.time() - self._t_start
+        first_line = next((line for line in cell['source'].splitlines() if line.strip()), '')
+        self.cells.append({
+            'cell': cell_index + 1,
+            'seconds': round(seconds, 2),
+            'peak rss MB': self._peak_rss(self._kernel_pid()),
+            'source': first_line.strip()[:80],
+        })
+
+    def slowest(self, num=5):
+        return sorted(self.cells, key=lambda c: c['seconds'], reverse=True)[:num]
+
+    def report(self, logger=None, num=5):
+        """Log the slowest cells."""
+        if logger is None:
+            logger = test_logger
+        for c in self.cells:
+            logger.debug("Cell {} ran in {:.1f}s".format(c['cell'], c['seconds']),
+                         extra={'event': 'cell', 'cell': c['cell'], 'seconds': c['seconds']})
+        logger.info("Slowest cells:")
+        for c in self.slowest(num):
+            logger.info("  [{}] {:.1f}s {} MB: {}".format(c['cell'], c['seconds'], c['peak rss MB'], c['source']))
+
+def find_regressions(result, previous, min_ratio=1.5, min_seconds=5):
+    """Compare a notebook result with the previous run's result for it.
+
+    The notebook run time and each cell's time (matched on index and first
+    line of source) count as a regression if they grew by more than min_ratio
+    and by at least min_seconds. Cached results aren't compared.
+
+    Returns:
+        list: Descriptions of each regression.
+    """
+    regressions = []
+    if not previous or result.get('cached') or 'run seconds' not in previous:
+        return regressions
+
+    def slower(now, before):
+        return now > before * min_ratio and now - before >= min_seconds
+
+    if slower(result['run seconds'], previous['run seconds']):
+        regressions.append("notebook took {:.1f}s, was {:.1f}s".format(result['run seconds'], previous['run seconds']))
+    previous_cells = {(c['cell'], c['source']): c for c in previous.get('cells', [])}
+    for c in result.get('cells', []):
+        before = previous_cells.get((c['cell'], c['source']))
+        if before and slower(c['seconds'], before['seconds']):
+            regressions.append("cell {} ({}) took {:.1f}s, was {:.1f}s".format(c['cell'], c['source'], c['seconds'], before['seconds']))
+    return regressions
 
 # Takes a notebook node and exports it to ReST and HTML and copies the notebook over
 def export_notebook(nb, nb_path, output_dir, SCOPETYPE=None, PLATFORM=None, logger=None):
@@ -292,16 +1242,94 @@ def export_notebook(nb, nb_path, output_dir, SCOPETYPE=None, PLATFORM=None, logg
         body, resources = exporter.from_notebook_node(nb)
         ipynb_file.write(body)
 
-    test_logger.info("Copying over images")
-    for image_path in glob(os.path.join(notebook_dir, "img", "*")):
+    copy_notebook_images(notebook_dir, output_dir, PLATFORM)
+    return ipynb_path
+
+def copy_notebook_images(notebook_dir, output_dir, PLATFORM):
+    """Link notebook_dir/img/* next to the exported notebooks for PLATFORM."""
+    link_images(os.path.join(notebook_dir, "img"), os.path.join(output_dir, PLATFORM, "img"), os.path.join(output_dir, ".images"))
+
+def link_images(image_dir, dest_dir, store_dir, logger=None):
+    """Put every image in image_dir into dest_dir as a hard link into store_dir.
+
+    store_dir holds one file per distinct image, named by its content hash, so
+    images shared by many notebooks and platforms are stored once, and ones
+    already linked into dest_dir aren't touched again. Where hard links
+    aren't supported the image is copied instead.
+    """
+    if logger is None:
+        logger = test_logger
+    os.makedirs(dest_dir, exist_ok=True)
+    os.makedirs(store_dir, exist_ok=True)
+    # several exports can link the same image at once
+    tmp_ext = '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+    linked = 0
+    for image_path in glob(os.path.join(image_dir, "*")):
+        if not os.path.isfile(image_path):
+            continue
         _, image_name = os.path.split(image_path)
-        outpath = os.path.join(output_dir, PLATFORM, "img", image_name)
-        test_logger.info("Copying {} to {}".format(image_path, outpath))
-        shutil.copyfile(image_path, outpath)
-    test_logger.info("Done")
+        stored_path = os.path.join(store_dir, hash_path(image_path) + os.path.splitext(image_name)[1])
+        if not os.path.isfile(stored_path):
+            shutil.copyfile(image_path, stored_path + tmp_ext)
+            os.replace(stored_path + tmp_ext, stored_path)
+
+        outpath = os.path.join(dest_dir, image_name)
+        if os.path.isfile(outpath) and os.path.samefile(outpath, stored_path):
+            continue
+        try:
+            os.link(stored_path, outpath + tmp_ext)
+        except OSError:
+            shutil.copyfile(stored_path, outpath + tmp_ext)
+        os.replace(outpath + tmp_ext, outpath)
+        linked += 1
+    logger.info("Linked {} images into {}".format(linked, dest_dir))
+
+class ExportPool:
+    """Exports notebooks in the background.
+
+    Exporting (serializing the notebook and linking its images) doesn't need
+    the device, so a hardware worker hands it to the pool and moves on to its
+    next notebook. At most max_pending exports wait at once; submit() blocks
+    when the queue is full so a slow disk can't pile up executed notebooks in
+    memory.
+
+    Args:
+        workers (int): Threads doing exports.
+        max_pending (int): Exports that can wait for a thread.
+    """
+
+    def __init__(self, workers=1, max_pending=4, logger=None):
+        from concurrent.futures import ThreadPoolExecutor
+        if logger is None:
+            logger = test_logger
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                self.logger.error("Export failed: {}".format(e))
+                raise
+            finally:
+                self._slots.release()
+        future = self._executor.submit(run)
+        self._futures.append(future)
+        return future
+
+    def join(self):
+        """Wait for every export to finish."""
+        self._executor.shutdown(wait=True)
 
 def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_errors=True, print_first_traceback_only=True, print_stdout=False, print_stderr=False,
-                  allowable_exceptions=None, baud=None, hw_location=None, logger=None, **kwargs):
+                  allowable_exceptions=None, baud=None, hw_location=None, logger=None, kernel_pool=None, result_cache=None, previous_result=None,
+                  fail_fast=None, cell_timeout=None, notebook_timeout=None, program_cache=None, export_pool=None, checkpoint=None,
+                  replay_dir=None, record_dir=None, **kwargs):
     # reset output for next test
 
     # TODO: clean this up
@@ -318,15 +1346,64 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
     else:
         logger.info('No serial number specified... only bad if more than one device attached.')
 
+    # reuse the last passing result if nothing the notebook depends on changed
+    if result_cache:
+        cache_key = result_cache.key(nb_path, kwargs, {
+            'allow_errors': allow_errors, 'allowable_exceptions': allowable_exceptions, 'fail_fast': fail_fast,
+            'cell_timeout': cell_timeout, 'notebook_timeout': notebook_timeout})
+        cached = result_cache.load(cache_key, nb_path, output_dir, kwargs.get('SNAME', 'CWLITEARM'))
+        if cached:
+            logger.info("PASSED (cached result {})".format(cache_key))
+            logger.info("\n")
+            return True, '', cached
+
+    # outputs too big to keep in memory go next to the exported notebook
+    lab_name, ext = os.path.splitext(os.path.basename(nb_path))
+    spill_dir = os.path.join(output_dir, kwargs.get('SNAME', 'CWLITEARM'), 'outputs', lab_name)
+
+    # skip reprogramming the device's target when it already has the firmware
+    device = serial_number or hw_location
+    setup_code = None
+    if program_cache and device:
+        setup_code = program_cache.setup_code(device)
+
+    # replay the device from, or record it into, <dir>/<SNAME>/<lab name>
+    replay = None
+    if replay_dir:
+        replay = os.path.join(os.path.abspath(replay_dir), kwargs.get('SNAME', 'CWLITEARM'), lab_name)
+    elif record_dir:
+        setup_code = replay_setup_code(os.path.join(record_dir, kwargs.get('SNAME', 'CWLITEARM'), lab_name)) + (setup_code or '')
+
     # run notebook and record runtime
+    profiler = CellProfiler()
     t_a = datetime.now()
-    nb, errors, export_kwargs = execute_notebook(nb_path, serial_number, hw_location=hw_location, allow_errors=allow_errors, allowable_exceptions=allowable_exceptions, baud=baud, logger=logger, **kwargs)
+    # a checkpoint is used instead of the pool, its kernels start further along.
+    # a recording is saved when its kernel exits, so it can't be pooled.
+    # Setup code and replays patch chipwhisperer, so those kernels aren't reused
+    if kernel_pool and checkpoint is None and not record_dir:
+        with kernel_pool.lease(os.path.dirname(os.path.abspath(nb_path)), reusable=not (setup_code or replay)) as km:
+            nb, errors, export_kwargs = execute_notebook(nb_path, serial_number, hw_location=hw_location, allow_errors=allow_errors, allowable_exceptions=allowable_exceptions, baud=baud, logger=logger, km=km, profiler=profiler,
+                                                             fail_fast=fail_fast, cell_timeout=cell_timeout, notebook_timeout=notebook_timeout,
+                                                             setup_code=setup_code, spill_dir=spill_dir, replay=replay, **kwargs)
+        time_saved = kernel_pool.last_time_saved
+        logger.info("Kernel pool saved {:.1f}s of kernel startup".format(time_saved))
+    else:
+        nb, errors, export_kwargs = execute_notebook(nb_path, serial_number, hw_location=hw_location, allow_errors=allow_errors, allowable_exceptions=allowable_exceptions, baud=baud, logger=logger, profiler=profiler,
+                                                     fail_fast=fail_fast, cell_timeout=cell_timeout, notebook_timeout=notebook_timeout,
+                                                     setup_code=setup_code, spill_dir=spill_dir, checkpoint=checkpoint, replay=replay,
+                                                     **kwargs)
+        time_saved = None
+        if any(cell.metadata.get('checkpointed') for cell in nb.cells):
+            time_saved = checkpoint.seconds
+            logger.info("Kernel checkpoint saved {:.1f}s of shared cells".format(time_saved))
     dt = datetime.now() - t_a
+    profiler.report(logger)
+    if program_cache and device:
+        program_cache.notebook_finished(device, nb, not errors)
 
     if not errors:
         logger.info("PASSED")
         passed = True
-        export_notebook(nb, nb_path, output_dir, **export_kwargs, logger=logger)
     else:
         logger.warning("FAILED:")
         passed = False
@@ -335,7 +1412,6 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
             _print_tracebacks([error for i, error in enumerate(errors) if i == 0],logger=logger)
         else:
             _print_tracebacks(errors,logger=logger)
-        export_notebook(nb, nb_path, output_dir, **export_kwargs, logger=logger)
 
     if print_stdout:
         _print_stdout(nb, logger)
@@ -351,8 +1427,34 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
     result = {
         'passed': passed,
         'errors': errors,
-        'run time': '{}:{:02d}'.format(dt.seconds//60, dt.seconds % 60)
+        'run time': '{}:{:02d}'.format(dt.seconds//60, dt.seconds % 60),
+        'run seconds': round(dt.total_seconds(), 1),
+        'cells': profiler.cells,
     }
+    skipped = [i + 1 for i, cell in enumerate(nb.cells) if cell.metadata.get('skipped')]
+    if skipped:
+        logger.info("Skipped cells {}".format(skipped))
+        result['skipped cells'] = skipped
+    regressions = find_regressions(result, previous_result)
+    if regressions:
+        result['regressions'] = regressions
+        for regression in regressions:
+            logger.log(60, "Slower than last run: {}".format(regression))
+    if time_saved is not None:
+        result['kernel time saved'] = round(time_saved, 1)
+    if result_cache:
+        result['cached'] = False
+
+    def export():
+        ipynb_path = export_notebook(nb, nb_path, output_dir, **export_kwargs, logger=logger)
+        if result_cache and passed:
+            result_cache.store(cache_key, result, ipynb_path)
+
+    # exporting doesn't need the device, so let the caller's pool do it
+    if export_pool:
+        export_pool.submit(export)
+    else:
+        export()
 
     return passed, '\n'.join(output), result
 
@@ -477,6 +1579,209 @@ class RegexReplacePreprocessor(nbconvert.preprocessors.Preprocessor):
                 cell['source'] = re.sub(p, repl, cell['source'])
         return cell, resources
 
+RUN_MAGIC_REGEXES = [
+    re.compile(r"(%run\s*[\"']?(.*\.ipynb)[\"']?)"),
+    re.compile(r"(get_ipython\(\)\.run_line_magic\('run'\, \'\"(.*\.ipynb)\"\'\))"),
+]
+
+# data files loaded by notebooks, e.g. data/ecc_cycles.npy or firmware.pickle.
+# format placeholders like simpleserial-aes-{}.hex are globbed
+DATA_FILE_REGEX = re.compile(r"""["']([^"'\n]+\.(?:npy|npz|pickle|pkl|hex|bin|bit|mat|h5|zip|cwp))["']""")
+BASH_CD_REGEX = re.compile(r"^\s*cd\s+[\"']?([^\"'\n;&|]+?)[\"']?\s*$", re.MULTILINE)
+FIRMWARE_SOURCE_EXTS = ('.c', '.h', '.s', '.S', '.mk', '.ld', '.inc')
+
+def _is_firmware_dir(path):
+    return os.path.isfile(os.path.join(path, 'makefile')) or os.path.isfile(os.path.join(path, 'Makefile'))
+
+_file_hashes = {}
+
+def hash_path(path):
+    """sha256 of a file, or of the source files in a firmware directory.
+
+    File hashes are memoized on (path, size, mtime) so firmware directories
+    shared by many notebooks are only read once.
+    """
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not (d.startswith('objdir') or d.startswith('.')))
+            for name in sorted(files):
+                if name.endswith(FIRMWARE_SOURCE_EXTS) or name.lower() == 'makefile':
+                    file_path = os.path.join(root, name)
+                    h.update(os.path.relpath(file_path, path).encode())
+                    h.update(hash_path(file_path).encode())
+        return h.hexdigest()
+
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+# %run include graph and references for each notebook, keyed on
+# (path, notebook_dir, file hash) so each file is only parsed once per run
+_notebook_scans = {}
+
+def _scan_notebook(path, notebook_dir):
+    """Parse one notebook for the %run notebooks, data files and firmware
+    directories it references. Paths are resolved from notebook_dir."""
+    memo_key = (path, notebook_dir, hash_path(path))
+    if memo_key in _notebook_scans:
+        return _notebook_scans[memo_key]
+
+    runs, data, firmware_dirs = [], set(), set()
+    for cell in nbformat.read(path, as_version=4).cells:
+        if cell['cell_type'] != 'code':
+            continue
+        source = cell['source']
+        for p in RUN_MAGIC_REGEXES:
+            for match in p.finditer(source):
+                ext_nb_path = os.path.normpath(os.path.join(notebook_dir, match.group(2)))
+                if os.path.isfile(ext_nb_path) and ext_nb_path not in runs:
+                    runs.append(ext_nb_path)
+        for match in DATA_FILE_REGEX.finditer(source):
+            pattern = re.sub(r'\{[^}]*\}|%s', '*', match.group(1))
+            data.update(os.path.normpath(f) for f in glob(os.path.join(notebook_dir, pattern)) if os.path.isfile(f))
+        if source.startswith('%%bash'):
+            for match in BASH_CD_REGEX.finditer(source):
+                fw_dir = os.path.normpath(os.path.join(notebook_dir, match.group(1)))
+                if _is_firmware_dir(fw_dir):
+                    firmware_dirs.add(fw_dir)
+
+    scan = {'runs': runs, 'data': data, 'firmware': firmware_dirs}
+    _notebook_scans[memo_key] = scan
+    return scan
+
+def notebook_dependencies(nb_path):
+    """Find the files a notebook depends on besides itself.
+
+    Follows %run notebooks transitively (resolved from the top level notebook's
+    directory, like the kernel does) and collects data/hex files referenced as
+    string literals and firmware directories that %%bash cells cd into to run make.
+    Hex files inside one of those firmware directories are covered by the directory.
+
+    Returns:
+        list: Sorted absolute paths of files and firmware directories.
+    """
+    notebook_dir = os.path.dirname(os.path.abspath(nb_path))
+    deps = set()
+    firmware_dirs = set()
+    to_scan = [os.path.abspath(nb_path)]
+    scanned = set()
+    while to_scan:
+        path = to_scan.pop()
+        if path in scanned:
+            continue
+        scanned.add(path)
+        scan = _scan_notebook(path, notebook_dir)
+        deps.update(scan['runs'])
+        deps.update(scan['data'])
+        firmware_dirs.update(scan['firmware'])
+        to_scan.extend(scan['runs'])
+
+    deps = {d for d in deps if not any(d.startswith(fw_dir + os.sep) for fw_dir in firmware_dirs)}
+    return sorted(deps | firmware_dirs)
+
+# changes under these paths (relative to the chipwhisperer repository) can
+# affect every notebook: the chipwhisperer package, installs and the test harness
+FULL_RUN_PATHS = ('software/', 'setup.py', 'setup.cfg', 'pyproject.toml', 'requirements.txt',
+                  'jupyter/tests/', 'jupyter/requirements.txt')
+
+def affected_jobs(cw_dir, config, changed_paths):
+    """Find the jobs that changed files can affect, to only test those.
+
+    A notebook is affected by a change to itself or anything returned by
+    notebook_dependencies() (%run notebooks, firmware directories, data and
+    hex files), to firmware sources outside its firmware directory if it
+    builds firmware (hal, crypto and simpleserial are shared by every
+    project), or to python modules next to it.
+
+    Args:
+        cw_dir (str): The chipwhisperer repository, with jupyter as a submodule.
+        config (str): Path to the tests yaml file.
+        changed_paths (list): Changed files, absolute or relative to cw_dir.
+
+    Returns:
+        dict: A shard (see plan_shards()) with every configuration and
+        hardware of the affected notebooks, or None if a change can affect
+        every notebook.
+    """
+    cw_dir = os.path.abspath(cw_dir)
+    tutorials, connected_hardware = load_configuration(config)
+    nb_dir = os.path.join(cw_dir, 'jupyter')
+    firmware_root = os.path.join(cw_dir, 'firmware')
+    changed = [os.path.normpath(os.path.join(cw_dir, path)) for path in changed_paths]
+
+    def inside(path, directory):
+        return path == directory or path.startswith(directory + os.sep)
+
+    for path in changed:
+        if os.path.relpath(path, cw_dir).replace(os.sep, '/').startswith(FULL_RUN_PATHS):
+            test_logger.info("{} can affect every notebook".format(path))
+            return None
+
+    changed_firmware = [path for path in changed if inside(path, firmware_root) and
+                        (path.endswith(FIRMWARE_SOURCE_EXTS) or os.path.basename(path).lower() == 'makefile')]
+    jobs = []
+    for nb, tutorial in tutorials.items():
+        nb_path = os.path.normpath(os.path.join(nb_dir, nb))
+        if not os.path.isfile(nb_path):
+            return None
+        deps = notebook_dependencies(nb_path)
+        builds_firmware = any(os.path.isdir(dep) for dep in deps)
+        affected = any(path == nb_path or any(inside(path, dep) for dep in deps) or
+                       (path.endswith('.py') and os.path.dirname(path) == os.path.dirname(nb_path))
+                       for path in changed)
+        if not affected and not (builds_firmware and changed_firmware):
+            continue
+        test_logger.info("{} is affected by the changes".format(nb))
+        for config_index, test_config in enumerate(tutorial['configurations']):
+            for hw_id in test_config['ids']:
+                if connected_hardware[hw_id].get('enabled') is False:
+                    continue
+                jobs.append({'notebook': nb, 'configuration': config_index, 'hardware': hw_id})
+    return {'jobs': jobs}
+
+# matches a whole %run line, either as the magic or as exported python,
+# capturing its indentation and the notebook path
+RUN_LINE_REGEX = re.compile(r"^([ \t]*)(?:%run\s*[\"']?(.*\.ipynb)[\"']?|get_ipython\(\)\.run_line_magic\('run'\, \'\"(.*\.ipynb)\"\'\))[ \t]*$",
+                            re.MULTILINE)
+
+# exported python for each included notebook with its own %run lines already
+# inlined, keyed on (path, notebook_dir, file hash)
+_inlined_notebooks = {}
+
+def _inlined_notebook(ext_nb_path, notebook_dir, stack=()):
+    memo_key = (ext_nb_path, notebook_dir, hash_path(ext_nb_path))
+    if memo_key not in _inlined_notebooks:
+        ext_nb_node = nbformat.read(ext_nb_path, as_version=4)
+        python_exporter = nbconvert.exporters.PythonExporter()
+        python_code, _ = python_exporter.from_notebook_node(ext_nb_node)
+        _inlined_notebooks[memo_key] = inline_run_magics(python_code, notebook_dir, stack + (ext_nb_path,))
+    return _inlined_notebooks[memo_key]
+
+def inline_run_magics(source, notebook_dir, stack=()):
+    """Replace every %run notebook.ipynb line in source with the notebook's code.
+
+    Included notebooks are exported to python once and memoized on their
+    contents, with nested %run lines already expanded, so one substitution
+    pass over source is enough. Inlined code keeps the indentation of the
+    %run line it replaces.
+    """
+    def replace(match):
+        indent = match.group(1)
+        ext_nb_path = os.path.normpath(os.path.join(notebook_dir, match.group(2) or match.group(3)))
+        if ext_nb_path in stack:
+            test_logger.warning("Not inlining recursive %run of {}".format(ext_nb_path))
+            return match.group(0)
+        python_code = _inlined_notebook(ext_nb_path, notebook_dir, stack)
+        return '{0}\n{0}{1}\n'.format(indent, python_code.replace("\n", "\n" + indent))
+    return RUN_LINE_REGEX.sub(replace, source)
+
 class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
     """Preprocessor that in lines code instead of using %run in nb.
 
@@ -493,6 +1798,9 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
 
     TODO: This needs to handle nested run blocks and indented run blocks - DONE
 
+    External notebooks are exported once per test run and shared between
+    all notebooks and hardware configs, see inline_run_magics().
+
     Args:
         notebook_dir (str): The path to the directory containing all the
             notebooks. Used to resolve the relative paths used by the
@@ -509,47 +1817,11 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
 
     def preprocess_cell(self, cell, resources, index):
         if cell['cell_type'] == 'code':
-            while ('%run' in cell['source']) or ("run_line_magic('run'" in cell['source']):
-                # to deal with other notebooks being called from the source notebook
-                # find the notebooks and export to python code and replace
-                # the current cell source code with that python code before
-                # replacing instances of cw.scope()
-                def regex_replace(p):
-                    # external_notebooks = re.findall(p, cell['source'])
-
-                    run_line = re.search(p, cell['source'])
-                    if not run_line:
-                        return
-                    run_position = run_line.start()
-                    num_tabs = 0
-                    num_spaces = 0
-                    x = cell['source']
-                    while True:
-                        if cell['source'][run_position-1] == '\t':
-                            num_tabs += 1
-                        elif cell['source'][run_position-1] == " ":
-                            num_spaces += 1
-                        else:
-                            break
-
-                        run_position -= 1
-
-                    # for full_match, ext_nb in external_notebooks:
-                    full_match = run_line.group()
-                    ext_nb = run_line.group(2)
-                    # print(run_line.group(1))
-                    # print(run_line.group(2))
-                    ext_nb_path = os.path.join(self.notebook_dir, ext_nb)
-                    ext_nb_node = nbformat.read(ext_nb_path, as_version=4)
-                    python_exporter = nbconvert.exporters.PythonExporter()
-                    python_code, _ = python_exporter.from_notebook_node(ext_nb_node)
-                    python_code = " " * num_spaces + "\t" * num_tabs + python_code.replace("\n", "\n{}{}".format(" " * num_spaces, "\t" * num_tabs))
-                    # print(str(num_spaces), str(num_tabs))
-                    cell['source'] = cell['source'].replace(full_match, '\n{}\n'.format(python_code))
-                p = re.compile(r"(%run\s*[\"']?(.*\.ipynb)[\"']?)")
-                regex_replace(p)
-                p = re.compile(r"(get_ipython\(\)\.run_line_magic\('run'\, \'\"(.*\.ipynb)\"\'\))")
-                regex_replace(p)
+            # to deal with other notebooks being called from the source notebook
+            # find the notebooks and export to python code and replace
+            # the current cell source code with that python code before
+            # replacing instances of cw.scope()
+            cell['source'] = inline_run_magics(cell['source'], self.notebook_dir)
 
             p2 = re.compile(r"(get_ipython\(\)\.run_cell_magic\('bash', '.*?', '(.*?)'\))", flags=re.DOTALL)
             run_line = re.finditer(p2, cell['source'])
@@ -580,9 +1852,816 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
 
         return cell, resources
 
+class KernelPool:
+    """Pool of pre-started kernels with the heavy imports already loaded.
+
+    Starting a kernel and importing chipwhisperer, holoviews and bokeh takes
+    several seconds, which is paid again for every notebook when each
+    ExecutePreprocessor starts its own kernel. The pool keeps `size` kernels
+    warm in the background. A leased kernel is moved into the notebook's
+    directory, and on return it has any open ChipWhisperer devices
+    disconnected, its namespace reset and is checked for health before it
+    goes back in the pool. Kernels that die or fail the check are replaced.
+
+    The reset only clears the notebook's namespace (%reset -f), so a kernel
+    is only reused when the notebook can't have left state behind elsewhere.
+    It's shut down and replaced instead when:
+
+    - it was leased with reusable=False, e.g. because setup code patched
+      chipwhisperer (ProgramCache, cw_replay) before the notebook ran. Its
+      replacement starts as soon as it's leased.
+    - the notebook imported a module that wasn't loaded after the warm up
+      and is part of chipwhisperer or lives under one of watch_dirs.
+    - a chipwhisperer module's globals were rebound, added or deleted since
+      the warm up (e.g. cw.capture_trace = ...). Objects changed in place
+      aren't detected.
+
+    Usage::
+
+        pool = KernelPool(2)
+        with pool.lease('/path/to/notebook/dir') as km:
+            ep.preprocess(nb, resources, km=km)
+        pool.shutdown()
+
+    Args:
+        size (int): Number of kernels to keep ready.
+        kernel_name (str): Kernel spec to start.
+        warm_imports (iterable): Modules to import in each new kernel. Ones
+            that fail to import are skipped.
+        timeout (float): Seconds to wait for a kernel to start or answer a
+            reset/health check.
+        watch_dirs (iterable): Directories, e.g. the chipwhisperer repository,
+            whose modules make a kernel unusable once a notebook imports them.
+    """
+
+    # the chipwhisperer submodules many course notebooks import are loaded
+    # too, importing them later would keep the kernel from being reused
+    default_imports = ('chipwhisperer', 'chipwhisperer.analyzer', 'chipwhisperer.common.results.glitch',
+                       'chipwhisperer.common.traces', 'chipwhisperer.common.api.lascar', 'numpy', 'matplotlib.pyplot',
+                       'holoviews', 'bokeh.plotting', 'tqdm.notebook')
+
+    # close any devices the last notebook left open and clear its namespace,
+    # keeping sys.modules so the imports stay warm
+    _reset_code = (
+        "for _cw_obj in list(globals().values()):\n"
+        "    if type(_cw_obj).__module__.startswith('chipwhisperer') and callable(getattr(_cw_obj, 'dis', None)):\n"
+        "        try:\n"
+        "            _cw_obj.dis()\n"
+        "        except Exception:\n"
+        "            pass\n"
+        "get_ipython().run_line_magic('reset', '-f')\n"
+        "import gc; gc.collect()\n"
+    )
+
+    # what the notebook's module state is compared with, kept on sys since
+    # %reset -f doesn't touch it
+    _baseline_code = (
+        "import sys as _sys\n"
+        "_sys._kernel_pool_baseline = (set(_sys.modules), {name: dict(vars(module)) for name, module in list(_sys.modules.items())\n"
+        "                                                 if name.split('.')[0] == 'chipwhisperer'})\n"
+        "del _sys\n"
+    )
+
+    # fails if the notebook left module state the reset can't clear
+    _module_check_code = (
+        "def _kernel_pool_check(watch_dirs):\n"
+        "    import os, sys\n"
+        "    modules, cw_globals = sys._kernel_pool_baseline\n"
+        "    watch_dirs = tuple(os.path.join(os.path.realpath(d), '') for d in watch_dirs)\n"
+        "    for name, module in list(sys.modules.items()):\n"
+        "        if name in cw_globals:\n"
+        "            now, then = vars(module), cw_globals[name]\n"
+        "            if now.keys() != then.keys() or any(now[k] is not v for k, v in then.items()):\n"
+        "                raise RuntimeError('globals of {{}} changed'.format(name))\n"
+        "        elif name not in modules:\n"
+        "            path = os.path.realpath(getattr(module, '__file__', None) or '')\n"
+        "            if name.split('.')[0] == 'chipwhisperer' or (path and path.startswith(watch_dirs)):\n"
+        "                raise RuntimeError('{{}} was imported'.format(name))\n"
+        "try:\n"
+        "    _kernel_pool_check({!r})\n"
+        "finally:\n"
+        "    del _kernel_pool_check\n"
+    )
+
+    def __init__(self, size=1, kernel_name='python3', warm_imports=None, timeout=120, logger=None, watch_dirs=()):
+        if logger is None:
+            logger = test_logger
+        self.logger = logger
+        self.size = size
+        self.kernel_name = kernel_name
+        self.timeout = timeout
+        if warm_imports is None:
+            warm_imports = self.default_imports
+        self.warm_imports = list(warm_imports)
+        self.watch_dirs = [os.path.abspath(d) for d in watch_dirs]
+        self.cold_start_times = []
+        self._lease_info = threading.local()
+        self._ready = queue.Queue()
+        self._closed = False
+        for _ in range(size):
+            self._start_in_background()
+
+    def _run(self, km, code):
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.timeout)
+            reply = kc.execute_interactive(code, silent=True, store_history=False, timeout=self.timeout,
+                                           output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+        return reply['content']['status'] == 'ok'
+
+    def _start_kernel(self):
+        t_a = time.time()
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        warm = "".join("try:\n    import {}\nexcept Exception:\n    pass\n".format(mod) for mod in self.warm_imports)
+        if not self._run(km, warm + self._reset_code + self._baseline_code):
+            self.logger.warning("Kernel pool: warm up failed, using kernel anyway")
+        self.cold_start_times.append(time.time() - t_a)
+        return km
+
+    def _fill(self):
+        try:
+            km = self._start_kernel()
+        except Exception as e:
+            self.logger.error("Kernel pool: failed to start kernel: {}".format(e))
+            # None tells lease() to start a kernel of its own instead of waiting
+            km = None
+        if self._closed:
+            if km is not None:
+                km.shutdown_kernel(now=True)
+        else:
+            self._ready.put(km)
+
+    def _start_in_background(self):
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _recycle(self, km, reusable=True):
+        # reset the kernel and put it back in the pool, replacing it if the
+        # notebook may have left module state behind, the reset fails or the
+        # kernel is dead. Kernels leased with reusable=False were replaced
+        # when they were leased.
+        if not reusable:
+            try:
+                km.shutdown_kernel(now=True)
+            except Exception:
+                pass
+            return
+        healthy = False
+        reason = "unhealthy kernel"
+        try:
+            if km.is_alive() and not self._run(km, self._module_check_code.format(self.watch_dirs)):
+                reason = "kernel whose module state may have changed"
+            else:
+                healthy = km.is_alive() and self._run(km, self._reset_code)
+        except Exception as e:
+            self.logger.warning("Kernel pool: reset failed: {}".format(e))
+        if healthy and not self._closed:
+            self._ready.put(km)
+            return
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception:
+            pass
+        if not self._closed:
+            self.logger.info("Kernel pool: replacing {}".format(reason))
+            self._fill()
+
+    @property
+    def last_time_saved(self):
+        """Startup time saved by this thread's most recent lease."""
+        return getattr(self._lease_info, 'time_saved', 0)
+
+    @contextmanager
+    def lease(self, path, reusable=True):
+        """Lease a warm kernel whose working directory is set to path.
+
+        With reusable=False the kernel is replaced instead of going back in
+        the pool, for when something besides the notebook runs in it. Sets
+        last_time_saved to the average cold start time minus the time
+        spent waiting for a ready kernel.
+
+        If the pool can't start kernels (or none is ready within timeout),
+        the notebook gets a kernel of its own, shut down afterwards.
+        """
+        t_a = time.time()
+        while True:
+            try:
+                km = self._ready.get(timeout=self.timeout)
+            except queue.Empty:
+                self.logger.warning("Kernel pool: no kernel ready after {}s".format(self.timeout))
+                km = None
+            if km is None:
+                break
+            try:
+                if km.is_alive() and self._run(km, "import os; os.chdir({!r}); get_ipython().execution_count = 1".format(path)):
+                    break
+            except Exception as e:
+                self.logger.warning("Kernel pool: health check failed: {}".format(e))
+            threading.Thread(target=self._recycle, args=(km,), daemon=True).start()
+
+        if km is None:
+            self.logger.warning("Kernel pool: starting a kernel outside the pool")
+            # try to fill the pool again for later leases
+            self._start_in_background()
+            self._lease_info.time_saved = 0
+            km = KernelManager(kernel_name=self.kernel_name)
+            km.start_kernel(cwd=path)
+            try:
+                yield km
+            finally:
+                km.shutdown_kernel(now=True)
+            return
+
+        if not reusable and not self._closed:
+            # start the replacement now, so the next lease doesn't wait for a cold start
+            self._start_in_background()
+        waited = time.time() - t_a
+        cold = sum(self.cold_start_times) / len(self.cold_start_times)
+        self._lease_info.time_saved = max(cold - waited, 0)
+        try:
+            yield km
+        finally:
+            threading.Thread(target=self._recycle, args=(km, reusable), daemon=True).start()
+
+    def shutdown(self):
+        """Shut down all idle kernels. Kernels still leased or resetting are
+        shut down when they are returned."""
+        self._closed = True
+        while True:
+            try:
+                km = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if km is not None:
+                km.shutdown_kernel(now=True)
+
+_chipwhisperer_hash = None
+
+def chipwhisperer_hash():
+    """sha256 of every file in the installed chipwhisperer package (the one
+    the notebook kernels import), computed once per process."""
+    global _chipwhisperer_hash
+    if _chipwhisperer_hash is None:
+        package_dir = os.path.dirname(os.path.abspath(cw.__file__))
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(package_dir):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                if name.endswith(('.pyc', '.pyo')):
+                    continue
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, package_dir).encode())
+                h.update(hash_path(file_path).encode())
+        _chipwhisperer_hash = h.hexdigest()
+    return _chipwhisperer_hash
+
+class ResultCache:
+    """Content addressed cache of passing notebook results.
+
+    Results are keyed on the notebook source, the parameters injected into it,
+    the options it's run with (allowed exceptions, fail fast, timeouts), the
+    installed chipwhisperer package (its version and the hash of every file
+    in it, see chipwhisperer_hash()), everything returned by
+    notebook_dependencies(), the .py files next to the notebook and, for
+    notebooks that build firmware, the firmware sources shared between
+    builds (firmware_cache.shared_sources()). That's what affected_jobs()
+    treats as the notebook's dependencies, so a commit that selects the
+    notebook also misses its cached result.
+    A hit restores the exported notebook and returns the stored result with
+    'cached' set, so unchanged notebook/config pairs aren't run again.
+
+    Args:
+        cache_dir (str): Directory holding <key>.yaml results and <key>.ipynb
+            exported notebooks.
+        force (bool): Never use cached results. Passing results are still
+            stored for later runs.
+    """
+
+    # kwargs that change between runs without changing what's tested
+    ignored_kwargs = ('target_hw_location',)
+
+    def __init__(self, cache_dir, force=False, logger=None):
+        if logger is None:
+            logger = test_logger
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.force = force
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, nb_path, kwargs, options=None):
+        """Key for running nb_path with the parameters kwargs and the run
+        options (e.g. allowable_exceptions, timeouts) that decide if it passes."""
+        notebook_dir = os.path.dirname(os.path.abspath(nb_path))
+        h = hashlib.sha256()
+        h.update(str(cw.__version__).encode())
+        h.update(chipwhisperer_hash().encode())
+        params = sorted((k, repr(v)) for k, v in kwargs.items() if k not in self.ignored_kwargs)
+        h.update(repr(params).encode())
+        h.update(repr(sorted((k, repr(v)) for k, v in (options or {}).items())).encode())
+        deps = notebook_dependencies(nb_path)
+        deps += sorted(glob(os.path.join(glob_escape(notebook_dir), '*.py')))
+        for fw_dir in [dep for dep in deps if os.path.isdir(dep)]:
+            deps += shared_sources(fw_dir)
+        for dep in [os.path.abspath(nb_path)] + sorted(set(deps)):
+            h.update(os.path.relpath(dep, notebook_dir).encode())
+            h.update(hash_path(dep).encode())
+        return h.hexdigest()
+
+    def load(self, key, nb_path, output_dir, PLATFORM):
+        """Restore the exported notebook for key and return its result, or
+        None on a miss."""
+        result_path = os.path.join(self.cache_dir, key + '.yaml')
+        cached_nb_path = os.path.join(self.cache_dir, key + '.ipynb')
+        if self.force or not (os.path.isfile(result_path) and os.path.isfile(cached_nb_path)):
+            return None
+        with open(result_path, 'r') as f:
+            result = yaml.safe_load(f)
+
+        notebook_dir, file_name = os.path.split(nb_path)
+        lab_name, ext = os.path.splitext(file_name)
+        shutil.copyfile(cached_nb_path, os.path.join(output_dir, PLATFORM, lab_name + '.ipynb'))
+        copy_notebook_images(notebook_dir, output_dir, PLATFORM)
+        result.pop('regressions', None)
+        result['cached'] = True
+        return result
+
+    def store(self, key, result, ipynb_path):
+        # write to temporary names first so a partial entry is never a hit
+        result_path = os.path.join(self.cache_dir, key + '.yaml')
+        cached_nb_path = os.path.join(self.cache_dir, key + '.ipynb')
+        shutil.copyfile(ipynb_path, cached_nb_path + '.tmp')
+        with open(result_path + '.tmp', 'w') as f:
+            yaml.dump(result, f, default_flow_style=False)
+        os.replace(cached_nb_path + '.tmp', cached_nb_path)
+        os.replace(result_path + '.tmp', result_path)
+        self.logger.info("Cached result as {}".format(key))
+
+def notebook_kwargs(hw_settings, test_config):
+    """Parameters for running a notebook configuration on some hardware."""
+    kwargs = {
+        'SCOPETYPE': hw_settings['scope'],
+        'PLATFORM': hw_settings['target'],
+        'CRYPTO_TARGET': hw_settings['firmware'],
+        'VERSION': hw_settings['tutorial type'],
+        'SS_VER': test_config['ssver'],
+        'SNAME': hw_settings['short name']
+
+    }
+
+    hw_kwargs = hw_settings.get('kwargs')
+    if hw_kwargs:
+        kwargs.update(hw_kwargs)
+
+    tutorial_kwargs = test_config.get('kwargs')
+    if tutorial_kwargs:
+        kwargs.update(tutorial_kwargs)
+    return kwargs
+
+def needs_hardware(hw_settings, test_config=None):
+    """Whether a notebook run for this hardware configuration touches a device.
+
+    SIMULATED configurations with scope NONE never connect to anything. A
+    tutorial configuration can override this with a `hardware` key.
+    """
+    if test_config and 'hardware' in test_config:
+        return bool(test_config['hardware'])
+    return not (hw_settings.get('tutorial type') == 'SIMULATED' and hw_settings.get('scope') == 'NONE')
+
+def plan_shards(config, num_shards, previous_results=None, sim_workers=4, default_seconds=600, history=None):
+    """Split the tutorials x configurations x hardware matrix into balanced shards.
+
+    Each shard is meant to run on its own host with the same connected
+    hardware (see run_tests(shard=...)). Run times come from the notebook's
+    recent average on that hardware in history (a TestHistory), else a
+    previous results.yaml: the notebook's 'run seconds' on that hardware,
+    else its average on other hardware, else the median of every known run
+    time, else default_seconds.
+
+    Jobs are placed longest first on the shard where they finish earliest
+    (LPT). A shard's time is its busiest lane, where each device is a lane
+    that runs its notebooks one after another, and hardware-free notebooks
+    share a lane of sim_workers threads.
+
+    Returns:
+        list: One dict per shard with 'estimated seconds' and its 'jobs', each
+        a dict with 'notebook', 'configuration' (index in the notebook's
+        configurations), 'hardware' (connected hardware index) and
+        'estimated seconds'.
+    """
+    tutorials, connected_hardware = load_configuration(config)
+    if not previous_results:
+        previous_results = {}
+
+    lab_times = {}
+    for hw_tests in previous_results.values():
+        for lab_name, result in (hw_tests or {}).items():
+            if isinstance(result, dict) and 'run seconds' in result:
+                lab_times.setdefault(lab_name, []).append(result['run seconds'])
+    known = sorted(t for times in lab_times.values() for t in times)
+    if known:
+        default_seconds = known[len(known) // 2]
+
+    jobs = []
+    for nb, tutorial in tutorials.items():
+        lab_name, ext = os.path.splitext(os.path.basename(nb))
+        for config_index, test_config in enumerate(tutorial['configurations']):
+            for hw_id in test_config['ids']:
+                hw_settings = connected_hardware[hw_id]
+                if hw_settings.get('enabled') is False:
+                    continue
+                previous = (previous_results.get(sname_to_log_name(hw_settings)) or {}).get(lab_name) or {}
+                recent = history.typical_seconds(sname_to_log_name(hw_settings), nb) if history else None
+                if recent is not None:
+                    seconds = recent
+                elif 'run seconds' in previous:
+                    seconds = previous['run seconds']
+                elif lab_name in lab_times:
+                    seconds = sum(lab_times[lab_name]) / len(lab_times[lab_name])
+                else:
+                    seconds = default_seconds
+                lane = hw_id if needs_hardware(hw_settings, test_config) else None
+                jobs.append((seconds, lane, {'notebook': nb, 'configuration': config_index, 'hardware': hw_id,
+                                             'estimated seconds': round(seconds, 1)}))
+
+    def finish_time(lanes):
+        return max([t / sim_workers if lane is None else t for lane, t in lanes.items()] or [0])
+
+    shards = [{'lanes': {}, 'jobs': []} for _ in range(num_shards)]
+    for seconds, lane, job in sorted(jobs, key=lambda j: j[0], reverse=True):
+        def cost(shard):
+            lanes = dict(shard['lanes'])
+            lanes[lane] = lanes.get(lane, 0) + seconds
+            # ties go to the shard with the least total work
+            return finish_time(lanes), sum(lanes.values())
+        shard = min(shards, key=cost)
+        shard['lanes'][lane] = shard['lanes'].get(lane, 0) + seconds
+        shard['jobs'].append(job)
+
+    return [{'estimated seconds': round(finish_time(shard['lanes']), 1), 'jobs': shard['jobs']} for shard in shards]
+
+def merge_results(results_paths, output_paths=()):
+    """Combine the results.yaml files of several shards into one.
+
+    Results are merged per hardware, so shards that ran different notebooks on
+    the same hardware end up side by side. If two files have the same
+    notebook for the same hardware, the later one wins.
+
+    Returns:
+        dict: The merged results, also written to each of output_paths.
+    """
+    merged = {}
+    for path in results_paths:
+        with open(path, 'r') as f:
+            results = yaml.safe_load(f) or {}
+        for sname, hw_tests in results.items():
+            merged.setdefault(sname, {}).update(hw_tests or {})
+
+    for path in output_paths:
+        with open(path, "w+") as f:
+            yaml.dump(merged, f, default_flow_style=False)
+    return merged
+
+FIRMWARE_CACHE_SCRIPT = os.path.join(tests_dir, 'firmware_cache.py')
+
+def firmware_cache_env(cache_dir):
+    """Make the make in %%bash cells go through firmware_cache.py.
+
+    Writes a script defining a make function and points BASH_ENV at it, so
+    kernels started afterwards run their %%bash cells with it. The notebooks
+    themselves aren't changed, so the exported tutorials look the same.
+
+    Returns:
+        str: The previous BASH_ENV (or None), for run_tests() to restore.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    script = os.path.join(cache_dir, 'bash_env.sh')
+    previous = os.environ.get('BASH_ENV')
+    with open(script, 'w') as f:
+        if previous and previous != script:
+            f.write('. {}\n'.format(shlex.quote(previous)))
+        f.write('make() {{ {} {} {} make "$@"; }}\n'.format(shlex.quote(sys.executable), shlex.quote(FIRMWARE_CACHE_SCRIPT),
+                                                         shlex.quote(os.path.abspath(cache_dir))))
+    os.environ['BASH_ENV'] = script
+    return previous
+
+def firmware_builds(nb_path, kwargs):
+    """Find the firmware builds in a notebook's %%bash cells (and the ones in
+    notebooks it %runs) when run with kwargs as its parameters.
+
+    Only cells that just cd and make are used, since anything else could
+    change the firmware first. Cells with arguments that aren't known
+    parameters are skipped too; they still use the cache when they run.
+
+    Returns:
+        list: (firmware dir, make command as a list) tuples.
+    """
+    nb_path = os.path.abspath(nb_path)
+    notebook_dir = os.path.dirname(nb_path)
+    builds = []
+    for path in [nb_path] + [dep for dep in notebook_dependencies(nb_path) if dep.endswith('.ipynb')]:
+        nb = nbformat.read(path, as_version=4)
+        params = {}
+        if path == nb_path:
+            try:
+                params = {p.name: p.value for p in extract_parameters(nb)}
+            except Exception:
+                pass
+        params.update(kwargs)
+        for cell in nb.cells:
+            if cell['cell_type'] != 'code' or not cell['source'].startswith('%%bash'):
+                continue
+            lines = cell['source'].splitlines()
+            header = shlex.split(lines[0])
+            args = []
+            for arg in header[header.index('-s') + 1:] if '-s' in header else []:
+                name = arg[1:] if arg.startswith('$') else None
+                args.append(str(params[name]) if name in params else None if name else arg)
+            if None in args:
+                continue
+
+            cwd = notebook_dir
+            cell_builds = []
+            for line in lines[1:]:
+                line = re.sub(r'\$(\d)', lambda m: args[int(m.group(1)) - 1] if int(m.group(1)) <= len(args) else m.group(0), line)
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                if words[0] == 'cd' and len(words) == 2:
+                    cwd = os.path.normpath(os.path.join(cwd, words[1]))
+                elif words[0] == 'make' and '$' not in line and '`' not in line and _is_firmware_dir(cwd):
+                    cell_builds.append((cwd, words))
+                else:
+                    cell_builds = None
+                    break
+            if cell_builds:
+                builds.extend(build for build in cell_builds if build not in builds)
+    return builds
+
+def prebuild_firmware(builds, cache_dir, workers=4, logger=None):
+    """Build firmware into the firmware cache before the notebooks need it.
+
+    Up to workers firmware directories are built at once: a thread per
+    directory runs firmware_cache.py, and so make, as a subprocess for each of
+    that directory's builds in turn, since they share its objdir. make itself
+    runs with the notebook's arguments, nothing adds -j. Failed builds are
+    only logged; the notebook runs make itself and shows the error.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if logger is None:
+        logger = test_logger
+    by_dir = {}
+    for fw_dir, args in builds:
+        if args not in by_dir.setdefault(fw_dir, []):
+            by_dir[fw_dir].append(args)
+
+    def build_dir(fw_dir):
+        for args in by_dir[fw_dir]:
+            t_a = time.time()
+            proc = subprocess.run([sys.executable, FIRMWARE_CACHE_SCRIPT, cache_dir] + list(args), cwd=fw_dir,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            if proc.returncode:
+                logger.warning("Prebuild of {} {} failed:\n{}".format(fw_dir, " ".join(args), proc.stdout[-2000:]))
+            else:
+                logger.info("Prebuilt {} {} in {:.1f}s".format(os.path.basename(fw_dir), " ".join(args[1:]), time.time() - t_a))
+
+    t_a = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(build_dir, by_dir))
+    logger.info("Prebuilt {} firmware builds in {:.1f}s".format(sum(len(b) for b in by_dir.values()), time.time() - t_a))
+
+class TestHistory:
+    """SQLite store of every notebook result, for questions spanning many runs.
+
+    results.yaml only holds the last run. The history keeps a row for every
+    run (time, commit, whether it ran everything) and for every notebook
+    result in it (hardware, notebook, configuration, passed, run time), with
+    the cell timings, so trends are a query away::
+
+        history = TestHistory('tutorials/history.sqlite')
+        history.flaky()                      # notebooks flipping between pass and fail
+        history.trend('courses/sca101/...')  # a notebook's run time over the runs
+        history.slowest('CWLITEARM')         # slowest notebooks on a device
+
+    Cached results are stored (they count as a pass) but left out of the
+    timing and flakiness queries, since nothing ran. Only the process
+    running the tests writes to it.
+
+    Args:
+        path (str): The database file, created if needed.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started TEXT NOT NULL,
+            commit_hash TEXT,
+            full INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            hardware TEXT NOT NULL,
+            notebook TEXT NOT NULL,
+            configuration INTEGER,
+            passed INTEGER NOT NULL,
+            cached INTEGER NOT NULL DEFAULT 0,
+            seconds REAL,
+            errors TEXT
+        );
+        CREATE INDEX IF NOT EXISTS results_by_notebook ON results (notebook, hardware, run_id);
+        CREATE INDEX IF NOT EXISTS results_by_hardware ON results (hardware, run_id);
+        CREATE INDEX IF NOT EXISTS results_by_run ON results (run_id);
+        CREATE TABLE IF NOT EXISTS cells (
+            result_id INTEGER NOT NULL REFERENCES results(id),
+            cell INTEGER NOT NULL,
+            seconds REAL,
+            peak_rss_mb REAL
+        );
+        CREATE INDEX IF NOT EXISTS cells_by_result ON cells (result_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    def add_run(self, commit=None, started=None, full=True):
+        """Start a run, returning its id for add_result()."""
+        with self.db:
+            cursor = self.db.execute("INSERT INTO runs (started, commit_hash, full) VALUES (?, ?, ?)",
+                                     ((started or datetime.now()).isoformat(), commit, int(full)))
+        return cursor.lastrowid
+
+    def add_result(self, run_id, hardware, notebook, configuration, result):
+        """Store a result dict from test_notebook()."""
+        errors = result.get('errors')
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO results (run_id, hardware, notebook, configuration, passed, cached, seconds, errors) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, hardware, notebook, configuration, int(bool(result.get('passed'))), int(bool(result.get('cached'))),
+                 result.get('run seconds'), json.dumps(strip_ansi(errors), default=str) if errors else None))
+            self.db.executemany("INSERT INTO cells (result_id, cell, seconds, peak_rss_mb) VALUES (?, ?, ?, ?)",
+                                [(cursor.lastrowid, c['cell'], c.get('seconds'), c.get('peak rss MB'))
+                                 for c in result.get('cells') or []])
+
+    def add_journal(self, run_id, journal):
+        """Store every result in a ResultsJournal."""
+        for record in journal.records():
+            self.add_result(run_id, record['hardware'], record['notebook'], record['configuration'], record['result'])
+
+    def _first_run(self, runs):
+        # id of the oldest of the last `runs` runs
+        row = self.db.execute("SELECT COALESCE(MAX(id), 0) - ? + 1 FROM runs", (runs,)).fetchone()
+        return row[0]
+
+    def run_results(self, run_id):
+        """Every result of a run, failures first."""
+        return [dict(row) for row in self.db.execute(
+            "SELECT hardware, notebook, configuration, passed, cached, seconds, errors FROM results "
+            "WHERE run_id = ? ORDER BY passed, hardware, notebook", (run_id,))]
+
+    def typical_seconds(self, hardware, notebook, runs=5):
+        """Average run time of a notebook on hardware over its last runs, or None."""
+        row = self.db.execute(
+            "SELECT AVG(seconds) FROM (SELECT seconds FROM results WHERE notebook = ? AND hardware = ? "
+            "AND cached = 0 AND seconds IS NOT NULL ORDER BY run_id DESC LIMIT ?)", (notebook, hardware, runs)).fetchone()
+        return row[0]
+
+    def flaky(self, runs=20, min_flips=2):
+        """Notebooks whose result changed at least min_flips times in the last
+        runs, most flips first. A notebook that broke and was fixed once
+        isn't flaky."""
+        return [dict(row) for row in self.db.execute(
+            "SELECT notebook, hardware, COUNT(*) AS runs, SUM(passed) AS passes, SUM(flip) AS flips FROM ("
+            "  SELECT notebook, hardware, passed,"
+            "         passed != LAG(passed) OVER (PARTITION BY notebook, hardware ORDER BY run_id) AS flip"
+            "  FROM results WHERE run_id >= ? AND cached = 0) "
+            "GROUP BY notebook, hardware HAVING flips >= ? ORDER BY flips DESC, notebook",
+            (self._first_run(runs), min_flips))]
+
+    def trend(self, notebook, hardware=None, limit=50):
+        """A notebook's run times over its last limit runs, oldest first."""
+        query = ("SELECT runs.started, runs.commit_hash, results.hardware, results.seconds, results.passed "
+                 "FROM results JOIN runs ON runs.id = results.run_id WHERE results.notebook = ? AND results.cached = 0")
+        args = [notebook]
+        if hardware:
+            query += " AND results.hardware = ?"
+            args.append(hardware)
+        query += " ORDER BY results.run_id DESC LIMIT ?"
+        args.append(limit)
+        return [dict(row) for row in reversed(self.db.execute(query, args).fetchall())]
+
+    def slowest(self, hardware=None, num=10, runs=5):
+        """The num slowest notebooks on each device (or just hardware),
+        averaged over the last runs."""
+        query = ("SELECT hardware, notebook, seconds, samples FROM ("
+                 "  SELECT hardware, notebook, AVG(seconds) AS seconds, COUNT(*) AS samples,"
+                 "         ROW_NUMBER() OVER (PARTITION BY hardware ORDER BY AVG(seconds) DESC) AS rank"
+                 "  FROM results WHERE run_id >= ? AND cached = 0 AND seconds IS NOT NULL")
+        args = [self._first_run(runs)]
+        if hardware:
+            query += " AND hardware = ?"
+            args.append(hardware)
+        query += "  GROUP BY hardware, notebook) WHERE rank <= ? ORDER BY hardware, seconds DESC"
+        args.append(num)
+        return [dict(row) for row in self.db.execute(query, args)]
+
+class ResultsJournal:
+    """Append only record of every finished notebook, so a crash doesn't lose results.
+
+    Each hardware writes its own <hardware>.jsonl in journal_dir, one line per
+    finished (notebook, configuration) with its result. Every line is flushed
+    and fsync'd before append() returns. A line cut short by a crash is
+    ended by the next append() and ignored when reading.
+
+    Args:
+        journal_dir (str): Directory holding the journal files.
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self._lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def _path(self, hardware):
+        return os.path.join(self.journal_dir, hardware + '.jsonl')
+
+    def append(self, hardware, notebook, configuration, result):
+        line = json.dumps({'hardware': hardware, 'notebook': notebook, 'configuration': configuration,
+                           'time': datetime.now().isoformat(), 'result': result}, default=str)
+        with self._lock, open(self._path(hardware), 'a+b') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # end a line cut short by a crash, or this one would be joined onto it
+                    line = '\n' + line
+            f.write((line + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def records(self, hardware=None):
+        paths = [self._path(hardware)] if hardware else sorted(glob(os.path.join(self.journal_dir, '*.jsonl')))
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass
+
+    def done(self, hardware):
+        """(notebook, configuration index) pairs with a recorded result on hardware."""
+        return {(record['notebook'], record['configuration']) for record in self.records(hardware)}
+
+    def results(self):
+        """Results for results.yaml, {hardware: {lab name: result}}, with
+        ANSI escapes removed from the error tracebacks."""
+        results = {}
+        for record in self.records():
+            lab_name, ext = os.path.splitext(os.path.basename(record['notebook']))
+            result = record['result']
+            if result.get('errors'):
+                result['errors'] = strip_ansi(result['errors'])
+            results.setdefault(record['hardware'], {})[lab_name] = result
+        return results
+
+    def clear(self):
+        for path in glob(os.path.join(self.journal_dir, '*.jsonl')):
+            os.remove(path)
+
 # function to run all notebooks for a given hardware configuration
 # select hardware via hw_id (i.e. 0 runs hw configuration 0, 1 runs hw configuration 1, and so on)
-def run_test_hw_config(hw_id, cw_dir, config, hw_location=None, target_hw_location=None, logger=None, output_dir=None):
+# notebooks that don't need hardware run concurrently on up to sim_workers threads,
+# ones that do run one after another on this process's device
+# results of passing notebooks are cached in cache_dir (output_dir/.result_cache by default)
+# and reused until the notebook or something it depends on changes, unless force is set
+# previous_tests is this hardware's results from the last run, to flag slower notebooks/cells
+# fail_fast, cell_timeout and notebook_timeout are passed to FailFastExecutePreprocessor, the
+# timeouts and allowable exceptions can also be set per tutorial configuration in the yaml file
+# only limits the run to a set of (notebook, configuration index) pairs, e.g. from a shard
+# program_cache_dir holds the ProgramCache records (None to always program the target)
+# each result is added to the ResultsJournal in journal_dir as soon as the notebook is exported,
+# and with resume, notebooks that already have a result there aren't run again
+# with checkpoint, notebooks run in several configurations without hardware run the cells
+# they share once and fork a kernel for each configuration, see KernelCheckpoint
+# with a TestHistory at history_path, the notebooks without hardware start longest first
+# replay_dir and record_dir are passed to test_notebook, replayed results aren't cached
+def run_test_hw_config(hw_id, cw_dir, config, hw_location=None, target_hw_location=None, logger=None, output_dir=None, kernel_pool_size=1,
+                       sim_workers=4, cache_dir=None, force=False, previous_tests=None, fail_fast=None, cell_timeout=None, notebook_timeout=None,
+                       only=None, program_cache_dir=None, journal_dir=None, resume=False, checkpoint=True, history_path=None,
+                       replay_dir=None, record_dir=None):
+    from concurrent.futures import ThreadPoolExecutor
     if logger is None:
         logger = test_logger
 
@@ -597,49 +2676,139 @@ def run_test_hw_config(hw_id, cw_dir, config, hw_location=None, target_hw_locati
         output_dir = os.path.join(cw_dir, 'tutorials')
     tests = {}
 
+    sname = sname_to_log_name(hw_settings)
+    if not journal_dir:
+        journal_dir = os.path.join(output_dir, '.journal')
+    journal = ResultsJournal(journal_dir)
+    done = journal.done(sname) if resume else set()
+    if done:
+        logger.info("Resuming, {} notebooks already have results".format(len(done)))
+
+    # collect every (notebook, kwargs) to run for this hardware
+    jobs = []
     for nb in tutorials.keys():
-        for test_config in tutorials[nb]['configurations']:
+        for config_index, test_config in enumerate(tutorials[nb]['configurations']):
             # if this hardware is in the notebook's hardware list
-            if hw_id in test_config['ids']:
+            if hw_id in test_config['ids'] and (only is None or (nb, config_index) in only) and (nb, config_index) not in done:
 
                 # grab hw specific info from yaml file
-                kwargs = {
-                    'SCOPETYPE': hw_settings['scope'],
-                    'PLATFORM': hw_settings['target'],
-                    'CRYPTO_TARGET': hw_settings['firmware'],
-                    'VERSION': hw_settings['tutorial type'],
-                    'SS_VER': test_config['ssver'],
-                    'SNAME': hw_settings['short name']
-
+                kwargs = notebook_kwargs(hw_settings, test_config)
+                logger.info("HW kwargs: {}".format(hw_settings.get('kwargs')))
+
+                options = {
+                    'fail_fast': fail_fast,
+                    'cell_timeout': test_config.get('cell timeout', cell_timeout),
+                    'notebook_timeout': test_config.get('timeout', notebook_timeout),
+                    'allowable_exceptions': test_config.get('allowable exceptions'),
                 }
 
-                path = os.path.join(nb_dir, nb)
-                nb_short = str(nb).split('/')[-1].split(' -')[0]
-                hw_kwargs = hw_settings.get('kwargs')
-                logger.info("HW kwargs: {}".format(hw_kwargs))
-                if hw_kwargs:
-                    kwargs.update(hw_kwargs)
-
-                tutorial_kwargs = test_config.get('kwargs')
-                if tutorial_kwargs:
-                    kwargs.update(tutorial_kwargs)
-
-                logger.info("\nTesting {} with {} ({})".format(nb, hw_id, kwargs))
-                logger.log(60, "Running {}".format(nb_short))
-                passed, output, result_dict = test_notebook(hw_location=hw_location, target_hw_location=target_hw_location, nb_path=path, output_dir=output_dir, logger=logger, **kwargs)
-                if not passed:
-                    summary['failed'] += 1
-                summary['run'] += 1
-                header = " {} {} in {} min\n".format("Passed" if passed else "Failed", nb_short, result_dict['run time'])
-                logger.log(60, header)
-                lab_dir, lab_file = os.path.split(nb)
-                lab_name, ext = os.path.splitext(lab_file)
-                logger.info("Lab name: {}".format(lab_name))
-                tests[lab_name] = result_dict
+                jobs.append((nb, config_index, kwargs, options, needs_hardware(hw_settings, test_config)))
 
             else:
                 pass # we don't need to test this hardware on this tutorial
-        
+
+    num_concurrent = sum(not hw for _, _, _, _, hw in jobs)
+    if num_concurrent > 1 and history_path and os.path.isfile(history_path):
+        history = TestHistory(history_path)
+        typical = {nb: history.typical_seconds(sname, nb) or 0 for nb, _, _, _, hw in jobs if not hw}
+        history.close()
+        jobs.sort(key=lambda job: 0 if job[4] else -typical[job[0]])
+    if num_concurrent:
+        # a notebook's configurations run one at a time (see nb_locks)
+        sim_workers = max(1, min(sim_workers or 1, len({nb for nb, _, _, _, hw in jobs if not hw})))
+        kernel_pool_size = max(kernel_pool_size, sim_workers) if kernel_pool_size else 0
+
+    if not cache_dir:
+        cache_dir = os.path.join(output_dir, '.result_cache')
+    result_cache = ResultCache(cache_dir, force=force, logger=logger)
+    program_cache = ProgramCache(program_cache_dir, logger=logger) if program_cache_dir else None
+    export_pool = ExportPool(logger=logger)
+
+    # warm kernels are started now so they're ready by the first notebook
+    kernel_pool = None
+    if kernel_pool_size:
+        kernel_pool = KernelPool(kernel_pool_size, logger=logger, watch_dirs=[cw_dir])
+
+    if not previous_tests:
+        previous_tests = {}
+
+    # the checkpoints only run their cells once the first configuration needs them
+    checkpoints = {}
+    if checkpoint and hasattr(os, 'fork'):
+        sweeps = {}
+        for nb, config_index, kwargs, options, hw in jobs:
+            if not hw:
+                sweeps.setdefault(nb, []).append(kwargs)
+        for nb, configurations in sweeps.items():
+            if len(configurations) > 1:
+                try:
+                    checkpoints[nb] = KernelCheckpoint.for_configurations(os.path.join(nb_dir, nb), configurations, logger=logger)
+                except Exception as e:
+                    logger.warning("Can't checkpoint {}: {}".format(nb, e))
+
+    # configurations of a notebook share its directory (projects/, the %%bash
+    # make cells' objdir and hex files) and export paths, so only one runs at once
+    nb_locks = {nb: threading.Lock() for nb, _, _, _, _ in jobs}
+
+    def run_job(nb, config_index, kwargs, options):
+        with nb_locks[nb]:
+            return _run_job(nb, config_index, kwargs, options)
+
+    def run_sim_jobs(nb_jobs):
+        return [(nb, run_job(nb, config_index, kwargs, options)) for nb, config_index, kwargs, options in nb_jobs]
+
+    def _run_job(nb, config_index, kwargs, options):
+        path = os.path.join(nb_dir, nb)
+        nb_short = str(nb).split('/')[-1].split(' -')[0]
+        lab_name, ext = os.path.splitext(os.path.basename(nb))
+        # everything logged for this notebook is tagged with it in events.jsonl
+        nb_logger = NotebookLogger(logger, {'notebook': nb, 'configuration': config_index})
+        nb_logger.info("\nTesting {} with {} ({})".format(nb, hw_id, kwargs))
+        nb_logger.log(60, "Running {}".format(nb_short), extra={'event': 'notebook started'})
+        passed, output, result_dict = test_notebook(hw_location=hw_location, target_hw_location=target_hw_location, nb_path=path, output_dir=output_dir, logger=nb_logger, kernel_pool=kernel_pool,
+                                                     result_cache=None if replay_dir else result_cache, previous_result=previous_tests.get(lab_name),
+                                                     program_cache=program_cache, export_pool=export_pool, checkpoint=checkpoints.get(nb),
+                                                     replay_dir=replay_dir, record_dir=record_dir, **options, **kwargs)
+        if result_dict.get('cached'):
+            header = " {} {} (cached)\n".format("Passed", nb_short)
+        else:
+            header = " {} {} in {} min\n".format("Passed" if passed else "Failed", nb_short, result_dict['run time'])
+        nb_logger.log(60, header, extra={'event': 'notebook finished', 'passed': passed, 'seconds': result_dict.get('run seconds'),
+                                         'cached': bool(result_dict.get('cached'))})
+        # the pool has one thread, so this runs after the notebook's export
+        export_pool.submit(journal.append, sname, nb, config_index, result_dict)
+        return passed, result_dict
+
+    try:
+        # each notebook's configurations go to one worker in turn, rather than
+        # tying up several workers waiting for its lock
+        sim_jobs = {}
+        for nb, config_index, kwargs, options, hw in jobs:
+            if not hw:
+                sim_jobs.setdefault(nb, []).append((nb, config_index, kwargs, options))
+        with ThreadPoolExecutor(max_workers=sim_workers if num_concurrent else 1) as sim_pool:
+            pending = [sim_pool.submit(run_sim_jobs, nb_jobs) for nb_jobs in sim_jobs.values()]
+
+            # hardware notebooks share one device, so keep them in order here
+            finished = [(nb, run_job(nb, config_index, kwargs, options)) for nb, config_index, kwargs, options, hw in jobs if hw]
+        for future in pending:
+            finished += future.result()
+
+        for nb, (passed, result_dict) in finished:
+            if not passed:
+                summary['failed'] += 1
+            summary['run'] += 1
+            lab_dir, lab_file = os.path.split(nb)
+            lab_name, ext = os.path.splitext(lab_file)
+            logger.info("Lab name: {}".format(lab_name))
+            tests[lab_name] = result_dict
+    finally:
+        export_pool.join()
+        for nb_checkpoint in checkpoints.values():
+            if nb_checkpoint:
+                nb_checkpoint.close()
+        if kernel_pool:
+            kernel_pool.shutdown()
 
     time.sleep(0.5)
     logger.info("\n-----------------\nFinished test run\n-----------------\n")
@@ -648,26 +2817,48 @@ def run_test_hw_config(hw_id, cw_dir, config, hw_location=None, target_hw_locati
 
 # main function for running tests on all hardware
 # runs tests for each hardware concurrently
-def run_tests(cw_dir, config, results_path=None, output_dir=None):
-    from concurrent.futures import ProcessPoolExecutor, as_completed
+# shard is one entry of plan_shards(): only its jobs are run, and only the hardware they use is set up
+# firmware the notebooks build is prebuilt on build_workers processes into firmware_cache_dir
+# (output_dir/.firmware_cache by default) while the hardware is set up; 0 disables the firmware cache
+# with skip_reprogram, targets that already have a notebook's firmware from earlier in the run aren't programmed again
+# results are journalled in output_dir/.journal as they finish and results.yaml is built from the journal;
+# resume continues an interrupted run, only running notebooks that don't have a result yet
+# checkpoint is passed to run_test_hw_config
+# every result is added to the TestHistory at history_path (output_dir/history.sqlite by default),
+# the returned summary has the run's 'run id' and 'history' path
+# with replay_dir, no device is used: each notebook replays replay_dir/<SNAME>/<lab name> (see cw_replay)
+# and the history is kept in replay_dir; with record_dir, each notebook's device use is recorded there
+def run_tests(cw_dir, config, results_path=None, output_dir=None, kernel_pool_size=1, sim_workers=4, cache_dir=None, force=False,
+              fail_fast=None, cell_timeout=None, notebook_timeout=None, shard=None, build_workers=4, firmware_cache_dir=None,
+              skip_reprogram=True, resume=False, checkpoint=True, history_path=None, replay_dir=None, record_dir=None):
     if not results_path:
         results_path = "./"
-    
-    # create the many loggers we use for tests
-    results_handler = logging.FileHandler(results_path + "/testing.log")
-    test_logger.addHandler(results_handler)
-
-    # global summary file that takes output from all test loggers
-    global_fmt = logging.Formatter("%(asctime)s||%(name)s||%(message)s", "%H:%M")
-    global_sum_handler =  logging.FileHandler(results_path + "/sum_test.log")
-    global_sum_handler.setFormatter(global_fmt)
-    global_sum_handler.setLevel(60)
-
-    test_logger.addHandler(global_sum_handler)
 
     # load yaml file
     tutorials, connected_hardware = load_configuration(config)
 
+    # every process logs through a queue to one process writing the log files
+    hw_names = [sname_to_log_name(hw) for hw in connected_hardware]
+    log_writer = LogWriter(results_path, hw_names)
+    log_writer.start()
+    # _run_tests() points BASH_ENV at the firmware cache for the kernels it starts
+    bash_env = os.environ.get('BASH_ENV')
+    try:
+        return _run_tests(cw_dir, config, tutorials, connected_hardware, log_writer, results_path, output_dir, kernel_pool_size,
+                          sim_workers, cache_dir, force, fail_fast, cell_timeout, notebook_timeout, shard, build_workers,
+                          firmware_cache_dir, skip_reprogram, resume, checkpoint, history_path, replay_dir, record_dir)
+    finally:
+        if bash_env is None:
+            os.environ.pop('BASH_ENV', None)
+        else:
+            os.environ['BASH_ENV'] = bash_env
+        log_writer.stop()
+
+def _run_tests(cw_dir, config, tutorials, connected_hardware, log_writer, results_path, output_dir, kernel_pool_size, sim_workers,
+               cache_dir, force, fail_fast, cell_timeout, notebook_timeout, shard, build_workers, firmware_cache_dir,
+               skip_reprogram, resume, checkpoint, history_path, replay_dir, record_dir):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
     num_hardware = len(connected_hardware)
     hw_locations = []
     target_hw_locations = []
@@ -688,33 +2879,19 @@ def run_tests(cw_dir, config, results_path=None, output_dir=None):
     if wrong_paths != "":
         raise FileNotFoundError("Incorrect paths: {}".format(wrong_paths))
 
-    # create loggers for each test hardware
+    # loggers for each test hardware, their files are written by log_writer
     def create_logger(i):
-        # set up logging for tests
-
-        # short name used for id
-        sname = sname_to_log_name(connected_hardware[i])
-        full_fmt = logging.Formatter("%(asctime)s||%(levelname)s||%(lineno)d||%(message)s", "%y-%m-%d %H:%M:%S")
-        full_handle = logging.FileHandler(results_path + "/test_{}.log".format(sname))
-        full_handle.setFormatter(full_fmt)
-        full_handle.setLevel(logging.NOTSET)
-
-        sum_fmt = logging.Formatter("%(asctime)s||%(message)s", "%H:%M")
-        sum_handle = logging.FileHandler(results_path + "/sum_test_{}.log".format(sname))
-        sum_handle.setFormatter(sum_fmt)
-        sum_handle.setLevel(60)
-
-        cur = logging.getLogger("{} Logger".format(sname))
-
-        cur.setLevel(logging.NOTSET)
-        cur.addHandler(full_handle)
-        cur.addHandler(sum_handle)
-        cur.addHandler(global_sum_handler)
-        return cur
+        return logging.getLogger("{} Logger".format(sname_to_log_name(connected_hardware[i])))
     
     # grab scope hw location and target hw location if needed
     # also swap to MPSSE mode if required, since doing that changes hw_location due to reenumeration
     # also update firmware if required
+    # devices whose DeviceCache record still matches aren't connected to at all
+    device_cache = DeviceCache(os.path.join(output_dir, '.device_cache.json'))
+    devices = enumerated_devices()
+    # the bootloaders are found by serial port, so only upgrade one device at a time
+    upgrade_lock = threading.Lock()
+
     def setup_HW(conf: dict, i: int):
         test_logger.info("Setting up conf {}".format(str(conf)))
         target_name = conf["short name"]
@@ -734,73 +2911,122 @@ def run_tests(cw_dir, config, results_path=None, output_dir=None):
         except Exception as e:
             test_logger.info("Making folder {} failed err {}".format(target_folder, str(e)))
 
-        # copy the images from input to output directory
+        # link the images from input to output directory
         # keeping them in the same relative directory
         image_input_dir = os.path.join(nb_dir, 'img')
         image_output_dir = os.path.join(target_folder, 'img')
-
-        if not os.path.isdir(image_output_dir):
-            os.mkdir(image_output_dir)
-
-        test_logger.info('Copying over image files...')
-        for image_path in glob(os.path.join(image_input_dir, '*')):
-            _, image_name = os.path.split(image_path)
-            shutil.copyfile(image_path, os.path.join(image_output_dir, image_name))
-        test_logger.info('Done')
+        link_images(image_input_dir, image_output_dir, os.path.join(output_dir, '.images'))
 
         # get target hw_location
         if not conf.get('target serial number') is None:
-            if conf['target'] == "CW305":
-                target_type =  cw.targets.CW305
-            elif conf['target'] == "CW310":
-                target_type =  cw.targets.CW310
+            tsn = str(conf['target serial number'])
+            tlocation = device_cache.lookup(tsn, devices)
+            if tlocation:
+                test_logger.info("Target device {} unchanged at {}".format(i, tlocation))
             else:
-                raise ValueError("Invalid target type ")
-            target = cw.target(None, target_type, sn=str(conf['target serial number']))
-
-            # update firmware if new one available
-            if target.latest_fw_str > target.fw_version_str:
-                target.upgrade_firmware()
-                time.sleep(5)
-                target = cw.target(None, target_type, sn=conf['target serial number'])
-                test_logger.info("Upgraded target firmware for device {}".format(i))
-
-            tlocation = target._getNAEUSB().hw_location()
-            test_logger.info("Found target device {} at {}".format(i, tlocation))
-            target.dis()
+                if conf['target'] == "CW305":
+                    target_type =  cw.targets.CW305
+                elif conf['target'] == "CW310":
+                    target_type =  cw.targets.CW310
+                else:
+                    raise ValueError("Invalid target type ")
+                connect_target = lambda: cw.target(None, target_type, sn=tsn)
+                target = connect_target()
+
+                # update firmware if new one available
+                if target.latest_fw_str > target.fw_version_str:
+                    with upgrade_lock:
+                        target.upgrade_firmware()
+                        target = wait_for_device(connect_target, tsn)
+                    test_logger.info("Upgraded target firmware for device {}".format(i))
+
+                tlocation = target._getNAEUSB().hw_location()
+                device_cache.store(tsn, tlocation, target.fw_version_str)
+                test_logger.info("Found target device {} at {}".format(i, tlocation))
+                target.dis()
 
         # get scope hw_location
         if not conf.get('serial number') is None:
-            scope = cw.scope(force=True, sn=str(conf['serial number']))
+            sn = str(conf['serial number'])
+            MPSSE = conf.get('MPSSE') is True
+            slocation = device_cache.lookup(sn, devices, MPSSE)
+            if slocation:
+                test_logger.info("Device {} unchanged at {}".format(i, slocation))
+                return slocation, tlocation
+
+            connect_scope = lambda: cw.scope(force=True, sn=sn)
+            scope = connect_scope()
 
             #update firmware if new one available
             if scope.latest_fw_str > scope.fw_version_str:
-                scope.upgrade_firmware()
-                time.sleep(5)
-                scope = cw.scope(force=True, sn=str(conf['serial number']))
+                with upgrade_lock:
+                    scope.upgrade_firmware()
+                    scope = wait_for_device(connect_scope, sn)
                 test_logger.info("Upgraded firmware for device {}".format(i))
             else:
                 test_logger.info("Device {} up to date".format(i))
 
             # swap to MPSSE mode if required
-            if conf.get('MPSSE') is True:
+            if MPSSE:
                 scope.enable_MPSSE()
-                time.sleep(5)
-                scope = cw.scope(force=True, sn=str(conf['serial number']))
+                scope = wait_for_device(connect_scope, sn)
                 test_logger.info("Changing device {} to MPSSE mode".format(i))
 
             test_logger.info("MPSSE enabled = {}".format(scope._getNAEUSB().is_MPSSE_enabled()))
             slocation = scope._getNAEUSB().hw_location()
+            device_cache.store(sn, slocation, scope.fw_version_str, MPSSE)
             test_logger.info("Found device {} at {}".format(i, slocation))
             scope.dis()
         return slocation, tlocation
 
-    for i in range(num_hardware):
-        loggers.append(create_logger(i))
-        s, t = setup_HW(connected_hardware[i], i)
-        hw_locations.append(s)
-        target_hw_locations.append(t)
+    hw_ids = list(range(num_hardware))
+    shard_jobs = None
+    if shard is not None:
+        shard_jobs = {}
+        for job in shard['jobs']:
+            shard_jobs.setdefault(job['hardware'], set()).add((job['notebook'], job['configuration']))
+        hw_ids = sorted(shard_jobs)
+        test_logger.info("Running shard with {} jobs on hardware {}, estimated {}s".format(len(shard['jobs']), hw_ids,
+                                                                                          shard.get('estimated seconds')))
+
+    # build the firmware every job needs while the hardware is being set up
+    prebuild = None
+    if build_workers:
+        if not firmware_cache_dir:
+            firmware_cache_dir = os.path.join(output_dir, '.firmware_cache')
+        firmware_cache_env(firmware_cache_dir)
+        builds = []
+        for nb in tutorials.keys():
+            for config_index, test_config in enumerate(tutorials[nb]['configurations']):
+                for i in test_config['ids']:
+                    if i in hw_ids and (shard_jobs is None or (nb, config_index) in shard_jobs[i]):
+                        for build in firmware_builds(os.path.join(nb_dir, nb), notebook_kwargs(connected_hardware[i], test_config)):
+                            if build not in builds:
+                                builds.append(build)
+        prebuild = threading.Thread(target=prebuild_firmware, args=(builds, firmware_cache_dir, build_workers))
+        prebuild.start()
+
+    # set every device up at once, they're independent
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, len(hw_ids))) as setup_pool:
+        setups = {i: setup_pool.submit(setup_HW, connected_hardware[i], i) for i in hw_ids if not replay_dir}
+        for i in range(num_hardware):
+            loggers.append(create_logger(i))
+            if i in setups:
+                s, t = setups[i].result()
+            else:
+                s, t = None, None
+            hw_locations.append(s)
+            target_hw_locations.append(t)
+
+    if prebuild:
+        prebuild.join()
 
+    # devices could have been programmed by anything since the last run
+    program_cache_dir = None
+    if skip_reprogram:
+        program_cache_dir = os.path.join(output_dir, '.program_cache')
+        ProgramCache(program_cache_dir).clear()
 
     # Run each on of the tutorials with each supported hardware
     # configuration for that tutorial and export the output
@@ -817,12 +3043,35 @@ def run_tests(cw_dir, config, results_path=None, output_dir=None):
     results = []
     test_logger.info("num hw: {}".format(num_hardware))
     results_data = {}
-    with ProcessPoolExecutor(max_workers=num_hardware) as nb_pool:
-        test_future = {nb_pool.submit(run_test_hw_config, i, cw_dir, config, hw_locations[i], target_hw_locations[i], loggers[i], output_dir): i for i in range(num_hardware)}
+
+    # last run's results, to compare run times against
+    previous_results = {}
+    previous_results_path = os.path.join(output_dir, "results.yaml")
+    if os.path.isfile(previous_results_path):
+        with open(previous_results_path, 'r') as f:
+            previous_results = yaml.safe_load(f) or {}
+
+    journal_dir = os.path.join(output_dir, '.journal')
+    journal = ResultsJournal(journal_dir)
+    if not resume:
+        journal.clear()
+
+    if not history_path:
+        history_path = os.path.join(replay_dir or output_dir, 'history.sqlite')
+    started = datetime.now()
+
+    with ProcessPoolExecutor(max_workers=max(1, len(hw_ids)), initializer=LogWriter.attach,
+                             initargs=(log_writer.queue, log_writer.hw_names)) as nb_pool:
+        test_future = {nb_pool.submit(run_test_hw_config, i, cw_dir, config, hw_locations[i], target_hw_locations[i], loggers[i], output_dir, kernel_pool_size, sim_workers, cache_dir, force,
+                                     previous_results.get(sname_to_log_name(connected_hardware[i])), fail_fast, cell_timeout, notebook_timeout,
+                                     shard_jobs[i] if shard_jobs is not None else None, program_cache_dir, journal_dir, resume,
+                                     checkpoint, history_path, replay_dir, record_dir): i for i in hw_ids}
         for future in as_completed(test_future):
-            hw_summary, hw_tests, hw_id = future.result()
-            sname = sname_to_log_name(connected_hardware[hw_id])
-            results_data[sname] = hw_tests
+            # a crashed worker's finished notebooks are still in the journal
+            try:
+                hw_summary, hw_tests, hw_id = future.result()
+            except Exception as e:
+                test_logger.error("Tests for hardware {} crashed: {}".format(test_future[future], e))
             # summary[str(index)]['failed'] += hw_summary['failed']
             # summary[str(index)]['run'] += hw_summary['run']
 
@@ -830,6 +3079,21 @@ def run_tests(cw_dir, config, results_path=None, output_dir=None):
             # tests.update(hw_tests)
     
     test_logger.log(60, "Finished all tests, writing results.yaml...")
+    results_data = journal.results()
+
+    # keep every result for queries across runs
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cw_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True).stdout.strip() or None
+    history = TestHistory(history_path)
+    summary['run id'] = history.add_run(commit, started, full=shard is None)
+    summary['history'] = history_path
+    history.add_journal(summary['run id'], journal)
+    for record in journal.records():
+        summary['all']['run'] += 1
+        summary['all']['failed'] += not record['result'].get('passed')
+    for flaky in history.flaky():
+        test_logger.log(60, "Flaky: {} on {}, {} flips in {} runs".format(flaky['notebook'], flaky['hardware'], flaky['flips'], flaky['runs']))
+    history.close()
 
     test_logger.info("\nResults data: {}\n".format(str(results_data)))
     # output_dir = os.path.join(cw_dir, 'tutorials')
@@ -849,7 +3113,52 @@ def run_tests(cw_dir, config, results_path=None, output_dir=None):
     return summary, tests
 
 if __name__ == '__main__':
-    script, cw_dir, config_file_path, results_path, tutorial_path = sys.argv
-    run_tests(cw_dir, config_file_path, results_path, tutorial_path)
+    parser = argparse.ArgumentParser(description="Run the tutorial notebooks on the hardware in a tests.yaml config")
+    parser.add_argument('cw_dir')
+    parser.add_argument('config_file_path')
+    parser.add_argument('results_path')
+    parser.add_argument('tutorial_path')
+    parser.add_argument('--force', action='store_true', help="re-run notebooks even if a cached result matches")
+    parser.add_argument('--fail-fast', choices=['stop', 'dependents'], help="skip all cells after the first error, or only cells depending on failed ones")
+    parser.add_argument('--cell-timeout', type=float, help="seconds before a cell is interrupted")
+    parser.add_argument('--notebook-timeout', type=float, help="seconds before a notebook is stopped")
+    parser.add_argument('--build-workers', type=int, default=4, help="processes prebuilding firmware, 0 to not cache firmware builds")
+    parser.add_argument('--always-program', action='store_true', help="program the target in every notebook, even if it has the firmware already")
+    parser.add_argument('--no-checkpoint', action='store_true', help="run every configuration of a notebook from the first cell")
+    parser.add_argument('--replay', metavar='DIR', help="run without devices, replaying the recordings in DIR (see cw_replay.py)")
+    parser.add_argument('--record', metavar='DIR', help="record every notebook's device use into DIR for --replay")
+    parser.add_argument('--resume', action='store_true', help="continue an interrupted run, skipping notebooks that already have a result")
+    parser.add_argument('--shards', type=int, help="write a plan splitting the tests into this many shards to --shard-plan, "
+                                                   "balanced with the run times in tutorial_path/results.yaml, then exit")
+    parser.add_argument('--shard', type=int, help="only run this shard (counting from 0) of --shard-plan")
+    parser.add_argument('--shard-plan', help="shard plan file (default results_path/shards.yaml)")
+    parser.add_argument('--merge', nargs='+', metavar='RESULTS', help="merge shard results.yaml files into results_path "
+                                                                      "and tutorial_path, then exit")
+    args = parser.parse_args()
+    shard_plan_path = args.shard_plan or os.path.join(args.results_path, "shards.yaml")
+    if args.merge:
+        merge_results(args.merge, [os.path.join(args.results_path, "results.yaml"), os.path.join(args.tutorial_path, "results.yaml")])
+    elif args.shards:
+        previous_results = {}
+        previous_results_path = os.path.join(args.tutorial_path, "results.yaml")
+        if os.path.isfile(previous_results_path):
+            with open(previous_results_path, 'r') as f:
+                previous_results = yaml.safe_load(f) or {}
+        history_path = os.path.join(args.tutorial_path, "history.sqlite")
+        history = TestHistory(history_path) if os.path.isfile(history_path) else None
+        shards = plan_shards(args.config_file_path, args.shards, previous_results, history=history)
+        with open(shard_plan_path, "w+") as f:
+            yaml.dump(shards, f, default_flow_style=False)
+        for k, shard in enumerate(shards):
+            print("Shard {}: {} jobs, estimated {}s".format(k, len(shard['jobs']), shard['estimated seconds']))
+    else:
+        shard = None
+        if args.shard is not None:
+            with open(shard_plan_path, 'r') as f:
+                shard = yaml.safe_load(f)[args.shard]
+        run_tests(args.cw_dir, args.config_file_path, args.results_path, args.tutorial_path, force=args.force,
+                  fail_fast=args.fail_fast, cell_timeout=args.cell_timeout, notebook_timeout=args.notebook_timeout, shard=shard,
+                  build_workers=args.build_workers, skip_reprogram=not args.always_program, resume=args.resume,
+                  checkpoint=not args.no_checkpoint, replay_dir=args.replay, record_dir=args.record)
     # run_tests()
 